@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+####
+#
+#
+#                              PIntron
+#
+# A novel pipeline for computational gene-structure prediction based on
+# spliced alignment of expressed sequences (ESTs and mRNAs).
+#
+# Copyright (C) 2010  Gianluca Della Vedova, Yuri Pirola
+#
+# Distributed under the terms of the GNU Affero General Public License (AGPL)
+#
+#
+# This file is part of PIntron.
+#
+# PIntron is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PIntron is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PIntron.  If not, see <http://www.gnu.org/licenses/>.
+#
+####
+#
+# Benchmarks of the Python post-processing of the PIntron pipeline.
+#
+# The intermediate files read by the post-processing (out-after-intron-agree.txt,
+# predicted-introns.txt, CCDS_transcripts.txt, VariantGTF.txt) are synthesized
+# for loci of increasing size, so that the benchmarks do not need the compiled
+# programs of the pipeline.
+#
+# Usage: pintron-bench.py [options] BENCHMARK
+#   BENCHMARK = loading  -- loading the coordinates of many loci from the JSON files and from the bundles
+#   BENCHMARK = memory   -- peak RSS of step 8 (compute_json) w.r.t. the number of ESTs
+#   BENCHMARK = parsers  -- throughput of the parsers of the intermediate files
+#   BENCHMARK = scaling  -- running time of step 8 (compute_json) w.r.t. the output size
+#
+####
+
+
+import contextlib
+import json
+import importlib.machinery
+import importlib.util
+import os
+import os.path
+import multiprocessing
+import random
+import resource
+import shutil
+import tempfile
+import time
+import types
+
+from optparse import OptionParser
+
+
+def load_pintron(path):
+    """Load the pintron driver (which has no .py extension once installed) as a module."""
+    loader = importlib.machinery.SourceFileLoader("pintron", path)
+    spec = importlib.util.spec_from_loader("pintron", loader)
+    pintron = importlib.util.module_from_spec(spec)
+    loader.exec_module(pintron)
+    # compute_json() reads the program version from the global options
+    pintron.options = types.SimpleNamespace(version="-bench")
+    return pintron
+
+
+def read_genomic(genomic_file):
+    """Return the chromosome, start, strand and sequence of a genomic file."""
+    with open(genomic_file) as fd:
+        (chromosome, start, end, strand) = fd.readline().strip()[1:].split(':')
+        sequence = "".join(line.strip() for line in fd).upper()
+    return (chromosome, int(start), '-' if strand in ('-', '-1') else '+', sequence)
+
+
+def synthesize_locus(directory, n_exons, n_isoforms, n_ests, strand='+', seed=1, genomic_file=None):
+    """Write the intermediate files of a synthetic locus in directory.
+
+    The isoforms are random subsets of n_exons exons, the ESTs are random chains of
+    consecutive exons of the isoforms, and the introns are the gaps between the
+    consecutive exons of the isoforms supported by at least one EST.
+    The genomic sequence is random, unless a genomic_file is given.
+    """
+    rnd = random.Random(seed)
+    if genomic_file:
+        (chromosome, chr_start, strand, genome) = read_genomic(genomic_file)
+        max_gap = max(300, (len(genome) - 2000) // n_exons - 250)
+    else:
+        max_gap = 3000
+    position = 1000
+    exons = []
+    for i in range(n_exons):
+        length = rnd.randint(80, 250)
+        exons.append((position, position + length - 1))
+        position += length + rnd.randint(300, max_gap)
+    if not genomic_file:
+        (chromosome, chr_start) = ("chr17", 7570000)
+        genome = "".join(rnd.choice("ACGT") for i in range(position + 1000))
+    elif position + 1000 > len(genome):
+        raise ValueError("{} exons do not fit in {}".format(n_exons, genomic_file))
+    genome_length = len(genome)
+
+    def absolute(pos):
+        return chr_start + pos - 1 if strand == '+' else chr_start + genome_length - pos
+
+    with open(os.path.join(directory, "genomic.txt"), "w") as fd:
+        fd.write(">{}:{}:{}:{}\n".format(chromosome, chr_start, chr_start + genome_length - 1,
+                                         "1" if strand == '+' else "-1"))
+        for i in range(0, genome_length, 60):
+            fd.write(genome[i:i + 60] + "\n")
+
+    isoforms = []
+    while len(isoforms) < n_isoforms:
+        isoform = sorted(rnd.sample(range(n_exons), rnd.randint(min(3, n_exons), n_exons)))
+        if isoform not in isoforms:
+            isoforms.append(isoform)
+
+    supporting_ests = {}
+    with open(os.path.join(directory, "out-after-intron-agree.txt"), "w") as fd:
+        for est in range(n_ests):
+            isoform = rnd.choice(isoforms)
+            first = rnd.randint(0, len(isoform) - 2)
+            last = rnd.randint(first + 1, len(isoform) - 1)
+            chain = isoform[first:last + 1]
+            accession = "AB{:06d}".format(est)
+            header = ">gnl|UG|Hs#S{0} Homo sapiens cDNA /gb={1} /gi={0} /ug=Hs.1".format(est, accession)
+            if rnd.random() < 0.3:
+                header += " /clone_end={}".format(rnd.choice([3, 5]))
+            fd.write(header + "\n")
+            if rnd.random() < 0.2:
+                fd.write("#polya=1\n")
+                if rnd.random() < 0.5:
+                    fd.write("#polyad-pas=1\n")
+            est_length = 0
+            for exon in chain:
+                sequence = genome[exons[exon][0] - 1:exons[exon][1]]
+                fd.write("{} {} {} {} {} {}\n".format(est_length + 1, est_length + len(sequence),
+                                                      exons[exon][0], exons[exon][1],
+                                                      sequence, sequence))
+                est_length += len(sequence)
+            for donor, acceptor in zip(chain, chain[1:]):
+                supporting_ests.setdefault((exons[donor][1] + 1, exons[acceptor][0] - 1),
+                                           set()).add(accession)
+
+    with open(os.path.join(directory, "predicted-introns.txt"), "w") as fd:
+        for (start, end) in sorted(supporting_ests):
+            ests = sorted(supporting_ests[(start, end)])
+            fd.write("\t".join(str(field) for field in [
+                start, end, absolute(start), absolute(end), end - start + 1,
+                len(ests), ",".join(ests) + ",", 0.01, 0.02, 0.9, 0.8, 0.0, -1, "U2", "GTAG", "G",
+                genome[start - 16:start - 1], genome[start - 1:start + 19],
+                genome[end - 20:end], genome[end:end + 15]]) + "\n")
+
+    with open(os.path.join(directory, "CCDS_transcripts.txt"), "w") as fccds, \
+         open(os.path.join(directory, "VariantGTF.txt"), "w") as fvariant:
+        fccds.write("{}\n{}\n".format(len(isoforms), genome_length))
+        for index, isoform in enumerate(isoforms, 1):
+            length = sum(exons[exon][1] - exons[exon][0] + 1 for exon in isoform)
+            annotated = index % 3 != 0
+            cds_start = rnd.randint(20, 60)
+            cds_end = length - rnd.randint(20, 60)
+            cds_end -= (cds_end - cds_start + 1) % 3
+            fvariant.write("tr#{} /nex={} /L={} /CDS={} /RefSeq={} /ProtL={} /Frame={} /Type={}\n".format(
+                index, len(isoform), length,
+                "{}..{}".format(cds_start, cds_end) if annotated else "..",
+                "NM_{:06d}(YY)".format(index) if index == 1 else "(NN)",
+                (cds_end - cds_start + 1) // 3 if annotated else "..",
+                "y" if index == 1 else "n",
+                "Ref" if index == 1 else "Alt"))
+            fccds.write(">{}:{}:{}:{}:0\n".format(index, len(isoform), int(index == 1), int(index == 1)))
+            rows = []
+            transcript_length = 0
+            for position, exon in enumerate(isoform):
+                start, end = exons[exon]
+                exon_length = end - start + 1
+                utr5 = utr3 = -1
+                if annotated:
+                    utr5 = min(exon_length, max(0, cds_start - 1 - transcript_length))
+                    utr3 = min(exon_length, max(0, transcript_length + exon_length - cds_end))
+                polya = int(position == len(isoform) - 1 and index % 2 == 1)
+                rows.append("{}:{}:{}:{}:{}:{}:{}\n{}\n".format(absolute(start), absolute(end), start, end,
+                                                               polya, utr5, utr3,
+                                                               genome[start - 1:end].lower()))
+                transcript_length += exon_length
+            # The exons are listed from the 3' end
+            fccds.writelines(reversed(rows))
+
+
+def run_compute_json(pintron, directory, output_file):
+    # The synthetic CDSs do not start/end with real codons: discard the warnings
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        pintron.compute_json(ccds_file=os.path.join(directory, "CCDS_transcripts.txt"),
+                             variant_file=os.path.join(directory, "VariantGTF.txt"),
+                             output_file=output_file,
+                             pas_tolerance=30,
+                             genomic_seq=os.path.join(directory, "genomic.txt"),
+                             factorization_file=os.path.join(directory, "out-after-intron-agree.txt"),
+                             introns_file=os.path.join(directory, "predicted-introns.txt"))
+
+
+def bench_scaling(pintron, options):
+    """Running time of compute_json on loci of increasing size."""
+    print("{:>6} {:>7} {:>9} {:>8} {:>8} {:>10} {:>9} {:>10}".format(
+        "scale", "exons", "isoforms", "introns", "ESTs", "output_MB", "time_s", "s/MB"))
+    for scale in [2 ** i for i in range(options.steps)]:
+        directory = tempfile.mkdtemp(prefix="pintron-bench-")
+        try:
+            synthesize_locus(directory, n_exons=options.exons * scale, n_isoforms=options.isoforms * scale,
+                             n_ests=options.ests * scale, strand=options.strand)
+            with open(os.path.join(directory, "predicted-introns.txt")) as fd:
+                n_introns = sum(1 for line in fd)
+            output_file = os.path.join(directory, "pintron-full-output.json")
+            best = None
+            for repetition in range(options.repetitions):
+                start = time.perf_counter()
+                run_compute_json(pintron, directory, output_file)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            size = os.path.getsize(output_file) / (1024 * 1024)
+            print("{:>6} {:>7} {:>9} {:>8} {:>8} {:>10.2f} {:>9.3f} {:>10.3f}".format(
+                scale, options.exons * scale, options.isoforms * scale, n_introns,
+                options.ests * scale, size, best, best / size))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_parsers(pintron, options):
+    """Throughput of the parsers of the intermediate files on loci modeled on the example."""
+    genomic_file = os.path.join(options.example, "genomic.txt")
+    with open(os.path.join(options.example, "ests.txt")) as fd:
+        example_ests = sum(1 for line in fd if line.startswith('>'))
+    parsers = [
+        ("out-after-intron-agree.txt", pintron.read_factorizations),
+        ("VariantGTF.txt", pintron.read_variants),
+        ("CCDS_transcripts.txt", pintron.read_ccds_transcripts),
+        ("predicted-introns.txt", pintron.read_introns),
+    ]
+    print("{:>6} {:>8} {:>28} {:>8} {:>9} {:>9} {:>8}".format(
+        "scale", "ESTs", "file", "size_MB", "lines", "time_s", "MB/s"))
+    for scale in [2 ** i for i in range(options.steps)]:
+        directory = tempfile.mkdtemp(prefix="pintron-bench-")
+        try:
+            synthesize_locus(directory, n_exons=options.exons, n_isoforms=options.isoforms,
+                             n_ests=example_ests * scale, genomic_file=genomic_file)
+            total = 0.0
+            for (name, parser) in parsers:
+                filename = os.path.join(directory, name)
+                with open(filename) as fd:
+                    lines = sum(1 for line in fd)
+                best = None
+                for repetition in range(options.repetitions):
+                    start = time.perf_counter()
+                    for record in parser(filename):
+                        pass
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                total += best
+                size = os.path.getsize(filename) / (1024 * 1024)
+                print("{:>6} {:>8} {:>28} {:>8.2f} {:>9} {:>9.4f} {:>8.1f}".format(
+                    scale, example_ests * scale, name, size, lines, best, size / best))
+            output_file = os.path.join(directory, "pintron-full-output.json")
+            start = time.perf_counter()
+            run_compute_json(pintron, directory, output_file)
+            elapsed = time.perf_counter() - start
+            print("{:>6} {:>8} {:>28} {:>8} {:>9} {:>9.4f} {:>7.0f}%".format(
+                scale, example_ests * scale, "(parsing / compute_json)", "", "", elapsed,
+                100 * total / elapsed))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def _peak_rss_of_compute_json(pintron_file, directory, output_file):
+    """Run compute_json in a fresh process and return its peak RSS (in MiB)."""
+    pintron = load_pintron(pintron_file)
+    run_compute_json(pintron, directory, output_file)
+    # ru_maxrss is measured in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_memory(pintron, options):
+    """Peak RSS of compute_json on loci with an increasing number of ESTs."""
+    drivers = [("current", options.pintron)]
+    if options.baseline:
+        drivers.insert(0, ("baseline", options.baseline))
+    # Each measure runs in a new interpreter, so that it does not inherit the memory of the others
+    context = multiprocessing.get_context("spawn")
+    print("{:>6} {:>8} {:>10} {:>10} {:>12}".format("scale", "ESTs", "input_MB", "driver", "peak_RSS_MB"))
+    for scale in [2 ** i for i in range(options.steps)]:
+        directory = tempfile.mkdtemp(prefix="pintron-bench-")
+        try:
+            synthesize_locus(directory, n_exons=options.exons, n_isoforms=options.isoforms,
+                             n_ests=options.ests * scale, strand=options.strand)
+            size = os.path.getsize(os.path.join(directory, "out-after-intron-agree.txt")) / (1024 * 1024)
+            for (label, pintron_file) in drivers:
+                with context.Pool(1) as pool:
+                    peak = pool.apply(_peak_rss_of_compute_json,
+                                      (pintron_file, directory, os.path.join(directory, "pintron-full-output.json")))
+                print("{:>6} {:>8} {:>10.1f} {:>10} {:>12.1f}".format(
+                    scale, options.ests * scale, size, label, peak))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_loading(pintron, options):
+    """Loading the coordinates of the exons and the introns of an increasing number of loci."""
+    directory = tempfile.mkdtemp(prefix="pintron-bench-")
+    try:
+        synthesize_locus(directory, n_exons=options.exons, n_isoforms=options.isoforms,
+                         n_ests=options.ests, strand=options.strand)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            gene = pintron.build_gene(os.path.join(directory, "CCDS_transcripts.txt"),
+                                      os.path.join(directory, "VariantGTF.txt"), 30,
+                                      os.path.join(directory, "genomic.txt"),
+                                      os.path.join(directory, "out-after-intron-agree.txt"),
+                                      os.path.join(directory, "predicted-introns.txt"))
+        json_file = os.path.join(directory, "locus.json")
+        bundle_file = os.path.join(directory, "locus.bundle")
+        pintron.export_gene(gene, "GENE", json_file=json_file, bundle_file=bundle_file)
+        print("{:>6} {:>10} {:>9} {:>10} {:>11} {:>8}".format(
+            "loci", "JSON_MB", "JSON_s", "bundle_MB", "bundle_s", "speedup"))
+        loci = []
+        for scale in [2 ** i for i in range(options.steps)]:
+            # Each locus has its own files, as in the output of a batch
+            while len(loci) < 16 * scale:
+                locus = os.path.join(directory, str(len(loci)))
+                shutil.copyfile(json_file, locus + ".json")
+                shutil.copyfile(bundle_file, locus + ".bundle")
+                loci.append(locus)
+            start = time.perf_counter()
+            starts = []
+            ends = []
+            for locus in loci:
+                with open(locus + ".json") as fd:
+                    content = json.load(fd)
+                for isoform in content['isoforms'].values():
+                    for exon in isoform['exons']:
+                        starts.append(exon['absolute_start'])
+                        ends.append(exon['absolute_end'])
+                for intron in content['introns'].values():
+                    starts.append(intron['absolute_start'])
+                    ends.append(intron['absolute_end'])
+            json_time = time.perf_counter() - start
+            start = time.perf_counter()
+            pintron.load_bundles([locus + ".bundle" for locus in loci], tables=('exons', 'introns'),
+                                 columns=('absolute_start', 'absolute_end'))
+            bundle_time = time.perf_counter() - start
+            print("{:>6} {:>10.2f} {:>9.3f} {:>10.2f} {:>11.4f} {:>7.0f}x".format(
+                len(loci), len(loci) * os.path.getsize(json_file) / (1024 * 1024), json_time,
+                len(loci) * os.path.getsize(bundle_file) / (1024 * 1024), bundle_time,
+                json_time / bundle_time))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+BENCHMARKS = {
+    'loading': bench_loading,
+    'memory': bench_memory,
+    'parsers': bench_parsers,
+    'scaling': bench_scaling,
+}
+
+
+def parse_command_line():
+    usage = "usage: %prog [options] " + "|".join(sorted(BENCHMARKS))
+    parser = OptionParser(usage=usage)
+    parser.add_option("--pintron",
+                      dest="pintron",
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           os.pardir, "dist-scripts", "pintron.py"),
+                      help="FILE of the pintron driver to benchmark (default = '%default')",
+                      metavar="FILE")
+    parser.add_option("--baseline",
+                      dest="baseline", default=None,
+                      help="FILE of another pintron driver to compare with in the memory benchmark",
+                      metavar="FILE")
+    parser.add_option("--example",
+                      dest="example",
+                      default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           os.pardir, "dist-docs", "example"),
+                      help="DIRECTORY of the example whose genomic sequence and number of ESTs "
+                      "are used by the parsers benchmark (default = '%default')",
+                      metavar="DIRECTORY")
+    parser.add_option("--exons",
+                      dest="exons", type="int", default=10,
+                      help="number of exons of the smallest locus (default = %default)")
+    parser.add_option("--isoforms",
+                      dest="isoforms", type="int", default=5,
+                      help="number of isoforms of the smallest locus (default = %default)")
+    parser.add_option("--ests",
+                      dest="ests", type="int", default=100,
+                      help="number of ESTs of the smallest locus (default = %default)")
+    parser.add_option("--strand",
+                      dest="strand", default="+",
+                      help="strand of the synthetic loci (default = '%default')")
+    parser.add_option("--steps",
+                      dest="steps", type="int", default=6,
+                      help="number of loci, each twice as large as the previous one (default = %default)")
+    parser.add_option("--repetitions",
+                      dest="repetitions", type="int", default=3,
+                      help="number of repetitions of each measure (default = %default)")
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error("a single benchmark among " + ", ".join(sorted(BENCHMARKS)) + " is required")
+    options.benchmark = args[0]
+    return options
+
+
+if __name__ == '__main__':
+    options = parse_command_line()
+    pintron = load_pintron(options.pintron)
+    BENCHMARKS[options.benchmark](pintron, options)
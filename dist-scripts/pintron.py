@@ -35,6 +35,7 @@ import sys
 import re
 import os
 import os.path
+import stat
 import subprocess
 import time
 import logging
@@ -43,7 +44,37 @@ import pprint
 import traceback
 import csv
 import hashlib
-import socket
+import copy
+import multiprocessing
+import shutil
+import tempfile
+import signal
+import threading
+import bisect
+import gzip
+import bz2
+import lzma
+import io
+import queue
+import collections
+import concurrent.futures
+import contextvars
+import asyncio
+import itertools
+import array
+import mmap
+import struct
+import zlib
+import heapq
+import contextlib
+import resource
+import cProfile
+import pstats
+import glob
+import shlex
+import fcntl
+import socketserver
+import http.server
 
 from optparse import OptionParser
 
@@ -58,20 +89,6 @@ def md5Checksum(filePath):
         m.update(data)
     return m.hexdigest()
 
-HOST = 'stunning-pancake'                 # Symbolic name meaning all available interfaces
-PORT = 80              # Arbitrary non-privileged port
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.bind((HOST, PORT))
-    s.listen(1)
-    conn, addr = s.accept()
-    with conn:
-        print('Connected by', addr)
-        while True:
-            data = conn.recv(1024)
-            if not data: break
-            conn.sendall(data)
-
-
 
 class PIntronError(Exception):
     """Base class for exceptions of the PIntron pipeline."""
@@ -94,6 +111,30 @@ class PIntronIOError(PIntronError):
         return '{0} (offending file: "{1}")'.format(self.msg, self.e_file)
 
 
+class PIntronStageError(PIntronError):
+    """Exception raised when a program of the pipeline terminates with an error.
+
+    Attributes:
+        cmd_label -- label of the stage
+        retcode   -- exit status of the program (negative if killed by a signal)
+        usage     -- resource usage of the program (from wait4)
+        msg       -- explanation of the error
+        stderr    -- last bytes of the standard error of the program
+        limits    -- resource limits (resource -> value) the program was executed with
+    """
+
+    def __init__(self, cmd_label, retcode, usage, msg, stderr=b"", limits=None):
+        self.cmd_label = cmd_label
+        self.retcode = retcode
+        self.usage = usage
+        self.msg = msg
+        self.stderr = stderr
+        self.limits = limits or {}
+
+    def __str__(self):
+        return '{0} (stage {1}, exit status {2})'.format(self.msg, self.cmd_label, self.retcode)
+
+
 def parse_command_line():
     usage = "usage: %prog [options]"
     parser = OptionParser(usage=usage)
@@ -112,9 +153,23 @@ def parse_command_line():
                       default="pintron-full-output.json",
                       help="full output file (default = '%default')",
                       metavar="FILE")
+    parser.add_option("--json-format",
+                      dest="json_format", type="choice", choices=list(JSON_FORMATS), default="pretty",
+                      help="format of the full output file: " + ", ".join(JSON_FORMATS) +
+                      " (default = '%default')")
     parser.add_option("-z", "--compress", action="store_true",
                       dest="compress", default=False,
-                      help="compress output (default = %default)")
+                      help="compress the output files and the logs while they are written, "
+                      "adding the suffix of the codec to their names (default = %default)")
+    parser.add_option("--compression-codec",
+                      dest="compression_codec", type="choice", choices=sorted(COMPRESSION_CODECS),
+                      default="gzip",
+                      help="codec of the compressed files: " + ", ".join(sorted(COMPRESSION_CODECS)) +
+                      " (default = '%default')")
+    parser.add_option("--compression-level",
+                      dest="compression_level", type="int", default=None,
+                      help="compression level, from 1 (fastest) to 9 (best); "
+                      "the default is 9 for gzip and bz2, 6 for xz")
     parser.add_option("-l", "--logfile",
                       dest="plogfile", default="pintron-pipeline-log.txt",
                       help="log filename of the pipeline steps (default = '%default')",
@@ -135,6 +190,41 @@ def parse_command_line():
     parser.add_option("-k", "--keep-intermediate-files", action="store_true",
                       dest="no_clean", default=False,
                       help="keep all intermediate or temporary files (default = %default)")
+    parser.add_option("--scratch-dir",
+                      dest="scratch_dir", default="",
+                      help="DIRECTORY (e.g., a tmpfs such as /dev/shm) where the private scratch "
+                      "directory of the run is created (default = current directory)",
+                      metavar="DIRECTORY")
+    parser.add_option("--scratch-size-limit",
+                      dest="scratch_size_limit", type="int", default=0,
+                      help="maximum size (in MiB) of the files in the scratch directory (and in its "
+                      "subdirectories), checked after each stage: the run fails as soon as a stage "
+                      "leaves more files than that, 0 to disable (default = %default)")
+    parser.add_option("--cache-dir",
+                      dest="cache_dir", default="",
+                      help="DIRECTORY of the cache of the results: runs with the same inputs, "
+                      "options and programs reuse the cached results, and runs on the same genomic "
+                      "sequence reuse the factorizations of the ESTs already factorized (default = no cache)",
+                      metavar="DIRECTORY")
+    parser.add_option("--cache-size-limit",
+                      dest="cache_size_limit", type="int", default=10240,
+                      help="maximum size (in MiB) of the cache of the results, the least recently "
+                      "used results are evicted first, 0 to disable (default = %default)")
+    parser.add_option("--cache-list", action="store_true",
+                      dest="cache_list", default=False,
+                      help="list the entries of the cache of the results and exit")
+    parser.add_option("--cache-purge", action="store_true",
+                      dest="cache_purge", default=False,
+                      help="remove all the entries of the cache of the results and exit")
+    parser.add_option("--resume", action="store_true",
+                      dest="resume", default=False,
+                      help="keep the intermediate files in a persistent work directory and skip the "
+                      "stages whose inputs, parameters and programs did not change since their "
+                      "last successful execution (default = %default)")
+    parser.add_option("--pipe-stages", action="store_true",
+                      dest="pipe_stages", default=False,
+                      help="connect the consecutive stages that only use the standard input/output "
+                      "with pipes, instead of intermediate files (default = %default)")
     parser.add_option("-t", "--gtf",
                       dest="gtf_filename",
                       default="pintron-all-isoforms.gtf",
@@ -146,6 +236,39 @@ def parse_command_line():
                       default=False,
                       help="the GTF file will only contain the CDS-annotated isoforms "
                       "(default = '%default')")
+    parser.add_option("--cds-gtf",
+                      dest="cds_gtf_filename", default="",
+                      help="output GTF FILE with only the CDS-annotated isoforms",
+                      metavar="GTF_FILE")
+    parser.add_option("--gff3",
+                      dest="gff3_filename", default="",
+                      help="output GFF3 FILE with the gene, the predicted isoforms and their features",
+                      metavar="GFF3_FILE")
+    parser.add_option("--bed",
+                      dest="bed_filename", default="",
+                      help="output BED12 FILE with the predicted isoforms",
+                      metavar="BED_FILE")
+    parser.add_option("--bundle",
+                      dest="bundle_filename", default="",
+                      help="output FILE with the isoforms, their exons and the introns in a columnar "
+                      "binary layout, never compressed",
+                      metavar="BUNDLE_FILE")
+    parser.add_option("--profile",
+                      dest="profile_dir", default="",
+                      help="save in DIRECTORY the gprof data of the programs of the pipeline (when "
+                      "compiled with 'make PROF=yes') and the cProfile data of the steps of the driver, "
+                      "with a report of the hotspots of each stage (default = no profiling)",
+                      metavar="DIRECTORY")
+    parser.add_option("--profile-top",
+                      dest="profile_top", type="int", default=20,
+                      help="number of hotspots of each stage listed in the profiling report "
+                      "(default = %default)")
+    parser.add_option("--metrics",
+                      dest="metrics_filename", default="pintron-metrics.json",
+                      help="output JSON FILE with the resources used by each stage (wall time, CPU time, "
+                      "peak RSS, I/O, sizes of the input and output files), '' to disable "
+                      "(default = '%default')",
+                      metavar="METRICS_FILE")
 
     # parser.add_option("--strand",
     #                   dest="strand", type="int", default=1,
@@ -232,142 +355,1239 @@ def parse_command_line():
     parser.add_option("--set-max-intron-agreement-time",
                       dest="max_intron_agreement_time", type="int", default=30,
                       help="[Expert use only] Set a time limit (in mins) for the intron agreement step")
+    parser.add_option("--stage-timeout",
+                      dest="stage_timeout", type="int", default=0,
+                      help="[Expert use only] Kill the programs of a step still running after MINUTES "
+                      "minutes of wall-clock time, 0 for no timeout (default = %default)",
+                      metavar="MINUTES")
+    parser.add_option("--adaptive-limits", action="store_true",
+                      dest="adaptive_limits", default=False,
+                      help="[Expert use only] Estimate the time and memory needed by the factorization step "
+                      "from the length of the genomic sequence and the number and length of the ESTs, and "
+                      "use them as limits (never above the limits set by the previous options)")
+    parser.add_option("--max-degradation-level",
+                      dest="max_degradation_level", type="int", default=len(EST_FACT_DEGRADATION_LEVELS) - 1,
+                      help="[Expert use only] Maximum number of retries of the factorization step, each "
+                      "with more restrictive settings, when it exceeds its limits, 0 to disable "
+                      "(default = %default)")
+    parser.add_option("--est-fact-shards",
+                      dest="est_fact_shards", type="int", default=1,
+                      help="[Expert use only] Split the ESTs into N shards factorized in parallel, 0 for the "
+                      "number of processors; the shards are reduced to fit in the memory budget, since each "
+                      "of them indexes the whole genomic sequence (default = %default)",
+                      metavar="N")
+    parser.add_option("--collapse-duplicate-ests", action="store_true",
+                      dest="collapse_duplicate_ests", default=False,
+                      help="[Expert use only] Factorize only one representative of each group of identical ESTs "
+                      "(same sequence and same strand information in the header), and give its "
+                      "factorizations to all the ESTs of the group")
     parser.add_option("--pas-tolerance",
                       dest="pas_tolerance", type="int", default=30,
                       help="[Expert use only] Maximum allowed difference on the exon final coordinate to identify a PAS")
+    parser.add_option("--batch",
+                      dest="batch_manifest", default="",
+                      help="run the pipeline on all the loci listed in the tab-separated MANIFEST "
+                      "(columns: genomic file, EST file, gene, organism)",
+                      metavar="MANIFEST")
+    parser.add_option("--batch-dir",
+                      dest="batch_dir", default="pintron-batch",
+                      help="DIRECTORY where the work directory of each locus of the batch (or of each "
+                      "job of the service) is created (default = '%default')",
+                      metavar="DIRECTORY")
+    parser.add_option("-j", "--jobs",
+                      dest="jobs", type="int", default=os.cpu_count() or 1,
+                      help="number of loci of the batch (or jobs of the service) processed in parallel "
+                      "(default = %default)")
+    parser.add_option("--batch-engine",
+                      dest="batch_engine", type="choice", choices=["processes", "async"], default="processes",
+                      help="how the loci of the batch are processed in parallel: by a pool of worker "
+                      "'processes', or as concurrent jobs of this process driven by an 'async' event "
+                      "loop (see AsyncLocusPool) (default = '%default')")
+    parser.add_option("--serve",
+                      dest="serve", default="",
+                      help="run as a service accepting pipeline jobs over HTTP at ADDRESS, either "
+                      "HOST:PORT or the path of a Unix socket (see pintron_service)",
+                      metavar="ADDRESS")
+    parser.add_option("--serve-input-dir",
+                      dest="serve_input_dir", default="",
+                      help="DIRECTORY of the files that the jobs of the service may give as their "
+                      "inputs (default = the jobs must contain their sequences)",
+                      metavar="DIRECTORY")
+    parser.add_option("--serve-max-request-size",
+                      dest="serve_max_request_size", type="int", default=256,
+                      help="largest job (in MiB) accepted by the service, including the sequences "
+                      "it contains (default = %default)",
+                      metavar="MIB")
+    parser.add_option("--serve-max-finished-jobs",
+                      dest="serve_max_finished_jobs", type="int", default=1000,
+                      help="number of finished jobs kept by the service: the oldest ones are "
+                      "forgotten and their work directories removed (default = %default)",
+                      metavar="N")
+    parser.add_option("--memory-budget",
+                      dest="memory_budget", type="int", default=0,
+                      help="memory (in MiB) available to the loci of the batch processed in parallel (a "
+                      "locus is started only if its predicted memory fits) or to the shards of the "
+                      "factorization step, 0 for the memory available when they start (default = %default)")
+    parser.add_option("--cost-model",
+                      dest="cost_model", default="",
+                      help="JSON FILE with the resources used by the loci of past batches, used to predict "
+                      "the cost of each locus and updated after each locus (default = "
+                      "'pintron-cost-model.json' in the batch directory)",
+                      metavar="FILE")
+    parser.add_option("--merge-gtf",
+                      dest="merge_gtf", default="",
+                      help="merge the GTF files given as arguments (or, with --batch, the GTF files of "
+                      "the loci of the batch) into the sorted BGZF FILE, indexed in FILE.tbi",
+                      metavar="FILE")
+    parser.add_option("--query-gtf",
+                      dest="query_gtf", default="",
+                      help="print the records of the indexed GTF FILE written by --merge-gtf "
+                      "overlapping the regions NAME[:START[-END]] given as arguments and exit",
+                      metavar="FILE")
 
     (options, args) = parser.parse_args()
+    options.arguments = args
+    # The directory of the intermediate files kept by --no-clean (and of config.ini)
+    options.work_dir = os.curdir
+    if options.profile_dir:
+        options.profile_dir = os.path.normpath(options.profile_dir)
     if options.bindir:
         options.bindir = os.path.normpath(options.bindir)
 
     return(options)
 
 
+# Formats of the full output file: an indented JSON document, a JSON document
+# on a single line, or JSON Lines.
+JSON_FORMATS = ('pretty', 'compact', 'jsonl')
+
+# The maps of the full output that are written one entry at a time
+_JSON_STREAMED_MAPS = ('introns', 'isoforms')
+
+
+def write_json(gene, fd, json_format='pretty', on_entry=None):
+    """Write the gene to the full output file, one intron/isoform at a time.
+
+    The entries of the gene can be compact records, converted by their
+    to_json() method. The 'pretty' format is the same as
+    json.dumps(gene, sort_keys=True, indent=4).
+    In the 'jsonl' format, the first line contains all the fields of the
+    gene with empty introns and isoforms, and each of the following lines
+    contains a single intron ({"introns": {id: intron}}) or isoform
+    ({"isoforms": {id: isoform}}); read_json() merges them back.
+    If given, on_entry(name, key, value) is called for each intron and
+    isoform, in the order they are written.
+    """
+    def default(record):
+        return record.to_json()
+
+    if json_format == 'jsonl':
+        encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=default)
+        fd.write(encoder.encode({k: {} if k in _JSON_STREAMED_MAPS else v for (k, v) in gene.items()}))
+        fd.write("\n")
+        for name in _JSON_STREAMED_MAPS:
+            for key in sorted(gene.get(name, {})):
+                fd.write(encoder.encode({name: {key: gene[name][key]}}))
+                fd.write("\n")
+                if on_entry:
+                    on_entry(name, key, gene[name][key])
+        return
+
+    if json_format == 'pretty':
+        encoder = json.JSONEncoder(sort_keys=True, indent=4, default=default)
+        (item_separator, key_separator) = (',', ': ')
+    else:
+        encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=default)
+        (item_separator, key_separator) = (',', ':')
+
+    def newline(level):
+        return "\n" + " " * (4 * level) if json_format == 'pretty' else ""
+
+    def write_value(value, level):
+        # Encoded JSON contains newlines only between its tokens
+        text = encoder.encode(value)
+        fd.write(text.replace("\n", newline(level)) if json_format == 'pretty' else text)
+
+    fd.write("{")
+    for (i, name) in enumerate(sorted(gene)):
+        if i > 0:
+            fd.write(item_separator)
+        fd.write(newline(1) + encoder.encode(name) + key_separator)
+        if name not in _JSON_STREAMED_MAPS or not gene[name]:
+            write_value(gene[name], 1)
+            continue
+        fd.write("{")
+        for (j, key) in enumerate(sorted(gene[name])):
+            if j > 0:
+                fd.write(item_separator)
+            fd.write(newline(2) + encoder.encode(str(key)) + key_separator)
+            write_value(gene[name][key], 2)
+            if on_entry:
+                on_entry(name, key, gene[name][key])
+        fd.write(newline(1) + "}")
+    fd.write(newline(0) + "}")
+
+
+def read_json(filename):
+    """Read a full output file written in any of the JSON_FORMATS, possibly compressed."""
+    with open_input(filename) as f:
+        if f.readline().strip() == '{':
+            f.seek(0)
+            return json.load(f)
+        f.seek(0)
+        gene = {}
+        for line in f:
+            if not line.strip():
+                continue
+            for (name, value) in json.loads(line).items():
+                if name in _JSON_STREAMED_MAPS:
+                    gene.setdefault(name, {}).update(value)
+                else:
+                    gene[name] = value
+        return gene
+
+
+# Compressed output files.
+# The data written to a compressed file are compressed by a thread of the
+# file, so independent files are compressed in parallel (zlib, bz2 and lzma
+# release the GIL) and concurrently with the production of their content.
+
+# Module, suffix and default level of each codec
+COMPRESSION_CODECS = {
+    'gzip': (gzip, '.gz', 9),
+    'bz2': (bz2, '.bz2', 9),
+    'xz': (lzma, '.xz', 6),
+}
+
+
+def compression_of(options):
+    """Return the (codec, level) of the outputs of the run, None if they are not compressed."""
+    if not options.compress:
+        return None
+    level = options.compression_level
+    if level is None:
+        level = COMPRESSION_CODECS[options.compression_codec][2]
+    if not 1 <= level <= 9:
+        raise PIntronError("Invalid compression level " + str(level))
+    return (options.compression_codec, level)
+
+
+def compressed_name(filename, compression):
+    """Return the name of filename once compressed."""
+    return filename + COMPRESSION_CODECS[compression[0]][1] if compression else filename
+
+
+class CompressedWriter(io.RawIOBase):
+    """A binary file whose content is compressed by a background thread."""
+
+    QUEUE_LENGTH = 8
+
+    def __init__(self, filename, compression, mode='wb'):
+        (codec, level) = compression
+        module = COMPRESSION_CODECS[codec][0]
+        if module is lzma:
+            self.fd = lzma.open(filename, mode, preset=level)
+        else:
+            self.fd = module.open(filename, mode, compresslevel=level)
+        self.chunks = queue.Queue(self.QUEUE_LENGTH)
+        self.error = None
+        self.thread = threading.Thread(target=self._compress, daemon=True)
+        self.thread.start()
+
+    def _compress(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if self.error is None:
+                try:
+                    self.fd.write(chunk)
+                except Exception as e:
+                    # Keep consuming the queue, the error is raised by close()
+                    self.error = e
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.chunks.put(bytes(data))
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.chunks.put(None)
+        self.thread.join()
+        self.fd.close()
+        if self.error is not None:
+            raise self.error
+
+
+def open_output(filename, compression=None, mode='w', buffering=1024 * 1024):
+    """Open an output file for writing, compressed if compression is not None.
+
+    The mode is 'w' or 'a', optionally followed by 'b'. Text files are
+    written in UTF-8.
+    """
+    binary = mode.endswith('b')
+    if not compression:
+        if binary:
+            return open(filename, mode, buffering=buffering)
+        return open(filename, mode, encoding='utf-8', buffering=buffering)
+    stream = io.BufferedWriter(CompressedWriter(filename, compression, mode[0] + 'b'), buffer_size=buffering)
+    return stream if binary else io.TextIOWrapper(stream, encoding='utf-8')
+
+
+def open_input(filename):
+    """Open a text file for reading, decompressing it if its suffix is the one of a codec."""
+    module = next((codec[0] for codec in COMPRESSION_CODECS.values() if filename.endswith(codec[1])), None)
+    if module:
+        return module.open(filename, 'rt', encoding='utf-8')
+    return open(filename, 'r', encoding='utf-8')
+
+
+class CompressedLog:
+    """A log file, compressed if compression is not None, that can be the stderr of a subprocess.
+
+    The processes write to a pipe, which is copied to the file by a thread.
+    Use it as a context manager; its stream attribute is the file object to
+    pass as stderr.
+    """
+
+    def __init__(self, filename, compression=None):
+        self.filename = filename
+        self.compression = compression
+        self.thread = None
+
+    def __enter__(self):
+        if not self.compression:
+            self.stream = open(self.filename, 'ab')
+            return self
+        (read_fd, write_fd) = os.pipe()
+        self.stream = os.fdopen(write_fd, 'wb')
+        self.source = os.fdopen(read_fd, 'rb')
+        self.destination = open_output(self.filename, self.compression, mode='ab')
+        self.thread = threading.Thread(target=self._pump, daemon=True)
+        self.thread.start()
+        return self
+
+    def _pump(self):
+        while True:
+            data = self.source.read1(65536)
+            if not data:
+                break
+            self.destination.write(data)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream.close()
+        if self.thread:
+            self.thread.join()
+            self.source.close()
+            self.destination.close()
+        return False
+
+
+class CompressedFileHandler(logging.StreamHandler):
+    """A logging handler writing to a compressed file."""
+
+    def __init__(self, filename, compression, mode='w'):
+        super().__init__(open_output(filename, compression, mode=mode, buffering=65536))
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream:
+                try:
+                    self.flush()
+                finally:
+                    self.stream.close()
+                    self.stream = None
+        finally:
+            self.release()
+        super().close()
+
+
+# Export of the gene model.
+# The annotation formats are produced by writers that receive the isoforms
+# one at a time, so that all the requested files (and the JSON file) are
+# written in a single traversal of the model.
+
+# Features of an exon of an isoform, in the order they are written, with the
+# keys of their coordinates and frame.
+_EXON_FEATURES = (
+    ("exon", 'absolute_start', 'absolute_end', None),
+    ("5UTR", 'absolute_5UTR_start', 'absolute_5UTR_end', None),
+    ("start_codon", 'start_codon_absolute_start', 'start_codon_absolute_end', 'start_codon_frame'),
+    ("CDS", 'CDS_absolute_start', 'CDS_absolute_end', 'CDS_frame'),
+    ("stop_codon", 'stop_codon_absolute_start', 'stop_codon_absolute_end', 'stop_codon_frame'),
+    ("3UTR", 'absolute_3UTR_start', 'absolute_3UTR_end', None),
+)
+
+_EXPORT_BUFFER_SIZE = 1024 * 1024
+
+
+def isoform_features(isoform):
+    """Yield (feature, start, end, frame) for the features of the exons of an isoform.
+
+    start <= end, and frame is None for the features without a frame.
+    """
+    for exon in isoform['exons']:
+        for (feature, start_key, end_key, frame_key) in _EXON_FEATURES:
+            if start_key in exon:
+                (start, end) = (exon[start_key], exon[end_key])
+                if end < start:
+                    start, end = end, start
+                yield (feature, start, end, exon[frame_key] if frame_key else None)
+
+
+class GTFWriter:
+    """Write the isoforms (all, or only the CDS-annotated ones) as GTF."""
+
+    def __init__(self, fd, genome, gene_name, all_isoforms=True):
+        self.fd = fd
+        self.fields = (genome['sequence_id'], genome['strand'])
+        self.gene_name = gene_name
+        self.all_isoforms = all_isoforms
+
+    def isoform(self, isoform_id, isoform):
+        if not (self.all_isoforms or isoform['annotated_CDS?']):
+            return
+        (seqname, strand) = self.fields
+        attributes = "gene_id \"{0}\"; transcript_id \"{0}.{1}\";\n".format(self.gene_name, isoform_id)
+        self.fd.writelines("\t".join([seqname, "PIntron", feature, str(start), str(end), ".", strand,
+                                      "." if frame is None else str(frame), attributes])
+                           for (feature, start, end, frame) in isoform_features(isoform))
+
+    def close(self):
+        pass
+
+
+class GFF3Writer:
+    """Write the gene, its isoforms (as mRNA) and their features as GFF3."""
+
+    FEATURES = {"5UTR": "five_prime_UTR", "3UTR": "three_prime_UTR"}
+
+    def __init__(self, fd, genome, gene_name, extent):
+        self.fd = fd
+        self.fields = (genome['sequence_id'], genome['strand'])
+        self.gene_name = gene_name
+        (seqname, strand) = self.fields
+        fd.write("##gff-version 3\n")
+        if extent:
+            fd.write("\t".join([seqname, "PIntron", "gene", str(extent[0]), str(extent[1]), ".", strand, ".",
+                                "ID={0};Name={0}\n".format(gene_name)]))
+
+    def isoform(self, isoform_id, isoform):
+        (seqname, strand) = self.fields
+        transcript = "{}.{}".format(self.gene_name, isoform_id)
+        rows = []
+        (first, last) = (None, None)
+        for (feature, start, end, frame) in isoform_features(isoform):
+            if feature == "exon":
+                first = start if first is None else min(first, start)
+                last = end if last is None else max(last, end)
+            attributes = "Parent=" + transcript
+            if feature == "CDS":
+                attributes = "ID={0}.cds;".format(transcript) + attributes
+            rows.append("\t".join([seqname, "PIntron", self.FEATURES.get(feature, feature), str(start), str(end),
+                                   ".", strand, str(frame) if feature == "CDS" else ".", attributes + "\n"]))
+        if first is None:
+            return
+        self.fd.write("\t".join([seqname, "PIntron", "mRNA", str(first), str(last), ".", strand, ".",
+                                 "ID={0};Parent={1}\n".format(transcript, self.gene_name)]))
+        self.fd.writelines(rows)
+
+    def close(self):
+        pass
+
+
+class BEDWriter:
+    """Write each isoform as a BED12 line, whose thick part is its CDS (codons included)."""
+
+    def __init__(self, fd, genome, gene_name):
+        self.fd = fd
+        self.fields = (genome['sequence_id'], genome['strand'])
+        self.gene_name = gene_name
+
+    def isoform(self, isoform_id, isoform):
+        (seqname, strand) = self.fields
+        blocks = []
+        coding = []
+        for (feature, start, end, frame) in isoform_features(isoform):
+            if feature == "exon":
+                blocks.append((start - 1, end))
+            elif feature in ("start_codon", "CDS", "stop_codon"):
+                coding.extend([start - 1, end])
+        if not blocks:
+            return
+        blocks.sort()
+        (chrom_start, chrom_end) = (blocks[0][0], max(end for (start, end) in blocks))
+        (thick_start, thick_end) = (min(coding), max(coding)) if coding else (chrom_start, chrom_start)
+        self.fd.write("\t".join([seqname, str(chrom_start), str(chrom_end),
+                                 "{}.{}".format(self.gene_name, isoform_id), "0", strand,
+                                 str(thick_start), str(thick_end), "0", str(len(blocks)),
+                                 ",".join(str(end - start) for (start, end) in blocks) + ",",
+                                 ",".join(str(start - chrom_start) for (start, end) in blocks) + ","]) + "\n")
+
+    def close(self):
+        pass
+
+
+# Columnar binary bundle of a locus.
+#
+# Layout (all integers are little-endian):
+#   bytes 0-7      magic number b"PIBUNDLE"
+#   bytes 8-11     format version (unsigned 32-bit integer)
+#   bytes 12-15    length H of the directory (unsigned 32-bit integer)
+#   bytes 16-16+H  directory, a UTF-8 JSON object:
+#                    {"locus": {gene, sequence_id, strand, genome_length},
+#                     "categories": {column: [values]},
+#                     "tables": {table: {"rows": n,
+#                                        "columns": [{"name", "type", "offset", "length"}]}}}
+#   then the columns, each starting at an offset multiple of 8 from the
+#   beginning of the file, stored as arrays whose "type" is a typecode of
+#   the array module ('b': int8, 'i': int32, 'd': float64).
+# Missing values are -1. Columns listed in "categories" store the index of
+# their value in the list. Rows of the exons and isoform_introns tables
+# refer to the isoforms by their index.
+
+BUNDLE_MAGIC = b"PIBUNDLE"
+BUNDLE_VERSION = 1
+_BUNDLE_PREFIX = struct.Struct("<8sII")
+
+# Columns of each table: name, typecode, and function computing the value
+# from the isoform (and the exon) or the intron
+_BUNDLE_TABLES = {
+    'isoforms': [
+        ('index', 'i', lambda index, isoform: int(index)),
+        ('number_of_exons', 'i', lambda index, isoform: isoform['number_of_exons']),
+        ('length', 'i', lambda index, isoform: isoform['length']),
+        ('annotated_CDS', 'b', lambda index, isoform: isoform['annotated_CDS?']),
+        ('CDS_start', 'i', lambda index, isoform: isoform.get('CDS_start', -1)),
+        ('CDS_end', 'i', lambda index, isoform: isoform.get('CDS_end', -1)),
+        ('protein_length', 'i', lambda index, isoform: isoform.get('protein_length', -1)),
+        ('reference', 'b', lambda index, isoform: isoform.get('reference?', False)),
+        ('from_RefSeq', 'b', lambda index, isoform: isoform.get('from_RefSeq?', False)),
+        ('polyA', 'b', lambda index, isoform: isoform['polyA?']),
+        ('PAS', 'b', lambda index, isoform: isoform['PAS?']),
+        ('NMD_flag', 'i', lambda index, isoform: isoform.get('NMD_flag', -1)),
+    ],
+    'exons': [
+        ('isoform', 'i', lambda index, exon: int(index)),
+        ('absolute_start', 'i', lambda index, exon: exon['absolute_start']),
+        ('absolute_end', 'i', lambda index, exon: exon['absolute_end']),
+        ('relative_start', 'i', lambda index, exon: exon['relative_start']),
+        ('relative_end', 'i', lambda index, exon: exon['relative_end']),
+        ('UTR5_length', 'i', lambda index, exon: exon.get('5UTR_length', -1)),
+        ('UTR3_length', 'i', lambda index, exon: exon.get('3UTR_length', -1)),
+        ('CDS_absolute_start', 'i', lambda index, exon: exon.get('CDS_absolute_start', -1)),
+        ('CDS_absolute_end', 'i', lambda index, exon: exon.get('CDS_absolute_end', -1)),
+        ('CDS_frame', 'b', lambda index, exon: exon.get('CDS_frame', -1)),
+    ],
+    'isoform_introns': [
+        ('isoform', 'i', lambda index, intron: int(index)),
+        ('intron', 'i', lambda index, intron: int(intron)),
+    ],
+    'introns': [
+        ('index', 'i', lambda index, intron: int(index)),
+        ('relative_start', 'i', lambda index, intron: intron['relative_start']),
+        ('relative_end', 'i', lambda index, intron: intron['relative_end']),
+        ('absolute_start', 'i', lambda index, intron: intron['absolute_start']),
+        ('absolute_end', 'i', lambda index, intron: intron['absolute_end']),
+        ('length', 'i', lambda index, intron: intron['length']),
+        ('number_of_supporting_transcripts', 'i', lambda index, intron: intron['number_of_supporting_transcripts']),
+        ('donor_score', 'd', lambda index, intron: intron['donor_score']),
+        ('acceptor_score', 'd', lambda index, intron: intron['acceptor_score']),
+        ('BPS_score', 'd', lambda index, intron: intron['BPS_score']),
+        ('BPS_position', 'i', lambda index, intron: intron.get('BPS_position', -1)),
+        ('donor_alignment_error', 'd', lambda index, intron: intron['donor_alignment_error']),
+        ('acceptor_alignment_error', 'd', lambda index, intron: intron['acceptor_alignment_error']),
+        ('type', 'b', None),
+        ('pattern', 'b', None),
+    ],
+}
+
+
+class BundleWriter:
+    """Write the isoforms, their exons and the introns as a columnar binary bundle."""
+
+    def __init__(self, filename, genome, gene_name):
+        self.filename = filename
+        self.locus = {
+            'gene': gene_name,
+            'sequence_id': genome['sequence_id'],
+            'strand': genome['strand'],
+            'genome_length': genome['length'],
+        }
+        self.columns = {table: [array.array(typecode) for (name, typecode, value) in columns]
+                        for (table, columns) in _BUNDLE_TABLES.items()}
+        self.categories = {'type': [], 'pattern': []}
+
+    def _append(self, table, index, item):
+        for (column, (name, typecode, value)) in zip(self.columns[table], _BUNDLE_TABLES[table]):
+            if value is None:
+                vocabulary = self.categories[name]
+                if item[name] not in vocabulary:
+                    vocabulary.append(item[name])
+                column.append(vocabulary.index(item[name]))
+            else:
+                column.append(value(index, item))
+
+    def isoform(self, isoform_id, isoform):
+        self._append('isoforms', isoform_id, isoform)
+        for exon in isoform['exons']:
+            self._append('exons', isoform_id, exon)
+        for intron_id in isoform.get('introns', []):
+            self._append('isoform_introns', isoform_id, intron_id)
+
+    def intron(self, intron_id, intron):
+        self._append('introns', intron_id, intron.to_json() if hasattr(intron, 'to_json') else intron)
+
+    def close(self):
+        directory = {'locus': self.locus, 'categories': self.categories, 'tables': {}}
+        descriptors = []
+        offset = 0
+        for (table, columns) in self.columns.items():
+            directory['tables'][table] = {'rows': len(columns[0]), 'columns': []}
+            for (column, (name, typecode, value)) in zip(columns, _BUNDLE_TABLES[table]):
+                length = len(column) * column.itemsize
+                descriptor = {'name': name, 'type': typecode, 'offset': offset, 'length': length}
+                directory['tables'][table]['columns'].append(descriptor)
+                descriptors.append((descriptor, offset))
+                offset += (length + 7) // 8 * 8
+        # The directory contains the offsets of the columns, which follow the
+        # directory: enlarge the room reserved for it until it fits
+        data_start = _BUNDLE_PREFIX.size
+        while True:
+            for (descriptor, offset) in descriptors:
+                descriptor['offset'] = data_start + offset
+            text = json.dumps(directory, sort_keys=True).encode('utf-8')
+            needed = (_BUNDLE_PREFIX.size + len(text) + 7) // 8 * 8
+            if needed <= data_start:
+                break
+            data_start = needed
+        with open(self.filename, 'wb') as fd:
+            fd.write(_BUNDLE_PREFIX.pack(BUNDLE_MAGIC, BUNDLE_VERSION, data_start - _BUNDLE_PREFIX.size))
+            fd.write(text.ljust(data_start - _BUNDLE_PREFIX.size))
+            for (table, columns) in self.columns.items():
+                for column in columns:
+                    if sys.byteorder == 'big':
+                        column.byteswap()
+                    column.tofile(fd)
+                    fd.write(bytes(-(len(column) * column.itemsize) % 8))
+
+
+class Bundle:
+    """A columnar binary bundle, memory-mapped.
+
+    locus, categories and tables are the content of the directory;
+    column(table, name) returns the values of a column without copying them
+    (on little-endian machines): the returned memoryviews must be released
+    before closing the bundle.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fd:
+            self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, length) = _BUNDLE_PREFIX.unpack_from(self.map)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            self.map.close()
+            raise PIntronIOError(filename, "Not a PIntron bundle (version {})".format(BUNDLE_VERSION))
+        directory = json.loads(self.map[_BUNDLE_PREFIX.size:_BUNDLE_PREFIX.size + length].decode('utf-8'))
+        self.locus = directory['locus']
+        self.categories = directory['categories']
+        self.tables = directory['tables']
+
+    def raw(self, table, name):
+        """Return the descriptor and the bytes of a column, as a memoryview of the map."""
+        descriptor = next(c for c in self.tables[table]['columns'] if c['name'] == name)
+        return (descriptor,
+                memoryview(self.map)[descriptor['offset']:descriptor['offset'] + descriptor['length']])
+
+    def column(self, table, name):
+        (descriptor, view) = self.raw(table, name)
+        if sys.byteorder == 'big':
+            values = array.array(descriptor['type'])
+            values.frombytes(view)
+            view.release()
+            values.byteswap()
+            return values
+        return view.cast(descriptor['type'])
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def load_bundles(filenames, tables=None, columns=None):
+    """Concatenate the tables of the bundles of many loci.
+
+    Return a dictionary table -> column -> array.array, restricted to the
+    given tables and columns (if not None). Each table has an additional
+    'locus' column, the position in filenames of the bundle of the row.
+    Category columns are returned as indices into the union of the
+    vocabularies of the bundles, listed in the 'categories' entry.
+    """
+    result = {}
+    categories = {}
+    for (locus, filename) in enumerate(filenames):
+        with Bundle(filename) as bundle:
+            for (table, content) in bundle.tables.items():
+                if tables is not None and table not in tables:
+                    continue
+                output = result.setdefault(table, {'locus': array.array('i')})
+                output['locus'].extend([locus] * content['rows'])
+                for descriptor in content['columns']:
+                    name = descriptor['name']
+                    if columns is not None and name not in columns:
+                        continue
+                    (descriptor, view) = bundle.raw(table, name)
+                    with view:
+                        values = array.array(descriptor['type'])
+                        values.frombytes(view)
+                    if sys.byteorder == 'big':
+                        values.byteswap()
+                    if name in bundle.categories:
+                        vocabulary = categories.setdefault(name, [])
+                        for value in bundle.categories[name]:
+                            if value not in vocabulary:
+                                vocabulary.append(value)
+                        recode = [vocabulary.index(value) for value in bundle.categories[name]]
+                        values = array.array(descriptor['type'], (recode[value] for value in values))
+                    output.setdefault(name, array.array(descriptor['type'])).extend(values)
+    result['categories'] = categories
+    return result
+
+
+def export_gene(gene, gene_name, json_file=None, json_format='pretty', gtf_file=None, cds_gtf_file=None,
+                gff3_file=None, bed_file=None, bundle_file=None, gtf_all_isoforms=True, compression=None):
+    """Write the gene model to any combination of the supported formats.
+
+    gtf_file contains all the isoforms (only the CDS-annotated ones if not
+    gtf_all_isoforms), cds_gtf_file only the CDS-annotated ones.
+    The isoforms are visited once, in the order of their index.
+    If compression is given, all the files but the bundle are written compressed.
+    """
+    files = []
+    writers = []
+    try:
+        def open_export(filename):
+            fd = open_output(filename, compression, buffering=_EXPORT_BUFFER_SIZE)
+            files.append(fd)
+            return fd
+
+        if gtf_file:
+            writers.append(GTFWriter(open_export(gtf_file), gene['genome'], gene_name,
+                                     all_isoforms=gtf_all_isoforms))
+        if cds_gtf_file:
+            writers.append(GTFWriter(open_export(cds_gtf_file), gene['genome'], gene_name, all_isoforms=False))
+        if gff3_file:
+            extent = [coordinate
+                      for isoform in gene['isoforms'].values()
+                      for exon in isoform['exons']
+                      for coordinate in (exon['absolute_start'], exon['absolute_end'])]
+            writers.append(GFF3Writer(open_export(gff3_file), gene['genome'], gene_name,
+                                      (min(extent), max(extent)) if extent else None))
+        if bed_file:
+            writers.append(BEDWriter(open_export(bed_file), gene['genome'], gene_name))
+        if bundle_file:
+            writers.append(BundleWriter(bundle_file, gene['genome'], gene_name))
+
+        def on_entry(name, key, value):
+            if name == 'isoforms':
+                for writer in writers:
+                    writer.isoform(key, value)
+            else:
+                for writer in writers:
+                    if hasattr(writer, 'intron'):
+                        writer.intron(key, value)
+
+        if json_file:
+            write_json(gene, open_export(json_file), json_format, on_entry if writers else None)
+        else:
+            for name in _JSON_STREAMED_MAPS:
+                for key in sorted(gene[name], key=int):
+                    on_entry(name, key, gene[name][key])
+        for writer in writers:
+            writer.close()
+    finally:
+        for fd in files:
+            fd.close()
+
+
 # Transform a JSON file into a GTF
 def json2gtf(infile, outfile, gene_name, all_isoforms):
-    def write_gtf_line(file, seqname, feature, start, end, score, strand, frame, gene, transcript):
-        if end < start:
-            start, end = end, start
-        f.write("\t".join([seqname, "PIntron", feature, str(start), str(end), score, strand, str(frame),
-                           "gene_id \"{0}\"; transcript_id \"{0}.{1}\";\n".format(gene, str(transcript))]))
-
     logging.debug(str(time.localtime()))
     logging.debug(json2gtf)
-    with open(infile, 'r', encoding='utf-8') as f:
-        entry = json.load(f)
-
-    with open(outfile, 'w', encoding='utf-8') as f:
-        for isoform_id, isoform in entry["isoforms"].items():
-            for exon in isoform["exons"]:
-
-                logging.debug("Exon data (json): { %s } ", exon)
-#                import pdb; pdb.set_trace()
-                if all_isoforms or isoform["annotated_CDS?"]:
-                    write_gtf_line(f, entry['genome']['sequence_id'], "exon",
-                                   exon['absolute_start'], exon['absolute_end'],
-                                   ".", entry['genome']['strand'], ".", gene_name, isoform_id)
-                    if 'absolute_5UTR_start' in exon:
-                        write_gtf_line(f, entry['genome']['sequence_id'], "5UTR",
-                                       exon['absolute_5UTR_start'], exon['absolute_5UTR_end'],
-                                       ".", entry['genome']['strand'], ".", gene_name, isoform_id)
-                    if 'start_codon_absolute_start' in exon:
-                        write_gtf_line(f, entry['genome']['sequence_id'], "start_codon",
-                                       exon['start_codon_absolute_start'], exon['start_codon_absolute_end'],
-                                       ".", entry['genome']['strand'], exon['start_codon_frame'], gene_name, isoform_id)
-                    if 'CDS_absolute_start' in exon:
-                        write_gtf_line(f, entry['genome']['sequence_id'], "CDS",
-                                       exon['CDS_absolute_start'], exon['CDS_absolute_end'],
-                                       ".", entry['genome']['strand'], exon['CDS_frame'], gene_name, isoform_id)
-                    if 'stop_codon_absolute_start' in exon:
-                        write_gtf_line(f, entry['genome']['sequence_id'], "stop_codon",
-                                       exon['stop_codon_absolute_start'], exon['stop_codon_absolute_end'],
-                                       ".", entry['genome']['strand'], exon['stop_codon_frame'], gene_name, isoform_id)
-                    if 'absolute_3UTR_start' in exon:
-                        write_gtf_line(f, entry['genome']['sequence_id'], "3UTR",
-                                       exon['absolute_3UTR_start'], exon['absolute_3UTR_end'],
-                                       ".", entry['genome']['strand'], ".", gene_name, isoform_id)
-
-
-def compute_json(ccds_file, variant_file, output_file, pas_tolerance, genomic_seq):
-    def dump_and_exit(exon, isoform, isoform_id):
-        logging.debug("Exon =>")
-        logging.debug(exon)
-        logging.debug("Isoform (ID " + str(isoform_id) + ")=>")
-        logging.debug(isoform)
-        raise PIntronError
+    entry = read_json(infile)
+    export_gene(entry, gene_name, gtf_file=outfile, gtf_all_isoforms=all_isoforms)
 
-    # Find the sequence ID
-    # It is stored in the first line of the genomic sequence
-    with open(genomic_seq, 'r', encoding='utf-8') as f:
-        line = f.readline().rstrip("\r\n")
-        m = re.match('>(?P<type>chr)?(?P<chrnum>X|Y|x|y|\d+):\d+:\d+:(?P<strand>\+|-|\+1|-1|1)', line)
-        sequence_id = "chr" + m.group('chrnum')
-        strand = m.group('strand')
-        if strand == '-1' or strand == '-':
-            strand = '-'
+
+# Genome-wide GTF.
+# The GTFs of many loci are merged into a single GTF sorted by sequence name
+# and start/end coordinates, compressed in the BGZF format and indexed in
+# the tabix (.tbi) format, so that the records of a region are read by
+# decompressing only the blocks that may contain them. Both files can also
+# be read by the bgzip/tabix tools of htslib.
+# Each locus GTF is sorted in memory and written as a temporary run, then
+# the runs are merged (at most MERGE_FAN_IN at a time) with a k-way merge,
+# so the memory is bounded by the largest locus.
+
+MERGE_FAN_IN = 128
+
+# Maximum size of the uncompressed data of a BGZF block
+_BGZF_BLOCK_SIZE = 0xff00
+_BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+_BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# Size of the windows of the linear index
+_TBI_SHIFT = 14
+
+
+def gtf_key(line):
+    fields = line.split('\t', 5)
+    return (fields[0], int(fields[3]), int(fields[4]))
+
+
+def reg2bin(beg, end):
+    """Return the bin of the 0-based, half-open interval [beg, end)."""
+    end -= 1
+    for (shift, offset) in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+def reg2bins(beg, end):
+    """Return the bins that may contain intervals overlapping [beg, end)."""
+    end -= 1
+    bins = [0]
+    for (shift, offset) in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+class BGZFWriter:
+    """Write a BGZF file, whose positions are virtual offsets (block address << 16 | offset in the block)."""
+
+    def __init__(self, filename, level=6):
+        self.fd = open(filename, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.address = 0
+
+    def tell(self):
+        return self.address << 16 | len(self.buffer)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= _BGZF_BLOCK_SIZE:
+            self._flush_block(self.buffer[:_BGZF_BLOCK_SIZE])
+            del self.buffer[:_BGZF_BLOCK_SIZE]
+
+    def _flush_block(self, data):
+        for level in (self.level, 0):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            payload = compressor.compress(data) + compressor.flush()
+            # Incompressible data are stored, so that the block is at most 64KiB
+            if len(payload) + _BGZF_HEADER.size + 8 <= 65536:
+                break
+        block_size = len(payload) + _BGZF_HEADER.size + 8
+        self.fd.write(_BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1))
+        self.fd.write(payload)
+        self.fd.write(struct.pack("<II", zlib.crc32(data), len(data)))
+        self.address += block_size
+
+    def close(self):
+        if self.buffer:
+            self._flush_block(self.buffer)
+            self.buffer = bytearray()
+        self.fd.write(_BGZF_EOF)
+        self.fd.close()
+
+
+class BGZFReader:
+    """Read the lines of a BGZF file from a virtual offset."""
+
+    def __init__(self, filename):
+        self.fd = open(filename, 'rb')
+        self.address = 0
+        self.next_address = 0
+        self._read_block(0)
+
+    def _read_block(self, address):
+        self.fd.seek(address)
+        header = self.fd.read(_BGZF_HEADER.size)
+        if len(header) < _BGZF_HEADER.size:
+            self.block = b''
         else:
-            strand = '+'
+            fields = _BGZF_HEADER.unpack(header)
+            if fields[:4] != (31, 139, 8, 4) or fields[8:10] != (66, 67):
+                raise PIntronIOError(self.fd.name, "Not a BGZF file")
+            payload = self.fd.read(fields[11] + 1 - _BGZF_HEADER.size - 8)
+            self.block = zlib.decompress(payload, -15)
+            self.next_address = address + fields[11] + 1
+        self.address = address
+        self.position = 0
 
-    gene = {
-        'file_format_version': 5,  # Hardcoding version number
-        'program_version': options.version,  # Program version
-        'isoforms': {},
-        'introns': {},
-        'factorizations': {},
-        'number_of_processed_transcripts': 0,
-        'genome': {
-            'sequence_id': sequence_id,
-            'strand': strand,
-        },
-    }
+    def seek(self, virtual_offset):
+        self._read_block(virtual_offset >> 16)
+        self.position = virtual_offset & 0xffff
 
-    for file in [ccds_file, variant_file]:
-        if not os.access(file, os.R_OK):
-            # throw exception and die
-            logging.exception("*** Fatal error: Could not read " + file + "\n")
+    def tell(self):
+        if self.position == len(self.block) and self.block:
+            return self.next_address << 16
+        return self.address << 16 | self.position
 
-    with open('out-after-intron-agree.txt', mode='r', encoding='utf-8') as fd:
-        current = ''
-        for line in fd:
+    def readline(self):
+        line = b''
+        while True:
+            end = self.block.find(b'\n', self.position)
+            if end >= 0:
+                line += self.block[self.position:end + 1]
+                self.position = end + 1
+                return line
+            line += self.block[self.position:]
+            self.position = len(self.block)
+            if not self.block:
+                return line
+            self._read_block(self.next_address)
+
+    def close(self):
+        self.fd.close()
+
+
+class TabixIndexer:
+    """Build the tabix index of a sorted GTF while it is written to a BGZFWriter."""
+
+    def __init__(self):
+        self.names = []
+        self.bins = []
+        self.linear = []
+
+    def add(self, name, beg, end, start_offset, end_offset):
+        """Add the record of name covering [beg, end) stored between the virtual offsets."""
+        if not self.names or self.names[-1] != name:
+            if name in self.names:
+                raise PIntronError("GTF not sorted by sequence name: " + name)
+            self.names.append(name)
+            self.bins.append({})
+            self.linear.append([])
+        chunks = self.bins[-1].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+        linear = self.linear[-1]
+        last_window = (end - 1) >> _TBI_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> _TBI_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+    def write(self, filename):
+        index = BGZFWriter(filename)
+        names = b''.join(name.encode('utf-8') + b'\0' for name in self.names)
+        # Generic format, sequence name/start/end in columns 1/4/5, comments starting with '#'
+        index.write(struct.pack("<4s8i", b"TBI\1", len(self.names), 0, 1, 4, 5, ord('#'), 0, len(names)))
+        index.write(names)
+        for (bins, linear) in zip(self.bins, self.linear):
+            index.write(struct.pack("<i", len(bins)))
+            for (bin_number, chunks) in sorted(bins.items()):
+                index.write(struct.pack("<Ii", bin_number, len(chunks)))
+                for chunk in chunks:
+                    index.write(struct.pack("<QQ", *chunk))
+            previous = 0
+            for (window, offset) in enumerate(linear):
+                previous = linear[window] = previous if offset is None else offset
+            index.write(struct.pack("<i", len(linear)))
+            index.write(struct.pack("<{}Q".format(len(linear)), *linear))
+        index.close()
+
+
+def read_tabix_index(filename):
+    """Return the sequence names, and the bins and the linear index of each sequence."""
+    # A BGZF file is a sequence of gzip members
+    with open(filename, 'rb') as fd:
+        data = gzip.decompress(fd.read())
+    (magic, n_ref, file_format, col_seq, col_beg, col_end, meta, skip, l_nm) = \
+        struct.unpack_from("<4s8i", data)
+    if magic != b"TBI\1":
+        raise PIntronIOError(filename, "Not a tabix index")
+    position = struct.calcsize("<4s8i")
+    names = data[position:position + l_nm].decode('utf-8').split('\0')[:n_ref]
+    position += l_nm
+    index = []
+    for reference in range(n_ref):
+        (n_bin,) = struct.unpack_from("<i", data, position)
+        position += 4
+        bins = {}
+        for i in range(n_bin):
+            (bin_number, n_chunk) = struct.unpack_from("<Ii", data, position)
+            position += 8
+            chunks = struct.unpack_from("<{}Q".format(2 * n_chunk), data, position)
+            position += 16 * n_chunk
+            bins[bin_number] = list(zip(chunks[::2], chunks[1::2]))
+        (n_intv,) = struct.unpack_from("<i", data, position)
+        position += 4
+        linear = struct.unpack_from("<{}Q".format(n_intv), data, position)
+        position += 8 * n_intv
+        index.append((bins, linear))
+    return (names, index)
+
+
+def _sorted_run(filename, directory):
+    """Sort the records of a GTF and write them to a temporary run."""
+    with open_input(filename) as f:
+        lines = [line if line.endswith('\n') else line + '\n'
+                 for line in f if line.strip() and not line.startswith('#')]
+    try:
+        lines.sort(key=gtf_key)
+    except (IndexError, ValueError) as err:
+        raise PIntronIOError(filename, "Malformed GTF record") from err
+    (handle, run) = tempfile.mkstemp(suffix=".gtf", dir=directory)
+    with os.fdopen(handle, 'w', encoding='utf-8') as fd:
+        fd.writelines(lines)
+    return run
+
+
+def _merge_runs(runs):
+    files = [open(run, 'r', encoding='utf-8') for run in runs]
+    return (files, heapq.merge(*files, key=gtf_key))
+
+
+def merge_gtf(inputs, output, level=6, fan_in=MERGE_FAN_IN):
+    """Merge the GTFs of many loci into the sorted BGZF file output, indexed in output.tbi."""
+    logging.info("Merging %d GTF files into %s", len(inputs), output)
+    with tempfile.TemporaryDirectory(prefix="pintron-merge-",
+                                     dir=os.path.dirname(os.path.abspath(output))) as directory:
+        runs = [_sorted_run(filename, directory) for filename in inputs]
+        while len(runs) > fan_in:
+            merged = []
+            for group in range(0, len(runs), fan_in):
+                (files, records) = _merge_runs(runs[group:group + fan_in])
+                (handle, run) = tempfile.mkstemp(suffix=".gtf", dir=directory)
+                with os.fdopen(handle, 'w', encoding='utf-8') as fd:
+                    fd.writelines(records)
+                for f in files:
+                    f.close()
+                    os.remove(f.name)
+                merged.append(run)
+            runs = merged
+        (files, records) = _merge_runs(runs)
+        writer = BGZFWriter(output, level)
+        indexer = TabixIndexer()
+        for line in records:
+            (name, start, end) = gtf_key(line)
+            start_offset = writer.tell()
+            writer.write(line.encode('utf-8'))
+            indexer.add(name, start - 1, end, start_offset, writer.tell())
+        writer.close()
+        for f in files:
+            f.close()
+    indexer.write(output + ".tbi")
+
+
+def parse_region(region):
+    """Parse a region NAME[:START[-END]] (1-based, inclusive) into (name, beg, end) (0-based, half-open)."""
+    match = re.match(r'^(.+?)(?::([\d,]+)(?:-([\d,]+))?)?$', region)
+    if not match:
+        raise PIntronError("Invalid region " + region)
+    (name, start, end) = match.groups()
+    beg = int(start.replace(',', '')) - 1 if start else 0
+    end = int(end.replace(',', '')) if end else 1 << 29
+    return (name, max(beg, 0), end)
+
+
+def query_gtf(filename, region, index=None):
+    """Yield the records of the indexed GTF filename overlapping region."""
+    (names, references) = index or read_tabix_index(filename + ".tbi")
+    (name, beg, end) = parse_region(region)
+    if name not in names:
+        return
+    (bins, linear) = references[names.index(name)]
+    window = beg >> _TBI_SHIFT
+    min_offset = linear[window] if window < len(linear) else (linear[-1] if linear else 0)
+    chunks = sorted(chunk for bin_number in reg2bins(beg, end) for chunk in bins.get(bin_number, [])
+                    if chunk[1] > min_offset)
+    reader = BGZFReader(filename)
+    try:
+        position = None
+        for (chunk_start, chunk_end) in chunks:
+            if position is None or chunk_start > position:
+                reader.seek(chunk_start)
+                position = chunk_start
+            while position < chunk_end:
+                line = reader.readline().decode('utf-8')
+                position = reader.tell()
+                if not line:
+                    break
+                (record_name, start, stop) = gtf_key(line)
+                if record_name != name or start > end:
+                    return
+                if stop > beg:
+                    yield line
+    finally:
+        reader.close()
+
+
+# Streaming parsers of the intermediate files read by compute_json.
+# Each parser is a generator that reads its file one line at a time and
+# yields one record (with typed values) at a time. Malformed lines raise a
+# ValueError reporting the file and the line number.
+
+_FACTOR_HEADER_GB = re.compile(r'/gb=([A-Z_0-9]+)')
+_FACTOR_HEADER_CLONE_END = re.compile(r'/clone_end=([35])')
+_FACTOR_PAS = re.compile(r'#polyad\S*=1')
+_FACTOR_EXON = re.compile(r'(\d+) (\d+) (\d+) (\d+)( \S+)? \S+$')
+_VARIANT_CDS = re.compile(r'^(<?)(\d+)\.\.(\d+)(>?)$')
+_VARIANT_REFSEQ = re.compile(r'^(.*?)(\(?([NY])([NY])\)?)?$', flags=re.IGNORECASE)
+_VARIANT_PROTL = re.compile(r'^(>?)(\d+)$')
+_CCDS_EXON = re.compile(r'^(\d+:){5}(-?\d+:)(-?\d+)$')
+_CCDS_SEQUENCE = re.compile(r'^[acgtACGT]+$')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _parse_error(filename, line_number, line, msg):
+    return ValueError("Could not parse {0} at line {1} ({2}):\n{3}\n".format(filename, line_number, msg,
+                                                                             line.rstrip("\r\n")))
+
+
+class Factor:
+    """A factor of an EST aligned to the genomic sequence (an exon of a factorization)."""
+    __slots__ = ('est_start', 'est_end', 'relative_start', 'relative_end', 'est_sequence')
+
+    def __init__(self, est_start, est_end, relative_start, relative_end, est_sequence):
+        self.est_start = est_start
+        self.est_end = est_end
+        self.relative_start = relative_start
+        self.relative_end = relative_end
+        self.est_sequence = est_sequence
+
+
+class Factorization:
+    """The factorization of an EST.
+
+    pas_factor is the last factor of an EST with a PAS, None otherwise.
+    """
+    __slots__ = ('est', 'clone_end', 'polyA', 'PAS', 'factors', 'pas_factor')
+
+    def __init__(self, est, clone_end=None):
+        self.est = est
+        self.clone_end = clone_end
+        self.polyA = False
+        self.PAS = False
+        self.factors = []
+        self.pas_factor = None
+
+
+class SupportingAlignment:
+    """The alignment of the factors of an EST surrounding an intron."""
+    __slots__ = ('donor_factor_start', 'donor_factor_end', 'donor_factor_suffix',
+                 'acceptor_factor_start', 'acceptor_factor_end', 'acceptor_factor_prefix')
+
+    def __init__(self, intron, donor_factor, acceptor_factor):
+        self.donor_factor_start = donor_factor.est_start
+        self.donor_factor_end = donor_factor.est_end
+        self.donor_factor_suffix = donor_factor.est_sequence[-len(intron.donor_exon_suffix):]
+        self.acceptor_factor_start = acceptor_factor.est_start
+        self.acceptor_factor_end = acceptor_factor.est_end
+        self.acceptor_factor_prefix = acceptor_factor.est_sequence[:len(intron.acceptor_exon_prefix)]
+
+    def to_json(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class Intron:
+    """A predicted intron.
+
+    supporting_transcripts maps each EST supporting the intron to its
+    SupportingAlignment (None until it is known).
+    """
+    INT_FIELDS = ('relative_start', 'relative_end', 'absolute_start', 'absolute_end', 'length',
+                  'number_of_supporting_transcripts', 'BPS_position')
+    FLOAT_FIELDS = ('donor_alignment_error', 'acceptor_alignment_error', 'donor_score',
+                    'acceptor_score', 'BPS_score')
+    STR_FIELDS = ('type', 'pattern', 'repeat_sequence', 'donor_exon_suffix', 'prefix', 'suffix',
+                  'acceptor_exon_prefix')
+    __slots__ = INT_FIELDS + FLOAT_FIELDS + STR_FIELDS + ('supporting_transcripts',)
+
+    def to_json(self):
+        """Return the intron as stored in the JSON file (file format version 5)."""
+        intron = {field: getattr(self, field) for field in self.__slots__}
+        if self.BPS_position < 0:
+            del intron['BPS_position']
+        intron['supporting_transcripts'] = {est: alignment.to_json() if alignment is not None else {}
+                                            for (est, alignment) in self.supporting_transcripts.items()}
+        return intron
+
+
+def read_factorizations(filename):
+    """Parse the factorizations of the ESTs (out-after-intron-agree.txt).
+
+    Yield a Factorization for each EST. The genomic side of the alignments
+    is not kept.
+    """
+    factorization = None
+    with open(filename, mode='r', encoding='utf-8') as fd:
+        for line_number, line in enumerate(fd, 1):
             l = line.rstrip()
+            if not l:
+                continue
             if l[0] == '>':
-                gene['number_of_processed_transcripts'] = gene['number_of_processed_transcripts'] + 1
-                new = re.search('\/gb=([A-Z_0-9]+)', l).groups()
-                current = new[0]
-                gene['factorizations'][current] = {
-                    'polyA?': False,
-                    'PAS': False,
-                    'exons': [],
-                    'EST': current,
-                }
-                if re.search('\/clone_end=([35])', l):
-                    new = re.search('\/clone_end=([35])', l).groups()
-                    gene['factorizations'][current]['clone end'] = new[0]
-
-            elif re.match('#polya=1', l):
-                gene['factorizations'][current]['polyA?'] = True
-            elif re.match('#polyad(\S*)=1', l):
-                gene['factorizations'][current]['PAS'] = True
-            elif re.match('(\d+) (\d+) (\d+) (\d+)( \S+)? \S+$', l):
-                new = re.match('(\d+) (\d+) (\d+) (\d+) (\S+) (\S+)$', l).groups()
-                # pprint.pprint(l)
-                # pprint.pprint(new)
-                exon = {
-                    'EST start': int(new[0]),
-                    'EST end': int(new[1]),
-                    'relative_start': int(new[2]),
-                    'relative_end': int(new[3]),
-                    'EST sequence': new[4],
-                    'genome sequence': new[5],
-                }
-                gene['factorizations'][current]['exons'].append(exon)
-                if gene['factorizations'][current]['PAS']:
-                    gene['factorizations'][current]['exon'] = exon
+                if factorization is not None:
+                    yield factorization
+                m = _FACTOR_HEADER_GB.search(l)
+                if m is None:
+                    raise _parse_error(filename, line_number, line, "missing /gb= accession")
+                factorization = Factorization(m.group(1))
+                m = _FACTOR_HEADER_CLONE_END.search(l)
+                if m is not None:
+                    factorization.clone_end = m.group(1)
+                continue
+            if factorization is None:
+                raise _parse_error(filename, line_number, line, "factorization without a header")
+            if l.startswith('#polya=1'):
+                factorization.polyA = True
+            elif _FACTOR_PAS.match(l):
+                factorization.PAS = True
+            elif _FACTOR_EXON.match(l):
+                fields = l.split(' ')
+                if len(fields) != 6:
+                    raise _parse_error(filename, line_number, line, "missing sequence of the factor")
+                factor = Factor(int(fields[0]), int(fields[1]), int(fields[2]), int(fields[3]), fields[4])
+                factorization.factors.append(factor)
+                if factorization.PAS:
+                    factorization.pas_factor = factor
+        if factorization is not None:
+            yield factorization
 
-    with open(variant_file, mode='r', encoding='utf-8') as fd:
-        for line in fd:
-            row = re.split(' /', line.rstrip())
-            index = int(re.sub('^.*\#', '', row.pop(0)))
+
+def read_variants(filename):
+    """Parse the description of the isoforms (VariantGTF.txt).
+
+    Yield a pair (index, isoform) for each line, where isoform is the
+    dictionary of the attributes of the isoform.
+    """
+    with open(filename, mode='r', encoding='utf-8') as fd:
+        for line_number, line in enumerate(fd, 1):
+            row = line.rstrip().split(' /')
+            if not row[0]:
+                continue
+            try:
+                index = int(row.pop(0).rpartition('#')[2])
+            except ValueError:
+                raise _parse_error(filename, line_number, line, "wrong isoform index")
             isoform = {
                 'exons': [],
                 'polyA?': False,
@@ -376,37 +1596,39 @@ def compute_json(ccds_file, variant_file, output_file, pas_tolerance, genomic_se
                 'reference_frame?': False,
             }
             for t in row:
-                (k, v) = re.split('=', t, 2)
-                logging.debug("Reading VariantGTF: " + k + "=>" + v + "!")
+                (k, sep, v) = t.partition('=')
                 if k == "nex":
                     isoform['number_of_exons'] = int(v)
                 elif k == "L":
                     isoform["length"] = int(v)
                 elif k == "CDS":
                     if v != '..':
+                        m = _VARIANT_CDS.match(v)
+                        if m is None:
+                            raise _parse_error(filename, line_number, line, "wrong CDS " + v)
                         isoform["annotated_CDS?"] = True
-                        m = re.match('^(<?)(\d+)\.\.(\d+)(>?)$', v)
                         (a, isoform["CDS_start"], isoform["CDS_end"], b) = (m.group(1), int(m.group(2)),
                                                                             int(m.group(3)), m.group(4))
                         isoform['CDS_length'] = isoform["CDS_end"] - isoform["CDS_start"] + 1
                         isoform['start_codon?'] = False if a == '<' else True
-                        isoform['stop_codon?']   = False if b == '>' else True
+                        isoform['stop_codon?'] = False if b == '>' else True
                 elif k == "RefSeq":
-                    m = re.match('^(.*?)(\(?([NY])([NY])\)?)?$', v, flags=re.IGNORECASE)
+                    m = _VARIANT_REFSEQ.match(v)
                     if m:
                         (r, a, b) = (m.group(1), m.group(3), m.group(4))
                         isoform['reference_start_codon?'] = False if a == 'N' else True
-                        isoform['reference_stop_codon?']   = False if b == 'N' else True
-                        if r != None and r:
+                        isoform['reference_stop_codon?'] = False if b == 'N' else True
+                        if r:
                             isoform['RefSeqID'] = r
                 elif k == "ProtL":
                     if v != '..' and isoform["annotated_CDS?"]:
-                        m = re.match('^(>?)(\d+)$', v, flags=re.IGNORECASE)
+                        m = _VARIANT_PROTL.match(v)
+                        if m is None:
+                            raise _parse_error(filename, line_number, line, "wrong protein length " + v)
                         (a, isoform['protein_length']) = (m.group(1), int(m.group(2)))
                         isoform['protein_incomplete?'] = False if a != '>' else True
                 elif k == "Frame":
-                    m = re.match('^y', v, flags=re.IGNORECASE)
-                    if m != None and isoform["annotated_CDS?"]:
+                    if v[:1] in ('y', 'Y') and isoform["annotated_CDS?"]:
                         isoform['reference_frame?'] = True
                 elif k == "Type":
                     if v == 'Ref':
@@ -416,105 +1638,238 @@ def compute_json(ccds_file, variant_file, output_file, pas_tolerance, genomic_se
                         else:
                             isoform['variant_type'] = "(Reference TR)"
                     else:
-                        isoform['variant_type'] = re.sub('\s+$', '', v)
-                elif not re.match('^\s*\#', line):
-                    raise ValueError("Could not parse GTF file " + variant_file + "(" + k + "=>" + v + ")\n" + line + "\n")
-            gene['isoforms'][index] = isoform
-
-    with open(ccds_file, mode='r', encoding='utf-8') as fd:
-        gene['number_of_predicted_isoforms'] = int(fd.readline().rstrip())
-        gene['genome']['length'] = int(fd.readline().rstrip())
-        isoform_5utr_length = 0
-        isoform_3utr_length = 0
-        for line in fd:
-            l = line.rstrip()
-            l = re.sub('\s+', '', l)
-            l = re.sub('#.*', '', l)
+                        isoform['variant_type'] = v.rstrip()
+                elif not line.lstrip().startswith('#'):
+                    raise _parse_error(filename, line_number, line, "unknown attribute " + k)
+            yield (index, isoform)
+
+
+def read_ccds_transcripts(filename):
+    """Parse the exons of the isoforms (CCDS_transcripts.txt).
 
-            if re.match('^>', l):
+    The first item yielded is the pair (number of isoforms, genome length)
+    read from the header of the file. Then a dictionary is yielded for each
+    isoform, with its index, its flags and the list of its exons, in the
+    order of the file.
+    """
+    with open(filename, mode='r', encoding='utf-8') as fd:
+        try:
+            yield (int(fd.readline()), int(fd.readline()))
+        except ValueError:
+            raise _parse_error(filename, 1, "", "wrong header")
+        isoform = None
+        for line_number, line in enumerate(fd, 3):
+            l = _WHITESPACE.sub('', line)
+            l = l.partition('#')[0]
+            if not l:
+                continue
+            if l[0] == '>':
                 # New isoform
-                l = l[1:]
-                # print(l)
-                fields = [int(x) for x in  re.split(':', l)]
-
-                # pprint.pprint(fields)
-                index = fields[0]
-                if not index in gene['isoforms']:
-                    raise ValueError("CCDS file " + ccds_file + "contains isoform with index " + index + " not in variant_file\n")
-                if fields[1] > gene['isoforms'][index]['number_of_exons']:
-#                    import pdb; pdb.set_trace()
-                    raise ValueError("Wrong number of exons: " + str(index) + "\n " + str(fields[1]) + "!= " +
-                                     str(isoform['number_of_exons']) + "\n")
-
-                gene['isoforms'][index]['reference?'] = False if fields[2] == 0 else True
-                gene['isoforms'][index]['from_RefSeq?'] = False if fields[3] == 0 else True
-                gene['isoforms'][index]['NMD_flag'] = fields[4]
-                if gene['isoforms'][index]['annotated_CDS?']:
-                    isoform_5utr_length = gene['isoforms'][index]['CDS_start']
-                    isoform_3utr_length = gene['isoforms'][index]['CDS_end']
-            elif re.match('^(\d+:){5}(-?\d+:)(-?\d+)$', l):
-                # Row contains exon metadata
+                if isoform is not None:
+                    yield isoform
+                try:
+                    fields = [int(x) for x in l[1:].split(':')]
+                except ValueError:
+                    raise _parse_error(filename, line_number, line, "wrong isoform header")
+                isoform = {
+                    'index': fields[0],
+                    'number_of_exons': fields[1],
+                    'reference?': fields[2] != 0,
+                    'from_RefSeq?': fields[3] != 0,
+                    'NMD_flag': fields[4],
+                    'polyA?': False,
+                    'exons': [],
+                }
+            elif _CCDS_EXON.match(l):
+                # Row contains exon metadata
+                if isoform is None:
+                    raise _parse_error(filename, line_number, line, "exon without an isoform")
+                fields = [int(x) for x in l.split(':')]
                 exon = {}
                 (exon["absolute_start"], exon["absolute_end"], exon["relative_start"], exon["relative_end"],
-                 polyA, exon["5UTR_length"], exon["3UTR_length"]) = [max(0, int(x)) for x in  re.split(':', l)]
+                 polyA, exon["5UTR_length"], exon["3UTR_length"]) = [max(0, x) for x in fields]
                 exon['length'] = abs(exon["absolute_end"] - exon["absolute_start"]) + 1
-                # if gene['genome']['strand'] == '-':
-                #     (exon["absolute_start"], exon["absolute_end"], exon["relative_start"], exon["relative_end"]) = (exon["absolute_end"], exon["absolute_start"], exon["relative_end"], exon["relative_end"])
-                if (polyA == 1):
-                    gene['isoforms'][index]['polyA?'] = True
-                # pprint.pprint(exon)
+                if polyA == 1:
+                    isoform['polyA?'] = True
                 logging.debug("Reading CCDS_transcripts: Row contains exon metadata { %s }",
                               "; ".join([line.rstrip(),
                                          str(max(exon["relative_end"], exon["relative_start"])),
                                          str(min(exon["relative_end"], exon["relative_start"])),
                                          str(exon["5UTR_length"]),
                                          str(exon["3UTR_length"]),
-                                         str(abs(exon["relative_end"] - exon["relative_start"]) + 1 - exon["5UTR_length"] - exon["3UTR_length"])
+                                         str(abs(exon["relative_end"] - exon["relative_start"]) + 1 -
+                                             exon["5UTR_length"] - exon["3UTR_length"])
                                      ]))
-                if int(re.split(':', l)[4]) < 0:
+                if fields[4] < 0:
                     del(exon["5UTR_length"])
-                if int(re.split(':', l)[5]) < 0:
+                if fields[5] < 0:
                     del(exon["3UTR_length"])
-                gene['isoforms'][index]['exons'].append(exon)
+                isoform['exons'].append(exon)
+            elif _CCDS_SEQUENCE.match(l):
+                if isoform is None or not isoform['exons']:
+                    raise _parse_error(filename, line_number, line, "sequence without an exon")
+                isoform['exons'][-1]['sequence'] = l
+                isoform['exons'][-1]['length_on_transcript'] = len(l)
+            else:
+                raise _parse_error(filename, line_number, line, "unknown row")
+        if isoform is not None:
+            yield isoform
+
+
+def read_introns(filename):
+    """Parse the predicted introns (predicted-introns.txt).
+
+    Yield an Intron for each line, supported by the ESTs listed in the file.
+    """
+    with open(filename, mode='r', encoding='utf-8') as fd:
+        for line_number, line in enumerate(fd, 1):
+            fields = line.rstrip().split("\t")
+            if fields == ['']:
+                continue
+            if len(fields) != 20:
+                raise _parse_error(filename, line_number, line,
+                                   "{} fields instead of 20".format(len(fields)))
+            intron = Intron()
+            (intron.relative_start, intron.relative_end,
+             intron.absolute_start, intron.absolute_end, intron.length,
+             intron.number_of_supporting_transcripts, EST_list,
+             intron.donor_alignment_error, intron.acceptor_alignment_error, intron.donor_score,
+             intron.acceptor_score, intron.BPS_score, intron.BPS_position, intron.type,
+             intron.pattern, intron.repeat_sequence, intron.donor_exon_suffix, intron.prefix,
+             intron.suffix, intron.acceptor_exon_prefix) = fields
+            intron.supporting_transcripts = {i: None for i in EST_list.split(',') if i != ''}
+            try:
+                for field in Intron.INT_FIELDS:
+                    setattr(intron, field, int(getattr(intron, field)))
+                for field in Intron.FLOAT_FIELDS:
+                    setattr(intron, field, float(getattr(intron, field)))
+            except ValueError:
+                raise _parse_error(filename, line_number, line, "wrong " + field)
+            yield intron
+
+
+def compute_json(ccds_file, variant_file, output_file, pas_tolerance, genomic_seq,
+                 factorization_file='out-after-intron-agree.txt', introns_file='predicted-introns.txt',
+                 json_format='pretty'):
+    gene = build_gene(ccds_file, variant_file, pas_tolerance, genomic_seq, factorization_file, introns_file)
+    export_gene(gene, None, json_file=output_file, json_format=json_format)
+
+
+def build_gene(ccds_file, variant_file, pas_tolerance, genomic_seq,
+               factorization_file='out-after-intron-agree.txt', introns_file='predicted-introns.txt'):
+    """Build the gene model from the outputs of the stages of the pipeline."""
+    def dump_and_exit(exon, isoform, isoform_id):
+        logging.debug("Exon =>")
+        logging.debug(exon)
+        logging.debug("Isoform (ID " + str(isoform_id) + ")=>")
+        logging.debug(isoform)
+        raise PIntronError
+
+    # Find the sequence ID
+    # It is stored in the first line of the genomic sequence
+    with open(genomic_seq, 'r', encoding='utf-8') as f:
+        line = f.readline().rstrip("\r\n")
+        m = re.match('>(?P<type>chr)?(?P<chrnum>X|Y|x|y|\d+):\d+:\d+:(?P<strand>\+|-|\+1|-1|1)', line)
+        sequence_id = "chr" + m.group('chrnum')
+        strand = m.group('strand')
+        if strand == '-1' or strand == '-':
+            strand = '-'
+        else:
+            strand = '+'
+
+    gene = {
+        'file_format_version': 5,  # Hardcoding version number
+        'program_version': options.version,  # Program version
+        'isoforms': {},
+        'introns': {},
+        'number_of_processed_transcripts': 0,
+        'genome': {
+            'sequence_id': sequence_id,
+            'strand': strand,
+        },
+    }
+
+    for file in [ccds_file, variant_file]:
+        if not os.access(file, os.R_OK):
+            # throw exception and die
+            logging.exception("*** Fatal error: Could not read " + file + "\n")
+
+    for (index, intron) in enumerate(read_introns(introns_file), 1):
+        gene['introns'][index] = intron
+
+    # The introns supported by each EST
+    introns_by_est = {}
+    for intron in gene['introns'].values():
+        for est in intron.supporting_transcripts:
+            introns_by_est.setdefault(est, []).append(intron)
+
+    # The factorizations are not kept: while they are read, each intron gets
+    # the alignment of the factors surrounding it for each supporting EST,
+    # and the coordinates of the factors with a PAS are saved.
+    # If an EST has more than one factorization, the last one is used.
+    pas_factors = {}
+    for factorization in read_factorizations(factorization_file):
+        gene['number_of_processed_transcripts'] += 1
+        est = factorization.est
+        pas_factors.pop(est, None)
+        if factorization.pas_factor is not None:
+            pas_factors[est] = (factorization.pas_factor.relative_start, factorization.pas_factor.relative_end)
+        if est not in introns_by_est:
+            continue
+        factors_by_end = {}
+        factors_by_start = {}
+        for factor in factorization.factors:
+            factors_by_end.setdefault(factor.relative_end, []).append(factor)
+            factors_by_start.setdefault(factor.relative_start, []).append(factor)
+        for intron in introns_by_est[est]:
+            good_left = factors_by_end.get(intron.relative_start - 1, [])
+            good_right = factors_by_start.get(intron.relative_end + 1, [])
+            if len(good_left) == 1 and len(good_right) == 1:
+                intron.supporting_transcripts[est] = SupportingAlignment(intron, good_left[0], good_right[0])
+            else:
+                intron.supporting_transcripts[est] = None
+    del introns_by_est
+
+    # Each intron must have the alignment of all its supporting transcripts
+    for intron in gene['introns'].values():
+        aligned = [est for (est, alignment) in intron.supporting_transcripts.items() if alignment is not None]
+        if len(aligned) != intron.number_of_supporting_transcripts:
+            logging.error("Intron %s:%s is supported by %d transcripts, but only %s are aligned",
+                          intron.relative_start, intron.relative_end,
+                          intron.number_of_supporting_transcripts, aligned)
+            raise PIntronError
 
-            elif re.match('^[acgtACGT]+$', l):
-                last_exon = gene['isoforms'][index]['exons'][-1]['sequence'] = l
-                gene['isoforms'][index]['exons'][-1]['length_on_transcript'] = len(l)
-            elif not re.match('^\s*\#', line):
-                raise ValueError("Could not parse CCDS file " + ccds_file + " at line:\n" + line + "\n")
+    for (index, isoform) in read_variants(variant_file):
+        gene['isoforms'][index] = isoform
+
+    ccds_records = read_ccds_transcripts(ccds_file)
+    (gene['number_of_predicted_isoforms'], gene['genome']['length']) = next(ccds_records)
+    for record in ccds_records:
+        index = record['index']
+        if index not in gene['isoforms']:
+            raise ValueError("CCDS file " + ccds_file + " contains isoform with index " + str(index) +
+                             " not in variant_file\n")
+        isoform = gene['isoforms'][index]
+        if record['number_of_exons'] > isoform['number_of_exons']:
+            raise ValueError("Wrong number of exons: " + str(index) + "\n " + str(record['number_of_exons']) +
+                             "!= " + str(isoform['number_of_exons']) + "\n")
+        isoform['reference?'] = record['reference?']
+        isoform['from_RefSeq?'] = record['from_RefSeq?']
+        isoform['NMD_flag'] = record['NMD_flag']
+        if record['polyA?']:
+            isoform['polyA?'] = True
+        isoform['exons'].extend(record['exons'])
 
     # When the strand is negative, the exons are in reverse order
     for isoform in gene['isoforms'].keys():
         gene['isoforms'][isoform]['exons'].reverse()
 
-    with open('predicted-introns.txt', mode='r', encoding='utf-8') as fd:
-        index = 1
-        for line in fd:
-            intron = {"supporting_transcripts": {}}
-            (intron['relative_start'], intron['relative_end'],
-             intron['absolute_start'], intron['absolute_end'], intron['length'], intron['number_of_supporting_transcripts'], EST_list,
-             intron['donor_alignment_error'], intron['acceptor_alignment_error'], intron['donor_score'],
-             intron['acceptor_score'], intron['BPS_score'], intron['BPS_position'], intron['type'], intron['pattern'],
-             intron['repeat_sequence'], intron['donor_exon_suffix'], intron['prefix'], intron['suffix'],
-             intron['acceptor_exon_prefix']) = re.split("\t", line.rstrip())
-             # intron['begin donor'] = intron['relative_end'] - len(intron['donor_exon_suffix']) +1
-             # intron['end acceptor'] = intron['relative begin'] - len(intron['acceptor_exon_prefix']) -1
-            intron["supporting_transcripts"] = {i: {} for i in re.split(',', EST_list) if i != ''}
-            #pprint.pprint(intron["supporting_transcripts"])
-            #import pdb; pdb.set_trace()
-
-            for field in ('relative_start', 'relative_end', 'absolute_start', 'absolute_end', 'length', 'number_of_supporting_transcripts',
-                          'BPS_position'):
-                intron[field] = int(intron[field])
-            for field in ('donor_alignment_error', 'acceptor_alignment_error', 'donor_score',
-                          'acceptor_score', 'BPS_score'):
-                intron[field] = float(intron[field])
-
-            if intron['BPS_position'] < 0:
-                del intron['BPS_position']
-
-            gene['introns'][index] = intron
-            index += 1
+    # Index the introns by their absolute coordinates, regardless of the orientation
+    introns_by_coordinates = {}
+    for index, intron in gene['introns'].items():
+        borders = (min(intron.absolute_start, intron.absolute_end),
+                   max(intron.absolute_start, intron.absolute_end))
+        introns_by_coordinates.setdefault(borders, []).append(index)
 
     # add introns to each isoform
     for isoform in gene['isoforms'].values():
@@ -527,53 +1882,17 @@ def compute_json(ccds_file, variant_file, output_file, pas_tolerance, genomic_se
             list_extremes.sort()
             left_border = list_extremes[1] + 1
             right_border = list_extremes[2] - 1
-            for index in gene['introns'].keys():
-                intron = gene['introns'][index]
-                if intron['absolute_start'] == left_border and intron['absolute_end'] == right_border or intron['absolute_end'] == left_border and intron['absolute_start'] == right_border:
-                    isoform['introns'].append(index)
-
-    # for each intron, add the alignment of the sorrounding exons.
-    # Since different factorizations can support the same intron, the first
-    # step is to find all pairs of exons supporting an intron
-    def supporting_factors(intron):
-        pairs = []
-        for est in intron["supporting_transcripts"].keys():
-            factor = gene['factorizations'][est]
-            #                    import pdb; pdb.set_trace()
-            good_left  = [exon for exon in factor['exons'] if exon['relative_end'] == intron['relative_start'] - 1]
-            good_right = [exon for exon in factor['exons'] if exon['relative_start'] == intron['relative_end'] + 1]
-            if len(good_left) == 1 and len(good_right) == 1:
-                pairs.append([est, good_left[0], good_right[0]])
-        if len(pairs) != intron['number_of_supporting_transcripts']:
-            pprint.pprint(factor)
-            print("\n")
-            pprint.pprint(intron)
-            print("\n")
-            pprint.pprint(pairs)
-            raise PIntronError
-        return(pairs)
-
-    #
-    # Each intron has the list of supporting_transcripts.
-    # For each such EST we provide the suffix/prefix of the prev/next exon
-    for index in gene['introns'].keys():
-            # donor_exon = [ exon for exon in isoform['exons'] if (exon['relative_end'] == intron['relative_start'] - 1) ][0]
-            # acceptor_exon = [ exon for exon in isoform['exons'] if (exon['relative_start'] == intron['relative_end'] + 1) ][0]
-            # add the alignment to each intron
-        for [est, donor_factor, acceptor_factor] in supporting_factors(gene['introns'][index]):
-#            import pdb; pdb.set_trace()
-            gene['introns'][index]['supporting_transcripts'][est] = {
-                'donor_factor_suffix': donor_factor['EST sequence'][-len(gene['introns'][index]['donor_exon_suffix']):],
-                'acceptor_factor_prefix': acceptor_factor['EST sequence'][:len(gene['introns'][index]['acceptor_exon_prefix'])],
-                'acceptor_factor_start': acceptor_factor['EST start'],
-                'donor_factor_end': donor_factor['EST end'],
-                'acceptor_factor_end': acceptor_factor['EST end'],
-                'donor_factor_start': donor_factor['EST start'],
-            }
+            isoform['introns'].extend(introns_by_coordinates.get((min(left_border, right_border),
+                                                                  max(left_border, right_border)), []))
+
+    # The (relative_start, relative_end) coordinates of the exons with a PAS,
+    # sorted to find those within pas_tolerance of an exon with a binary search
+    pas_coordinates = sorted(pas_factors.values())
 
-    def same_coordinates(a, b):
-        return True if (a['relative_start'] == b['relative_start'] and
-                        30 >= a['relative_end'] - b['relative_end'] >= -30) else False
+    def same_coordinates_as_pas(exon):
+        i = bisect.bisect_left(pas_coordinates, (exon['relative_start'], exon['relative_end'] - pas_tolerance))
+        return (i < len(pas_coordinates) and
+                pas_coordinates[i] <= (exon['relative_start'], exon['relative_end'] + pas_tolerance))
 
     # pprint.pprint(gene)
     for isoform in gene['isoforms'].keys():
@@ -600,7 +1919,7 @@ def compute_json(ccds_file, variant_file, output_file, pas_tolerance, genomic_se
         exon = gene['isoforms'][isoform]['exons'][-1]
         # If PAS_factorizations has an exon with the same coordinates,
         # we have a PAS
-        if any(x for x in gene['factorizations'].values() if x['PAS'] and same_coordinates(x['exon'], exon)):
+        if same_coordinates_as_pas(exon):
             gene['isoforms'][isoform]['PAS?'] = True
 
     # Enrich the JSON file with information that can be used to compute the GTF file
@@ -770,34 +2089,618 @@ def compute_json(ccds_file, variant_file, output_file, pas_tolerance, genomic_se
                 cumulative_stop_codon_length += abs(exon['stop_codon_absolute_end'] - exon['stop_codon_absolute_start']) + 1
 
     # import pdb; pdb.set_trace()
-    # Clean up the data structure and write the json file
-    del gene['factorizations']
-    with open(output_file, mode='w', encoding='utf-8') as fd:
-        fd.write(json.dumps(gene, sort_keys=True, indent=4))
+    return gene
+
+
+# ioctl request that makes a file share the data blocks of another one (Linux)
+FICLONE = 0x40049409
+
+
+def stage_file(source, destination, hardlink=True):
+    """Make destination a copy of source, sharing its data when possible.
+
+    The copy is a reflink on the filesystems that support it (e.g., Btrfs,
+    XFS), otherwise a hard link if hardlink is set (the file must never be
+    modified), otherwise a full copy.  Return the method used.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return 'reflink'
+    except OSError:
+        if os.path.lexists(destination):
+            os.remove(destination)
+    if hardlink:
+        try:
+            os.link(source, destination)
+            return 'hardlink'
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+    return 'copy'
+
+
+# prlimit (from util-linux) sets the resource limits of a program and then executes
+# it, without running any code of the driver between fork and exec
+PRLIMIT = shutil.which('prlimit')
+PRLIMIT_OPTIONS = {resource.RLIMIT_CPU: '--cpu', resource.RLIMIT_AS: '--as'}
+
+# Program executed by a new interpreter in place of a program with resource
+# limits, when prlimit is not available and the driver has threads (e.g., the
+# AsyncLocusPool or the shards of est-fact): a preexec_fn is not safe with threads.
+_LIMITS_SHIM = """
+import os, resource, sys
+end = sys.argv.index('--')
+for arg in sys.argv[1:end]:
+    (name, soft, hard) = arg.split(':')
+    resource.setrlimit(getattr(resource, name), (int(soft), int(hard)))
+os.execvp(sys.argv[end + 1], sys.argv[end + 1:])
+"""
+
+
+def limit_values(limits):
+    """Return the (soft, hard) limit of each resource of limits, never above the current hard limit.
+
+    The program receives SIGXCPU at its CPU time limit (and SIGKILL a second later).
+    """
+    values = {}
+    for (limit, value) in limits.items():
+        value = int(value)
+        hard = resource.getrlimit(limit)[1]
+        pair = (value, value + 1 if limit == resource.RLIMIT_CPU else value)
+        values[limit] = pair if hard == resource.RLIM_INFINITY else tuple(min(v, hard) for v in pair)
+    return values
+
+
+def limited_command(command, limits):
+    """Return the argv and the preexec_fn executing command with the resource limits (resource -> value) set.
+
+    The limits are set by prlimit if available, otherwise by the preexec_fn if
+    the calling thread is the only thread of the driver, otherwise by a new
+    interpreter running _LIMITS_SHIM (which is slower to start).
+    """
+    if not limits:
+        return (list(command), None)
+    values = limit_values(limits)
+    if PRLIMIT and all(limit in PRLIMIT_OPTIONS for limit in values):
+        return ([PRLIMIT] + ['{}={}:{}'.format(PRLIMIT_OPTIONS[limit], soft, hard)
+                             for (limit, (soft, hard)) in values.items()] + ['--'] + list(command), None)
+    if threading.active_count() == 1:
+        def set_limits():
+            for (limit, pair) in values.items():
+                resource.setrlimit(limit, pair)
+        return (list(command), set_limits)
+    names = {getattr(resource, name): name for name in dir(resource) if name.startswith('RLIMIT_')}
+    return ([sys.executable, '-I', '-S', '-c', _LIMITS_SHIM] +
+            ['{}:{}:{}'.format(names[limit], soft, hard) for (limit, (soft, hard)) in values.items()] +
+            ['--'] + list(command), None)
+
+
+def describe_command(command, stdin=None, stdout=None):
+    """Return the shell-like description of the argv command reading stdin and writing stdout."""
+    return (shlex.join(command) + (" < " + shlex.quote(stdin) if stdin else "") +
+            (" > " + shlex.quote(stdout) if stdout else ""))
+
+
+# Options of est-fact at each degradation level: when est-fact exceeds its
+# limits, it is executed again at the next level, which reports fewer
+# factorizations and uses longer common factors.
+EST_FACT_DEGRADATION_LEVELS = [
+    [],
+    ["--max-no-of-factorizations=1000", "--min-factor-length=18"],
+    ["--max-no-of-factorizations=100", "--min-factor-length=21"],
+    ["--max-no-of-factorizations=10", "--min-factor-length=25"],
+]
+
+# Rule of thumb for the resources used by est-fact: the index of the genomic
+# sequence and the data of the ESTs take a few tens of bytes per nucleotide,
+# and the time to factorize each EST grows with the length of the genomic
+# sequence. The limits are the estimates times a safety margin.
+EST_FACT_BASE_MEMORY = 256 * 1024 * 1024
+EST_FACT_BYTES_PER_GENOMIC_NT = 48
+EST_FACT_BYTES_PER_EST_NT = 16
+EST_FACT_BASE_TIME = 60
+EST_FACT_SECONDS_PER_EST = 0.05
+EST_FACT_SECONDS_PER_EST_AND_GENOMIC_NT = 1e-7
+EST_FACT_SAFETY_MARGIN = 2
+# Each shard of the ESTs builds its own index of the genomic sequence: the
+# automatic sharding never creates shards with fewer ESTs than this.
+EST_FACT_MIN_SHARD_SIZE = 100
+
+
+def sequence_statistics(filename):
+    """Return the number of sequences and the total length of the sequences of a FASTA file."""
+    sequences = 0
+    length = 0
+    with open(filename, 'rb') as fd:
+        for line in fd:
+            if line.startswith(b'>'):
+                sequences += 1
+            else:
+                length += len(line.strip())
+    return (sequences, length)
+
+
+def estimate_est_fact_resources(genomic_length, number_of_ests, ests_length):
+    """Return the estimated CPU time (in seconds) and memory (in bytes) used by est-fact."""
+    seconds = EST_FACT_BASE_TIME + number_of_ests * (EST_FACT_SECONDS_PER_EST +
+                                                     EST_FACT_SECONDS_PER_EST_AND_GENOMIC_NT * genomic_length)
+    memory = (EST_FACT_BASE_MEMORY + EST_FACT_BYTES_PER_GENOMIC_NT * genomic_length +
+              EST_FACT_BYTES_PER_EST_NT * ests_length)
+    return (int(seconds), int(memory))
+
+
+def est_fact_limits(options, genomic_length=None, number_of_ests=None, ests_length=None):
+    """Return the resource limits (resource -> value) of est-fact.
+
+    The limits are the ones set by the options, lowered to the estimates of
+    the resources needed (times a safety margin) with --adaptive-limits.
+    """
+    limits = {resource.RLIMIT_CPU: options.max_factorization_time * 60,
+              resource.RLIMIT_AS: options.max_factorization_memory * 1024 * 1024}
+    if options.adaptive_limits and genomic_length is not None:
+        (seconds, memory) = estimate_est_fact_resources(genomic_length, number_of_ests, ests_length)
+        limits[resource.RLIMIT_CPU] = min(limits[resource.RLIMIT_CPU], seconds * EST_FACT_SAFETY_MARGIN)
+        limits[resource.RLIMIT_AS] = min(limits[resource.RLIMIT_AS], memory * EST_FACT_SAFETY_MARGIN)
+    return limits
+
+
+def est_fact_shards(options, genomic_length, number_of_ests, ests_length):
+    """Return the number of shards of the ESTs factorized in parallel by est-fact.
+
+    The shards set by the options (as many as the processors if 0) are reduced
+    until the estimated memory of all the shards fits in the memory budget.
+    """
+    shards = options.est_fact_shards
+    if shards <= 0:
+        shards = min(os.cpu_count() or 1, number_of_ests // EST_FACT_MIN_SHARD_SIZE)
+    shards = max(1, min(shards, number_of_ests))
+    budget = options.memory_budget * 1024 * 1024 if options.memory_budget else available_memory()
+    while shards > 1:
+        shard_ests = -(-number_of_ests // shards)
+        shard_length = -(-ests_length // shards)
+        memory = min(est_fact_limits(options, genomic_length, shard_ests, shard_length)[resource.RLIMIT_AS],
+                     estimate_est_fact_resources(genomic_length, shard_ests, shard_length)[1])
+        if shards * memory <= budget:
+            break
+        shards -= 1
+    return shards
+
+
+def split_fasta(filename, shard_files):
+    """Split the sequences of a FASTA file into contiguous shards of similar size.
+
+    The i-th shard is written to shard_files[i], so that the concatenation of the
+    shards is the original file.
+    """
+    total = os.path.getsize(filename)
+    shards = len(shard_files)
+    with contextlib.ExitStack() as files:
+        outputs = [files.enter_context(open(name, 'wb')) for name in shard_files]
+        with open(filename, 'rb') as fd:
+            shard = 0
+            position = 0
+            for line in fd:
+                if (line.startswith(b'>') and shard < shards - 1 and
+                        position >= total * (shard + 1) // shards):
+                    shard += 1
+                outputs[shard].write(line)
+                position += len(line)
+
+
+def _header_attribute(header, name):
+    """Return the text of a FASTA header after /name= (as searched by est-fact), None if missing."""
+    for key in (b'/' + name + b'=', b'/' + name.upper() + b'='):
+        position = header.find(key)
+        if position >= 0:
+            return header[position + len(key):]
+    return None
+
+
+def _fasta_header(line):
+    """Return the header of a FASTA header line as read by the programs (without the trailing control bytes)."""
+    end = len(line)
+    while end > 1 and line[end - 1] < 0x20:
+        end -= 1
+    return line[1:end]
+
+
+def read_ests(filename):
+    """Return the header, the lines and the key of each EST of a FASTA file.
+
+    The key of an EST is a hash of its sequence and of the information used by
+    est-fact to choose its strand (a RefSeq mRNA accession, /clone_end and
+    /fixed_strand): est-fact computes the same factorizations for all the ESTs
+    with the same key.
+    """
+    def strand_information(header):
+        accession = _header_attribute(header, b'gb')
+        clone_end = _header_attribute(header, b'clone_end')
+        fixed_strand = _header_attribute(header, b'fixed_strand')
+        return (accession is not None and accession.startswith(b'NM'),
+                clone_end.split(b"'")[0] if clone_end is not None else None,
+                fixed_strand[:1] if fixed_strand is not None else None)
+
+    records = []
+    with open(filename, 'rb') as fd:
+        for line in fd:
+            if line.startswith(b'>'):
+                records.append((_fasta_header(line), [line], hashlib.sha1()))
+            elif records:
+                records[-1][1].append(line)
+                records[-1][2].update(line.rstrip())
+    return [(header, lines,
+             hashlib.sha1(digest.digest() + repr(strand_information(header)).encode('utf-8')).hexdigest())
+            for (header, lines, digest) in records]
+
+
+def collapse_duplicate_ests(records, cached=()):
+    """Choose the ESTs of records (as returned by read_ests) to factorize.
+
+    Only the first EST with each key is factorized, unless its key is in
+    cached.  Return the list of the header of each EST and of the source of
+    its factorizations (the header of the EST factorized in its place, or its
+    key if cached), and the records of the ESTs to factorize.  Return None if
+    the headers of the ESTs are not unique.
+    """
+    if len(set(header for (header, lines, key) in records)) != len(records):
+        logging.warning("The headers of the ESTs are not unique: duplicate ESTs are not collapsed")
+        return None
+    sources = {key: key.encode('ascii') for key in cached}
+    representatives = []
+    unique = []
+    for (header, lines, key) in records:
+        source = sources.setdefault(key, header)
+        representatives.append((header, source))
+        if source == header:
+            unique.append((header, lines, key))
+    return (representatives, unique)
+
+
+def expand_collapsed_ests(filenames, representatives, output_filename, others=()):
+    """Write the records of the representative ESTs for all the ESTs of their groups.
+
+    The output files of est-fact (read in order from filenames) consist of
+    records starting with the header of their EST.  For each EST listed in
+    representatives (see collapse_duplicate_ests), the records of its
+    representative are written to output_filename with the header of the EST
+    (an EST without alignments has no records).  Raise PIntronError if the
+    outputs have records of an EST that is neither a representative nor in
+    others.  Return the number of records written.
+    """
+    records = {}
+    for filename in filenames:
+        with open(filename, 'rb') as fd:
+            lines = None
+            for line in fd:
+                if line.startswith(b'>'):
+                    lines = []
+                    records.setdefault(_fasta_header(line), []).append(lines)
+                elif lines is not None:
+                    lines.append(line)
+    unknown = set(records) - set(representative for (header, representative) in representatives) - set(others)
+    if unknown:
+        raise PIntronError("The factorizations of {} ESTs (e.g., {}) do not match any input EST".format(
+            len(unknown), min(unknown).decode('ascii', 'replace')))
+    written = 0
+    with open(output_filename, 'wb') as fd:
+        for (header, representative) in representatives:
+            for lines in records.get(representative, ()):
+                fd.write(b'>' + header + b'\n')
+                fd.writelines(lines)
+                written += 1
+    return written
+
+
+def count_records(filenames):
+    """Return the number of records of the FASTA-like files filenames."""
+    count = 0
+    for filename in filenames:
+        with open(filename, 'rb') as fd:
+            count += sum(1 for line in fd if line.startswith(b'>'))
+    return count
+
+
+# Messages of a failed allocation: palloc() of the programs, the C++ runtime and strerror(ENOMEM)
+MEMORY_ERROR_MESSAGES = re.compile(rb"Allocation memory error|std::bad_alloc|Cannot allocate memory|"
+                                   rb"[Oo]ut of memory|ENOMEM")
+# A program whose peak RSS reaches this fraction of its RLIMIT_AS has exhausted its memory
+MEMORY_LIMIT_FRACTION = 0.9
+
+
+def limit_exceeded(error):
+    """Return the limit ('time' or 'memory') that the failed stage of error exceeded, None if none.
+
+    Only the evidence of a limit counts: RLIMIT_CPU kills the program with
+    SIGXCPU at the limit, and a program exceeding RLIMIT_AS reports the failed
+    allocation or has used most of its memory.  Any other failure (an error of
+    the program, a kill by --stage-timeout or by the OOM killer) is not due to
+    the limits.  The evidence is checked against the limits the program was
+    executed with (error.limits).
+    """
+    limits = error.limits
+    cpu_time = error.usage.ru_utime + error.usage.ru_stime if error.usage else 0
+    if resource.RLIMIT_CPU in limits and (error.retcode == -signal.SIGXCPU or
+                                          cpu_time >= limits[resource.RLIMIT_CPU]):
+        return 'time'
+    peak_rss = error.usage.ru_maxrss * 1024 if error.usage else 0
+    if resource.RLIMIT_AS in limits and (MEMORY_ERROR_MESSAGES.search(error.stderr) or
+                                         peak_rss >= limits[resource.RLIMIT_AS] * MEMORY_LIMIT_FRACTION):
+        return 'memory'
+    return None
+
+
+# The AsyncLocusPool, and the job, that the current thread is executing (if any)
+_controller = contextvars.ContextVar('pintron_controller', default=None)
+_job = contextvars.ContextVar('pintron_job', default=None)
+
+# Bytes of the standard error of each program kept for its errors (see limit_exceeded)
+STDERR_TAIL_SIZE = 4096
+
+# Seconds between the checks of the cancel event of wait_processes
+CANCEL_POLL_INTERVAL = 0.1
+
+
+def wait_processes(processes, logfile, timeout=None, cancel=None):
+    """Wait for the termination of the processes, all killed after timeout seconds (if given).
+
+    The processes are waited for by an event loop, which also copies their
+    standard error (a pipe) to the logfile file object: the loop of the
+    AsyncLocusPool within one of its jobs, otherwise a loop of the calling thread.
+    Return the resource usage of each process (from wait4, so including its
+    descendants), the last STDERR_TAIL_SIZE bytes of its standard error, and
+    whether the processes were killed by the timeout; the exit status of each
+    process is stored in its returncode.  The processes are also killed when
+    the cancel event (a threading.Event, if given) is set by another thread.
+    """
+    controller = _controller.get()
+    if controller:
+        return controller.wait_processes(processes, logfile, timeout, cancel)
+    return asyncio.run(_wait_processes(processes, logfile, timeout, cancel=cancel))
+
+
+def _kill_process(proc):
+    # Only the event loop reaps the processes, hence the pid of an unreaped process cannot be reused
+    if proc.returncode is None:
+        os.kill(proc.pid, signal.SIGKILL)
+
+
+async def _copy_stderr(proc, logfile, tail):
+    reader = asyncio.StreamReader()
+    (transport, protocol) = await asyncio.get_running_loop().connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), proc.stderr)
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            logfile.write(data)
+            tail.extend(data)
+            del tail[:-STDERR_TAIL_SIZE]
+    finally:
+        transport.close()
+
+
+async def _reap(proc):
+    # asyncio subprocesses are reaped without their resource usage: the process
+    # is waited for on a pidfd (or by wait4 in the default executor if pidfds
+    # are not available) and then reaped by wait4
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        (pid, status, usage) = await loop.run_in_executor(None, os.wait4, proc.pid, 0)
+    else:
+        try:
+            terminated = loop.create_future()
+            loop.add_reader(pidfd, lambda: terminated.done() or terminated.set_result(None))
+            try:
+                await terminated
+            finally:
+                loop.remove_reader(pidfd)
+        finally:
+            os.close(pidfd)
+        (pid, status, usage) = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return usage
+
+
+async def _cancelled(cancel):
+    # A threading.Event cannot wake up an event loop
+    while not cancel.is_set():
+        await asyncio.sleep(CANCEL_POLL_INTERVAL)
+
+
+async def _wait_processes(processes, logfile, timeout=None, interrupted=lambda: False, cancel=None):
+    """Coroutine of wait_processes; interrupted() tells whether the caller killed the processes."""
+    tails = [bytearray() for proc in processes]
+    copies = asyncio.gather(*(_copy_stderr(proc, logfile, tail) for (proc, tail) in zip(processes, tails)))
+    reaped = asyncio.gather(*(_reap(proc) for proc in processes))
+    waiters = [reaped] + ([asyncio.ensure_future(_cancelled(cancel))] if cancel else [])
+    timed_out = False
+    killed = False
+    try:
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not reaped.done():
+            # Killed by the timeout or by the cancel event
+            timed_out = not (cancel and cancel.is_set())
+            killed = True
+            for proc in processes:
+                _kill_process(proc)
+        usages = await reaped
+    except asyncio.CancelledError:
+        # e.g., KeyboardInterrupt within asyncio.run
+        for proc in processes:
+            _kill_process(proc)
+        await reaped
+        copies.cancel()
+        await asyncio.gather(copies, return_exceptions=True)
+        raise
+    finally:
+        for waiter in waiters[1:]:
+            waiter.cancel()
+    if killed or interrupted():
+        # The descendants of a killed program may keep its standard error open
+        copies.cancel()
+    await asyncio.gather(copies, return_exceptions=True)
+    return (usages, [bytes(tail) for tail in tails], timed_out)
 
 
 def exec_system_command(command, error_comment, logfile, cmd_label,
-                        output_file=""):
+                        output_file="", cwd=None, env=None, stdin=None, stdout=None, limits=None,
+                        timeout=None, cancel=None):
+    # command is the argv of the program, executed without a shell.
+    # stdin and stdout are the names of the files (in cwd) connected to its
+    # standard input/output, logfile is the file object that receives its
+    # standard error, limits maps the resources (of the resource module) to
+    # the limits set in the child before executing the program, and the
+    # program is killed if still running after timeout seconds or when the
+    # cancel event is set (see wait_processes).
     logging.debug(str(time.localtime()))
-    logging.debug(command)
+    logging.debug(describe_command(command, stdin, stdout))
+
+    def path(name):
+        return os.path.join(cwd, name) if cwd else name
 
     try:
-        retcode = subprocess.call(command + " 2>> " + logfile, shell=True)
+        (argv, preexec_fn) = limited_command(command, limits)
+        with contextlib.ExitStack() as files:
+            proc = subprocess.Popen(argv, cwd=cwd, env=env, preexec_fn=preexec_fn,
+                                    stderr=subprocess.PIPE,
+                                    stdin=files.enter_context(open(path(stdin), 'rb')) if stdin else None,
+                                    stdout=files.enter_context(open(path(stdout), 'wb')) if stdout else None)
+        # wait4 also returns the resources used by the command (and its descendants)
+        ([usage], [stderr], timed_out) = wait_processes([proc], logfile, timeout, cancel)
+        retcode = proc.returncode
         if retcode != 0:
             print(error_comment, retcode, file=sys.stderr)
-            raise PIntronError(error_comment)
-        if os.path.exists("gmon.out"):
+            if timed_out:
+                error_comment = "{} (killed after {:.0f}s)".format(error_comment, timeout)
+            raise PIntronStageError(cmd_label, retcode, usage, error_comment, stderr, limits)
+        gmon_file = path("gmon.out")
+        if os.path.exists(gmon_file):
             try:
-                os.rename("gmon.out", cmd_label+".gmon.out")
+                os.rename(gmon_file, os.path.join(os.path.dirname(gmon_file), cmd_label+".gmon.out"))
             except:
                 pass
     except OSError as e:
         print("Execution failed:", e, file=sys.stderr)
         raise PIntronError
+    return usage
+
+
+def exec_piped_commands(stages, logfile, input_file, output_file=None, cwd=None,
+                        keep_intermediate=False, timeout=None):
+    """Execute a sequence of stages connected by OS pipes.
+
+    The standard output of each stage is the standard input of the next one, so
+    all the stages run concurrently and their intermediate data never touches the
+    disk.  The first stage reads input_file and the output of the last one is
+    saved in output_file (or discarded).  When keep_intermediate is set, the
+    output of each stage with a 'tee' entry is also saved in the given file.
+
+    Each stage is a dictionary with the 'command' (an argv list), 'error_comment',
+    'cmd_label' and, optionally, 'tee', 'env' and 'limits' keys.  The standard error of all the stages is
+    written to the logfile file object.  All the stages are killed if still running
+    after timeout seconds.  Return the resource usage of each stage.
+    """
+    def pump(source, destination, tee_file):
+        broken = False
+        with open(tee_file, 'wb') as tee:
+            while True:
+                data = source.read1(65536)
+                if not data:
+                    break
+                tee.write(data)
+                if not broken:
+                    try:
+                        destination.write(data)
+                    except BrokenPipeError:
+                        # The next stage terminated: keep saving the output anyway
+                        broken = True
+        source.close()
+        try:
+            destination.close()
+        except BrokenPipeError:
+            pass
+
+    def path(name):
+        return os.path.join(cwd, name) if cwd else name
+
+    logging.debug(str(time.localtime()))
+    logging.debug(" | ".join(shlex.join(stage['command']) for stage in stages))
+
+    processes = []
+    threads = []
+    try:
+        with open(path(input_file), 'rb') as stdin:
+            stdout = open(path(output_file), 'wb') if output_file else subprocess.DEVNULL
+            try:
+                previous_out = stdin
+                tee = None
+                for i, stage in enumerate(stages):
+                    last = i == len(stages) - 1
+                    (argv, preexec_fn) = limited_command(stage['command'], stage.get('limits'))
+                    proc = subprocess.Popen(argv, cwd=cwd, preexec_fn=preexec_fn,
+                                            stdin=subprocess.PIPE if tee else previous_out,
+                                            stdout=stdout if last else subprocess.PIPE,
+                                            stderr=subprocess.PIPE, env=stage.get('env'))
+                    processes.append(proc)
+                    if tee:
+                        thread = threading.Thread(target=pump, args=(previous_out, proc.stdin, tee))
+                        thread.start()
+                        threads.append(thread)
+                    elif i > 0:
+                        # The parent must not keep the read end of the pipe open
+                        previous_out.close()
+                    previous_out = proc.stdout
+                    tee = path(stage['tee']) if keep_intermediate and stage.get('tee') else None
+            finally:
+                if output_file:
+                    stdout.close()
+        (usages, stderrs, timed_out) = wait_processes(processes, logfile, timeout)
+        retcodes = [proc.returncode for proc in processes]
+        for thread in threads:
+            thread.join()
+    except OSError as e:
+        for proc in processes:
+            proc.kill()
+            proc.wait()
+        logging.error("Execution failed: %s", e)
+        raise PIntronError("Execution failed: " + str(e))
 
+    failed = [i for (i, retcode) in enumerate(retcodes) if retcode != 0]
+    if failed:
+        # A stage killed by SIGPIPE only reflects the failure of the next one
+        i = next((i for i in failed if retcodes[i] not in (-signal.SIGPIPE, 128 + signal.SIGPIPE)), failed[0])
+        error_comment = stages[i]['error_comment']
+        logging.error("%s (exit status %d)", error_comment, retcodes[i])
+        if timed_out:
+            error_comment = "{} (killed after {:.0f}s)".format(error_comment, timeout)
+        raise PIntronStageError(stages[i]['cmd_label'], retcodes[i], usages[i], error_comment, stderrs[i],
+                                stages[i].get('limits'))
+    gmon_file = path("gmon.out")
+    if os.path.exists(gmon_file):
+        try:
+            os.rename(gmon_file, path(stages[-1]['cmd_label'] + ".gmon.out"))
+        except:
+            pass
+    return usages
 
-def check_executables(bindir, exes):
+
+# md5 of the executables, keyed by their path, size and modification time, so
+# that long-running processes (e.g., the workers of the service) compute the
+# checksum of each program only once.
+_executable_checksums = {}
+
+
+def check_executables(bindir, exes, checksums=None):
     """Check if the executables are in the path or in the specified directory.
+
+    If checksums is given, the md5 of each executable is stored in it, keyed by
+    the full path of the executable.
     """
 
     full_exes = {}
@@ -812,9 +2715,15 @@ def check_executables(bindir, exes):
         for path in paths:
             if os.access(os.path.join(path, exe), os.X_OK):
                 real_path = os.path.realpath(os.path.abspath(os.path.join(path, exe)))
-                md5hex = md5Checksum(real_path)
+                stat = os.stat(real_path)
+                signature = (real_path, stat.st_size, stat.st_mtime_ns)
+                if signature not in _executable_checksums:
+                    _executable_checksums[signature] = md5Checksum(real_path)
+                md5hex = _executable_checksums[signature]
                 logging.debug("Using program '{}' in dir '{}' (md5: {})".format(exe, real_path, md5hex))
                 full_exes[exe] = real_path
+                if checksums is not None:
+                    checksums[real_path] = md5hex
                 break
         if full_exes[exe] == None:
             raise PIntronIOError(exe, "Could not find program '{}'!\n"
@@ -823,6 +2732,589 @@ def check_executables(bindir, exes):
     return full_exes
 
 
+class ScratchDir:
+    """Private working directory of a single run of the pipeline.
+
+    All the stages run inside the directory, and only the requested files are
+    moved out of it.  The directory is removed on exit, even if the run failed,
+    unless keep_on_failure is set.
+
+    If a name is given, the directory is not private: it is reused if it already
+    exists and it is never removed (e.g., to resume an interrupted run).
+
+    Attributes:
+        base_dir   -- directory (e.g., a tmpfs such as /dev/shm) where the scratch
+                      directory is created
+        size_limit -- maximum size (in bytes) of the scratch directory (0 = no limit),
+                      checked by check_size after each stage: a stage can
+                      exceed it while it runs
+        name       -- name of the persistent directory (None for a private one)
+        path       -- absolute path of the scratch directory
+    """
+
+    def __init__(self, base_dir="", size_limit=0, keep_on_failure=False, name=None):
+        self.base_dir = os.path.abspath(os.path.expanduser(base_dir) if base_dir else os.curdir)
+        self.size_limit = size_limit
+        self.keep_on_failure = keep_on_failure
+        self.name = name
+        self.path = None
+
+    def __enter__(self):
+        if not os.path.isdir(self.base_dir) or not os.access(self.base_dir, os.W_OK):
+            raise PIntronIOError(self.base_dir,
+                                 'Could not create the scratch directory in "' + self.base_dir + '"!')
+        if self.size_limit and shutil.disk_usage(self.base_dir).free < self.size_limit:
+            raise PIntronIOError(self.base_dir,
+                                 'Less than {} MiB available for the scratch directory!'.format(
+                                     self.size_limit // (1024 * 1024)))
+        if self.name:
+            self.path = os.path.join(self.base_dir, self.name)
+            os.makedirs(self.path, exist_ok=True)
+        else:
+            self.path = tempfile.mkdtemp(prefix="pintron-scratch-", dir=self.base_dir)
+        logging.debug("Using scratch directory '%s'", self.path)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.name:
+            logging.info("Intermediate files and stage manifests kept in '%s'", self.path)
+        elif exc_type is not None and self.keep_on_failure:
+            logging.info("Intermediate files kept in '%s'", self.path)
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+        return False
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def size(self):
+        """Return the total size of the regular files in the directory and its subdirectories."""
+        total = 0
+        for (dirpath, dirnames, filenames) in os.walk(self.path):
+            for filename in filenames:
+                try:
+                    st = os.lstat(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    total += st.st_size
+        return total
+
+    def check_size(self):
+        if self.size_limit:
+            size = self.size()
+            if size > self.size_limit:
+                raise PIntronIOError(self.path,
+                                     'The scratch directory exceeds its size limit ({:.1f} > {:.1f} MiB)'.format(
+                                         size / (1024 * 1024), self.size_limit / (1024 * 1024)))
+
+    def move_out(self, name, destination):
+        """Move a file of the scratch directory to its final destination."""
+        dest_dir = os.path.dirname(os.path.abspath(destination))
+        os.makedirs(dest_dir, exist_ok=True)
+        shutil.move(self.file(name), destination)
+
+    def move_all_out(self, dest_dir):
+        """Move all the files of the scratch directory to dest_dir."""
+        for entry in os.scandir(self.path):
+            if entry.is_file(follow_symlinks=False):
+                shutil.move(entry.path, os.path.join(dest_dir, entry.name))
+
+
+class ResultCache:
+    """Persistent, content-addressed cache of the results of whole runs.
+
+    Each entry is a directory named after the key of the run, i.e., a hash of the
+    input sequences, of the options that affect the results and of the checksums
+    of the programs.  The modification time of the entry records its last use, and
+    the least recently used entries are evicted when the cache exceeds its size limit.
+
+    Attributes:
+        cache_dir  -- directory containing the cache entries
+        size_limit -- maximum size (in bytes) of the cache (0 = no limit)
+    """
+
+    INFO_FILE = "entry-info.json"
+
+    def __init__(self, cache_dir, size_limit=0):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.size_limit = size_limit
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, options, checksums):
+        """Compute the key of a run from its inputs, its options and the programs used."""
+        config = os.path.join(options.work_dir, "config.ini")
+        content = {
+            'genomic': md5Checksum(options.genome_filename),
+            'ests': md5Checksum(options.EST_filename),
+            'config': md5Checksum(config) if os.path.isfile(config) else None,
+            'options': [options.gene, options.organism, options.pas_tolerance,
+                        options.only_cds_annot, bool(options.gtf_filename), options.json_format,
+                        bool(options.cds_gtf_filename), bool(options.gff3_filename), bool(options.bed_filename),
+                        bool(options.bundle_filename), compression_of(options),
+                        # The limits of est-fact decide the degradation level of the result
+                        options.max_factorization_time, options.max_factorization_memory,
+                        options.adaptive_limits, options.max_degradation_level],
+            'programs': sorted(checksums.values()) + [md5Checksum(sys.argv[0]), options.version],
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def retrieve(self, key, outputs):
+        """Copy the files of the entry to their destination, if the entry exists.
+
+        outputs maps the names of the cached files to their destination.
+        Return True if the entry has been found.
+        """
+        entry_dir = self._entry_dir(key)
+        if not all(os.path.isfile(os.path.join(entry_dir, name)) for name in outputs):
+            return False
+        for name, destination in outputs.items():
+            os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+            shutil.copyfile(os.path.join(entry_dir, name), destination)
+        os.utime(entry_dir)
+        return True
+
+    def store(self, key, files, info):
+        """Add an entry with the given files (a map from names to paths)."""
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            for name, path in files.items():
+                shutil.copyfile(path, os.path.join(tmp_dir, name))
+            info = dict(info, key=key, created=time.strftime('%Y-%m-%d %H:%M:%S'))
+            with open(os.path.join(tmp_dir, self.INFO_FILE), mode='w', encoding='utf-8') as fd:
+                fd.write(json.dumps(info, sort_keys=True, indent=4))
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError as e:
+            logging.warning("Could not store the results in the cache: %s", e)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        logging.debug("Results stored in the cache with key %s", key)
+        self.evict()
+
+    def entries(self):
+        """Return the entries of the cache, from the most to the least recently used."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            try:
+                with open(os.path.join(entry.path, self.INFO_FILE), mode='r', encoding='utf-8') as fd:
+                    info = json.load(fd)
+            except (OSError, ValueError):
+                info = {'key': entry.name}
+            info['size'] = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            info['last_used'] = entry.stat().st_mtime
+            entries.append(info)
+        entries.sort(key=lambda info: info['last_used'], reverse=True)
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits its size limit."""
+        if not self.size_limit:
+            return
+        entries = self.entries()
+        total = sum(info['size'] for info in entries)
+        while entries and total > self.size_limit:
+            info = entries.pop()
+            logging.debug("Evicting the cache entry %s", info['key'])
+            shutil.rmtree(self._entry_dir(info['key']), ignore_errors=True)
+            total -= info['size']
+
+    def purge(self):
+        """Remove all the entries of the cache."""
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def print_entries(self, out=sys.stdout):
+        entries = self.entries()
+        for info in entries:
+            print("{}  {}  {:>10}  {}  {}".format(info['key'],
+                                                  time.strftime('%Y-%m-%d %H:%M:%S',
+                                                                time.localtime(info['last_used'])),
+                                                  info['size'], info.get('gene', '?'),
+                                                  info.get('genomic', '?')), file=out)
+        print("{} entries, {:.1f} MiB".format(len(entries),
+                                              sum(info['size'] for info in entries) / (1024 * 1024)),
+              file=out)
+
+
+class FactorizationCache(ResultCache):
+    """Persistent cache of the factorizations computed by est-fact on each genomic sequence.
+
+    est-fact factorizes each EST on its own against the index of the genomic
+    sequence, hence its outputs for an EST only depend on the key of the EST
+    (see read_ests), on the genomic sequence, on the options and on the program.
+    Each entry, whose key is a hash of the last three, is made of segments
+    added by the runs with that key: the outputs of the ESTs factorized by the
+    run (with the key of each EST as header) and the list of the keys of those
+    ESTs (<id>.ests, created last).  Runs that only need cached ESTs do not
+    execute est-fact at all.  The entries share the directory and the size
+    limit of the cache of the results.
+
+    Only the factorizations are cached, not the index of the genomic sequence:
+    a run with new ESTs, or with other est-fact arguments (e.g., a sweep of its
+    parameters), still builds the index.
+    """
+
+    OUTPUTS = ('raw-multifasta-out.txt', 'processed-ests.txt')
+
+    def entry_key(self, genomic, arguments, executable, config=None):
+        """Compute the key of the entry of a genomic sequence, est-fact arguments and program."""
+        content = {
+            'genomic': md5Checksum(genomic),
+            'arguments': arguments,
+            'config': md5Checksum(config) if config else None,
+            'program': md5Checksum(executable),
+        }
+        return "fact-" + hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _segments(self, key):
+        return sorted(path[:-len(".ests")]
+                      for path in glob.glob(os.path.join(glob.escape(self._entry_dir(key)), "*.ests")))
+
+    def lookup(self, key):
+        """Return the keys of the ESTs whose factorizations are in the entry."""
+        cached = set()
+        for segment in self._segments(key):
+            with open(segment + ".ests", mode='r', encoding='ascii') as fd:
+                cached.update(line.strip() for line in fd)
+        if cached:
+            os.utime(self._entry_dir(key))
+        return cached
+
+    def outputs(self, key, name):
+        """Return the files of the entry with the outputs name (one of OUTPUTS)."""
+        return [segment + "." + name for segment in self._segments(key)]
+
+    def add(self, key, records, outputs, info):
+        """Add a segment with the outputs of the ESTs records (as returned by read_ests).
+
+        outputs maps each name of OUTPUTS to the list of the files with the
+        outputs of the ESTs (with their headers).  Raise PIntronError (and
+        store nothing) if the segment does not have all the records of the
+        outputs, one for each record.
+        """
+        entry_dir = self._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode='w', encoding='ascii', prefix=".tmp-", suffix=".ests",
+                                         dir=entry_dir, delete=False) as fd:
+            segment = os.path.join(entry_dir, os.path.basename(fd.name)[len(".tmp-"):-len(".ests")])
+            try:
+                representatives = [(est_key.encode('ascii'), header) for (header, lines, est_key) in records]
+                for name in self.OUTPUTS:
+                    written = expand_collapsed_ests(outputs[name], representatives, segment + "." + name)
+                    expected = count_records(outputs[name])
+                    if written != expected:
+                        raise PIntronError("{} records stored in the cache instead of the {} records of "
+                                           "the ESTs in {}".format(written, expected, name))
+                fd.writelines(est_key + "\n" for (header, lines, est_key) in records)
+            except (OSError, PIntronError) as e:
+                for name in self.OUTPUTS:
+                    if os.path.exists(segment + "." + name):
+                        os.remove(segment + "." + name)
+                fd.close()
+                os.remove(fd.name)
+                if isinstance(e, PIntronError):
+                    raise
+                logging.warning("Could not store the factorizations in the cache: %s", e)
+                return
+        info_file = os.path.join(entry_dir, self.INFO_FILE)
+        if not os.path.exists(info_file):
+            with open(info_file, mode='w', encoding='utf-8') as info_fd:
+                info_fd.write(json.dumps(dict(info, key=key, created=time.strftime('%Y-%m-%d %H:%M:%S')),
+                                         sort_keys=True, indent=4))
+        # The segment is complete when its list of ESTs exists
+        os.rename(fd.name, segment + ".ests")
+        logging.debug("Factorizations of %d ESTs stored in the cache with key %s", len(records), key)
+        self.evict()
+
+
+class StageCheckpoints:
+    """Manifests of the stages completed in the work directory of a resumable run.
+
+    The manifest of a stage records the checksums of its input files, its command
+    line (hence its parameters) and the checksums of the executables it runs.  A
+    stage is up to date if its saved manifest matches the current one and its
+    output files are unchanged since the stage completed.  A stage can also save
+    a state for the later attempts with the same manifest.
+
+    Attributes:
+        work_dir  -- directory containing the input/output files and the manifests
+        checksums -- md5 of the executables, keyed by their full path
+    """
+
+    def __init__(self, work_dir, checksums):
+        self.work_dir = work_dir
+        self.checksums = checksums
+
+    def _manifest_file(self, cmd_label):
+        return os.path.join(self.work_dir, cmd_label + ".manifest.json")
+
+    def _file_checksums(self, names):
+        checksums = {}
+        for name in names:
+            path = os.path.join(self.work_dir, name)
+            checksums[name] = md5Checksum(path) if os.path.isfile(path) else None
+        return checksums
+
+    def manifest(self, command, inputs, executables):
+        return {
+            'command': command,
+            'inputs': self._file_checksums(inputs),
+            'executables': {exe: self.checksums.get(exe) for exe in executables},
+        }
+
+    def is_up_to_date(self, cmd_label, manifest, outputs):
+        try:
+            with open(self._manifest_file(cmd_label), mode='r', encoding='utf-8') as fd:
+                saved = json.load(fd)
+        except (OSError, ValueError):
+            return False
+        current_outputs = self._file_checksums(outputs)
+        return (saved.get('stage') == manifest and
+                None not in current_outputs.values() and
+                saved.get('outputs') == current_outputs)
+
+    def invalidate(self, cmd_label):
+        if os.path.exists(self._manifest_file(cmd_label)):
+            os.remove(self._manifest_file(cmd_label))
+
+    def save(self, cmd_label, manifest, outputs):
+        with open(self._manifest_file(cmd_label), mode='w', encoding='utf-8') as fd:
+            fd.write(json.dumps({'stage': manifest, 'outputs': self._file_checksums(outputs)},
+                                sort_keys=True, indent=4))
+
+    def _state_file(self, cmd_label):
+        return os.path.join(self.work_dir, cmd_label + ".state.json")
+
+    def state(self, cmd_label, manifest):
+        """Return the state saved by the stage with the same manifest, None if none."""
+        try:
+            with open(self._state_file(cmd_label), mode='r', encoding='utf-8') as fd:
+                saved = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        # The manifest as read back from JSON (e.g., with lists in place of tuples)
+        return saved.get('state') if saved.get('stage') == json.loads(json.dumps(manifest)) else None
+
+    def save_state(self, cmd_label, manifest, state):
+        """Save the state (e.g., the degradation level reached) of the stage with the manifest."""
+        with open(self._state_file(cmd_label), mode='w', encoding='utf-8') as fd:
+            fd.write(json.dumps({'stage': manifest, 'state': state}, sort_keys=True, indent=4))
+
+
+def read_proc_io():
+    """Return the I/O counters of this process and of its terminated children, None if not available."""
+    try:
+        with open("/proc/self/io", mode='r') as fd:
+            return {key: int(value) for (key, value) in (line.split(':') for line in fd)}
+    except (OSError, ValueError):
+        return None
+
+
+class StageMetrics:
+    """Resources used by the stages of a run.
+
+    Each stage records its wall time, the user/system CPU time and the peak RSS
+    of its processes (from wait4), the bytes read and written (from
+    /proc/self/io, which accumulates the counters of the terminated children)
+    and the sizes of its input and output files.  The stages executed within
+    the driver itself record the CPU time of the driver and its peak RSS so far.
+    The peak RSS of a process is never lower than the RSS of the driver when the
+    process is forked, since Linux keeps the high-water mark across exec.  The
+    jobs of an AsyncLocusPool share the driver: their steps record the CPU time of
+    their own thread only, and neither peak RSS nor I/O counters.
+    """
+
+    IO_COUNTERS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+
+    def __init__(self):
+        self.stages = []
+        self.start = time.time()
+        self.cached = False
+        self.degradation_level = None
+        self.est_fact_shards = None
+
+    @staticmethod
+    def _file_sizes(cwd, names):
+        sizes = {}
+        for name in names:
+            path = os.path.join(cwd, name)
+            if os.path.isfile(path):
+                sizes[name] = os.path.getsize(path)
+        return sizes
+
+    def skip(self, cmd_label):
+        self.stages.append({'stage': cmd_label, 'status': 'skipped'})
+
+    @contextlib.contextmanager
+    def stage(self, cmd_label, cwd, inputs=(), outputs=(), in_process=False):
+        """Measure the stage executed in the with block.
+
+        The block appends to the yielded list the resource usage of the
+        processes of the stage (unless in_process).
+        """
+        record = {'stage': cmd_label, 'status': 'failed', 'start_time': round(time.time(), 3),
+                  'input_files': self._file_sizes(cwd, inputs)}
+        self.stages.append(record)
+        usages = []
+        shared = _controller.get() is not None
+        io_start = read_proc_io() if not shared else None
+        who = resource.RUSAGE_THREAD if shared else resource.RUSAGE_SELF
+        self_start = resource.getrusage(who)
+        start = time.perf_counter()
+        try:
+            yield usages
+            record['status'] = 'ok'
+        finally:
+            record['wall_time'] = round(time.perf_counter() - start, 3)
+            if in_process:
+                self_end = resource.getrusage(who)
+                usages = [self_end] if not shared else []
+                record['user_time'] = round(self_end.ru_utime - self_start.ru_utime, 3)
+                record['system_time'] = round(self_end.ru_stime - self_start.ru_stime, 3)
+            else:
+                record['user_time'] = round(sum(usage.ru_utime for usage in usages), 3)
+                record['system_time'] = round(sum(usage.ru_stime for usage in usages), 3)
+            # ru_maxrss is measured in KiB on Linux
+            record['peak_rss'] = max((usage.ru_maxrss * 1024 for usage in usages), default=None)
+            io_end = read_proc_io()
+            if io_start and io_end:
+                record['io'] = {key: io_end[key] - io_start[key] for key in self.IO_COUNTERS}
+            record['output_files'] = self._file_sizes(cwd, outputs)
+
+    def to_json(self):
+        return {'stages': self.stages,
+                'cached': self.cached,
+                'est_fact_degradation_level': self.degradation_level,
+                'est_fact_shards': self.est_fact_shards,
+                'start_time': round(self.start, 3),
+                'wall_time': round(time.time() - self.start, 3)}
+
+    def write(self, filename):
+        with open(filename, mode='w', encoding='utf-8') as fd:
+            fd.write(json.dumps(self.to_json(), sort_keys=True, indent=4))
+
+    def log_summary(self):
+        logging.info("Resources used by the stages:")
+        logging.info("%-50s %-7s %9s %9s %9s %9s %9s %9s", "stage", "status", "wall_s", "user_s", "sys_s",
+                     "RSS_MiB", "read_MiB", "write_MiB")
+        mib = 1024 * 1024
+        for record in self.stages:
+            if record['status'] == 'skipped':
+                logging.info("%-50s %-7s", record['stage'], record['status'])
+                continue
+            io = record.get('io', {})
+            logging.info("%-50s %-7s %9.2f %9.2f %9.2f %9s %9s %9s", record['stage'], record['status'],
+                         record['wall_time'], record['user_time'], record['system_time'],
+                         "{:.1f}".format(record['peak_rss'] / mib) if record['peak_rss'] else "-",
+                         "{:.1f}".format(io['rchar'] / mib) if io else "-",
+                         "{:.1f}".format(io['wchar'] / mib) if io else "-")
+
+
+# cProfile profiles a single thread at a time (since Python 3.12)
+_cprofile_lock = threading.Lock()
+
+
+class Profiler:
+    """Profile data of the stages of a run, collected in a directory.
+
+    The programs of the pipeline compiled with 'make PROF=yes' write their
+    gprof data to <cmd_label>.gmon.out.<pid> (see environment), which are
+    moved to the directory after each stage.  The steps executed by the
+    driver run under cProfile and their data are saved in <cmd_label>.prof.
+    report() writes pintron-profile-report.txt with the top hotspots of each
+    stage.
+    """
+
+    def __init__(self, directory, top=20):
+        self.directory = os.path.abspath(directory)
+        self.top = top
+        self.stages = []
+        os.makedirs(self.directory, exist_ok=True)
+
+    def environment(self, cmd_label):
+        """Return the environment of the processes of the stage cmd_label."""
+        env = dict(os.environ)
+        env['GMON_OUT_PREFIX'] = cmd_label + ".gmon.out"
+        return env
+
+    def collect(self, cmd_label, cwd, executable):
+        """Move the gprof data written by the stage cmd_label in cwd to the directory."""
+        files = []
+        for path in sorted(glob.glob(os.path.join(cwd, glob.escape(cmd_label) + ".gmon.out*"))):
+            destination = os.path.join(self.directory, os.path.basename(path))
+            shutil.move(path, destination)
+            files.append(destination)
+        if files:
+            self.stages.append({'stage': cmd_label, 'executable': executable, 'gmon': files})
+
+    @contextlib.contextmanager
+    def python(self, cmd_label):
+        """Profile the with block as the stage cmd_label."""
+        with _cprofile_lock:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+        stats_file = os.path.join(self.directory, cmd_label + ".prof")
+        profile.dump_stats(stats_file)
+        self.stages.append({'stage': cmd_label, 'cprofile': stats_file})
+
+    def _gprof_hotspots(self, stage):
+        try:
+            result = subprocess.run(["gprof", "-b", "-p", stage['executable']] + stage['gmon'],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+        except OSError as e:
+            return ["gprof could not be executed: " + str(e)]
+        if result.returncode != 0:
+            return ["gprof failed: " + result.stderr.strip()]
+        with open(os.path.join(self.directory, stage['stage'] + ".gprof.txt"), mode='w', encoding='utf-8') as fd:
+            fd.write(result.stdout)
+        lines = result.stdout.splitlines()
+        # The flat profile is a table whose header starts with ' time'
+        header = next((i for (i, line) in enumerate(lines) if line.lstrip().startswith("time")), 0)
+        return lines[max(header - 1, 0):header + 1 + self.top]
+
+    def _cprofile_hotspots(self, stage):
+        report = io.StringIO()
+        pstats.Stats(stage['cprofile'], stream=report).sort_stats('cumulative').print_stats(self.top)
+        lines = report.getvalue().splitlines()
+        header = next((i for (i, line) in enumerate(lines) if line.lstrip().startswith("ncalls")), 0)
+        return [line for line in lines[header:] if line.strip()]
+
+    def report(self, metrics=None):
+        """Write the report of the hotspots of each stage, and return its name."""
+        wall_times = {record['stage']: record.get('wall_time') for record in (metrics.stages if metrics else [])}
+        report_file = os.path.join(self.directory, "pintron-profile-report.txt")
+        with open(report_file, mode='w', encoding='utf-8') as fd:
+            if not self.stages:
+                fd.write("No profile data: the programs of the pipeline must be compiled with "
+                         "'make PROF=yes' to write their gprof data.\n")
+            for stage in self.stages:
+                title = "Stage " + stage['stage']
+                if wall_times.get(stage['stage']) is not None:
+                    title += " (wall time {:.2f}s)".format(wall_times[stage['stage']])
+                fd.write(title + "\n" + "=" * len(title) + "\n")
+                if 'gmon' in stage:
+                    fd.write("gprof flat profile of {} ({} process(es))\n".format(stage['executable'],
+                                                                              len(stage['gmon'])))
+                    hotspots = self._gprof_hotspots(stage)
+                else:
+                    fd.write("cProfile of the driver, sorted by cumulative time\n")
+                    hotspots = self._cprofile_hotspots(stage)
+                fd.write("\n".join(hotspots) + "\n\n")
+        return report_file
+
+
 def pintron_pipeline(options):
     """Executes the whole pipeline, using the input options.
     """
@@ -840,13 +3332,14 @@ def pintron_pipeline(options):
 
     logging.debug("Using main program 'pintron' in dir '{}' (md5: {})".format(os.path.realpath(os.path.abspath(sys.argv[0])),
                                                                               md5Checksum(sys.argv[0])))
+    checksums = {}
     exes = check_executables(options.bindir, ["est-fact",
                                              "min-factorization",
                                              "intron-agreement",
                                              "compact-compositions",
                                              "maximal-transcripts",
                                              "cds-annotation"
-                                             ])
+                                             ], checksums)
 
     if not os.path.isfile(options.genome_filename) or not os.access(options.genome_filename, os.R_OK):
         raise PIntronIOError(options.genome_filename,
@@ -854,164 +3347,1281 @@ def pintron_pipeline(options):
     if not os.path.isfile(options.EST_filename) or not os.access(options.EST_filename, os.R_OK):
         raise PIntronIOError(options.EST_filename,
                              'Could not read file "' + options.EST_filename + '"!')
-    if (os.access('genomic.txt', os.F_OK) and
-         not os.path.samefile('genomic.txt', options.genome_filename) and
-         not os.access('genomic.txt', os.W_OK) ):
-        raise PIntronIOError('genomic.txt',
-                             'Could not write file "genomic.txt"!')
-    if (os.access('ests.txt', os.F_OK) and
-         not os.path.samefile('ests.txt', options.EST_filename) and
-         not os.access('ests.txt', os.W_OK) ):
-        raise PIntronIOError('ests.txt',
-                             'Could not write file "ests.txt"!')
-
-    if os.path.isfile('genomic.txt') and os.path.samefile('genomic.txt', options.genome_filename):
-        logging.debug('Files "%s" and "genomic.txt" refer to the same file: skip copy.',
-                      options.genome_filename)
+
+    metrics = StageMetrics()
+    profiler = Profiler(options.profile_dir, options.profile_top) if options.profile_dir else None
+    try:
+        cache = None
+        if options.cache_dir:
+            cache = ResultCache(options.cache_dir, options.cache_size_limit * 1024 * 1024)
+            cache_key = cache.key(options, checksums)
+            if cache.retrieve(cache_key, output_files(options)):
+                logging.info("Results found in the cache (key %s): all the stages are skipped.", cache_key)
+                metrics.cached = True
+            else:
+                execute_stages(options, exes, checksums, cache, cache_key, metrics, profiler)
+        else:
+            execute_stages(options, exes, checksums, metrics=metrics, profiler=profiler)
+    finally:
+        if metrics.stages:
+            metrics.log_summary()
+        if options.metrics_filename:
+            metrics.write(options.metrics_filename)
+        if profiler:
+            logging.info("Profiling report saved in %s", profiler.report(metrics))
+
+
+def output_files(options):
+    """Map the name of each result of the pipeline in the scratch directory to its destination."""
+    outputs = {"pintron-full-output.json": options.output_filename}
+    if options.gtf_filename:
+        outputs["pintron-output.gtf"] = options.gtf_filename
+    if options.cds_gtf_filename:
+        outputs["pintron-cds-output.gtf"] = options.cds_gtf_filename
+    if options.gff3_filename:
+        outputs["pintron-output.gff3"] = options.gff3_filename
+    if options.bed_filename:
+        outputs["pintron-output.bed"] = options.bed_filename
+    compression = compression_of(options)
+    outputs = {name: compressed_name(destination, compression) for (name, destination) in outputs.items()}
+    if options.bundle_filename:
+        outputs["pintron-output.bundle"] = options.bundle_filename
+    return outputs
+
+
+def execute_stages(options, exes, checksums, cache=None, cache_key=None, metrics=None, profiler=None):
+    """Executes all the stages of the pipeline in a scratch directory.
+
+    The results are moved to their final destination and, if a result cache is
+    given, they are also stored in the cache under cache_key.  The resources
+    used by the stages are recorded in metrics and, if a profiler is given,
+    their profile data are collected by the profiler.
+    """
+    if metrics is None:
+        metrics = StageMetrics()
+    compression = compression_of(options)
+    plogfile = compressed_name(os.path.abspath(options.plogfile), compression)
+    work_dir_name = None
+    if options.resume:
+        # The work directory of a resumable run only depends on its output
+        work_dir_name = "pintron-work-" + hashlib.md5(
+            os.path.abspath(options.output_filename).encode('utf-8')).hexdigest()[:12]
+    with ScratchDir(options.scratch_dir or options.work_dir, options.scratch_size_limit * 1024 * 1024,
+                    keep_on_failure=options.no_clean, name=work_dir_name) as scratch, \
+         CompressedLog(plogfile, compression) as plog:
+
+        checkpoints = StageCheckpoints(scratch.path, checksums) if options.resume else None
+        timeout = options.stage_timeout * 60 if options.stage_timeout else None
+
+        def checkpointed(run, cmd_label, command, inputs, outputs, executables):
+            if checkpoints:
+                manifest = checkpoints.manifest(command, inputs, executables)
+                if checkpoints.is_up_to_date(cmd_label, manifest, outputs):
+                    logging.info("Stage '%s' is up to date: skipped.", cmd_label)
+                    metrics.skip(cmd_label)
+                    return
+                checkpoints.invalidate(cmd_label)
+            with metrics.stage(cmd_label, scratch.path, inputs, outputs) as usages:
+                try:
+                    usages.extend(run())
+                except PIntronStageError as error:
+                    # The failed stage records the resources used by its program
+                    if error.usage:
+                        usages.append(error.usage)
+                    raise
+            scratch.check_size()
+            if checkpoints:
+                checkpoints.save(cmd_label, manifest, outputs)
+
+        def profiled(run, stages):
+            # stages lists the label and the executable of each program run by run()
+            if not profiler:
+                return run()
+            try:
+                return run()
+            finally:
+                for (cmd_label, executable) in stages:
+                    profiler.collect(cmd_label, scratch.path, executable)
+
+        def run_stage(command, cmd_label, inputs=(), outputs=(), executables=(), stdin=None, stdout=None,
+                      limits=None, **kwargs):
+            env = profiler.environment(cmd_label) if profiler and executables else None
+            checkpointed(lambda: profiled(lambda: [exec_system_command(command=command,
+                                                                       cmd_label=cmd_label,
+                                                                       logfile=plog.stream,
+                                                                       cwd=scratch.path, env=env,
+                                                                       stdin=stdin, stdout=stdout,
+                                                                       limits=limits, timeout=timeout,
+                                                                       **kwargs)],
+                                          [(cmd_label, executable) for executable in executables]),
+                         cmd_label, describe_command(command, stdin, stdout), inputs, outputs, executables)
+
+        def stage_input(source, destination, cmd_label, hardlink=True):
+            def run():
+                try:
+                    method = stage_file(source, scratch.file(destination), hardlink)
+                except OSError as e:
+                    raise PIntronIOError(source, 'Could not prepare the file "' + destination + '": ' + str(e))
+                logging.debug("Staged '%s' as '%s' (%s)", source, destination, method)
+                return []
+            checkpointed(run, cmd_label, "stage " + shlex.quote(source) + " " + shlex.quote(destination),
+                         [source], [destination], [])
+
+        def run_sharded_est_fact(command, shards, limits, cmd_label, inputs, outputs, error_comment,
+                                 factorization_key=None):
+            # est-fact reads and writes fixed file names in its working directory,
+            # hence each shard of the ESTs is factorized in its own subdirectory.
+            # Each EST is factorized on its own and the outputs follow the order of
+            # the ESTs, so the concatenation of the outputs of the shards is
+            # exactly the output of a single process.  When the identical ESTs are
+            # collapsed, or their factorizations are found in the cache, the
+            # outputs of each factorized (or cached) EST are replicated for all
+            # the ESTs with its key, in the order of ests.txt.
+            env = profiler.environment(cmd_label) if profiler else None
+            if env:
+                # The profile data of all the shards are collected from the scratch directory
+                env['GMON_OUT_PREFIX'] = scratch.file(env['GMON_OUT_PREFIX'])
+
+            def run_shard(shard_dir, cancel):
+                shard_limits = limits
+                if options.adaptive_limits:
+                    shard_limits = est_fact_limits(options, genomic_length,
+                                                   *sequence_statistics(os.path.join(shard_dir, 'ests.txt')))
+                return exec_system_command(command=command, error_comment=error_comment,
+                                           logfile=plog.stream, cmd_label=cmd_label,
+                                           output_file=outputs[0], cwd=shard_dir, env=env,
+                                           limits=shard_limits, timeout=timeout, cancel=cancel)
+
+            def run():
+                ests = scratch.file('ests.txt')
+                collapsed = None
+                number_of_shards = shards
+                if options.collapse_duplicate_ests or factorization_key:
+                    records = read_ests(ests)
+                    cached = factorization_cache.lookup(factorization_key) if factorization_key else set()
+                    collapsed = collapse_duplicate_ests(records, cached)
+                if collapsed is not None:
+                    (representatives, unique) = collapsed
+                    ests = scratch.file('unique-ests.txt')
+                    with open(ests, 'wb') as fd:
+                        for (header, lines, key) in unique:
+                            fd.writelines(lines)
+                    logging.info("Factorizing %d unique ESTs out of %d (%d found in the cache)",
+                                 len(unique), len(records), sum(1 for (header, lines, key) in records if key in cached))
+                    # If all the ESTs are cached, est-fact is not executed at all
+                    number_of_shards = min(shards, len(unique))
+                shard_dirs = [scratch.file("{}-shard-{:03d}".format(cmd_label, i)) for i in range(number_of_shards)]
+                for shard_dir in shard_dirs:
+                    shutil.rmtree(shard_dir, ignore_errors=True)
+                    os.makedirs(shard_dir)
+                    stage_file(scratch.file('genomic.txt'), os.path.join(shard_dir, 'genomic.txt'))
+                split_fasta(ests, [os.path.join(shard_dir, 'ests.txt') for shard_dir in shard_dirs])
+                usages = []
+                if shard_dirs:
+                    # The first failed shard kills the others, which would only delay its error
+                    # (and the retry at the next degradation level)
+                    cancel = threading.Event()
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shard_dirs)) as executor:
+                        # The shards are part of the job (if any) of this thread
+                        futures = [executor.submit(contextvars.copy_context().run, run_shard, shard_dir, cancel)
+                                   for shard_dir in shard_dirs]
+                        try:
+                            (done, pending) = concurrent.futures.wait(
+                                futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+                        except BaseException:
+                            cancel.set()
+                            raise
+                        failed = [future for future in futures if future in done and future.exception()]
+                        if failed:
+                            cancel.set()
+                    # The error of the first failed shard (if any) is raised here
+                    usages = [future.result() for future in failed + futures]
+                shard_outputs = {name: [os.path.join(shard_dir, name) for shard_dir in shard_dirs]
+                                 for name in outputs}
+                for name in outputs:
+                    if collapsed is not None:
+                        cached_outputs = factorization_cache.outputs(factorization_key, name) if cached else []
+                        expand_collapsed_ests(cached_outputs + shard_outputs[name], representatives,
+                                              scratch.file(name), [key.encode('ascii') for key in cached])
+                        continue
+                    with open(scratch.file(name), 'wb') as output:
+                        for shard_output in shard_outputs[name]:
+                            with open(shard_output, 'rb') as fd:
+                                shutil.copyfileobj(fd, output)
+                if factorization_key and collapsed is not None and unique:
+                    factorization_cache.add(factorization_key, unique, shard_outputs,
+                                            {'gene': options.gene,
+                                             'organism': options.organism,
+                                             'genomic': os.path.abspath(options.genome_filename)})
+                for shard_dir in shard_dirs:
+                    shutil.rmtree(shard_dir)
+                if collapsed is not None:
+                    os.remove(ests)
+                return usages
+
+            checkpointed(lambda: profiled(run, [(cmd_label, command[0])]),
+                         cmd_label, describe_command(command), inputs, outputs, [command[0]])
+
+        stage_input(os.path.abspath(options.genome_filename), 'genomic.txt', 'cmd-1a-copy-genomic')
+        stage_input(os.path.abspath(options.EST_filename), 'ests.txt', 'cmd-1b-copy-ests')
+
+        # Compute factorizations
+        logging.info("STEP  2:  Pre-aligning transcript data...")
+
+        # est-fact looks for its configuration file in the working directory
+        est_fact_args = []
+        est_fact_inputs = ['genomic.txt', 'ests.txt']
+        est_fact_config = None
+        if os.path.isfile(os.path.join(options.work_dir, "config.ini")):
+            est_fact_config = os.path.abspath(os.path.join(options.work_dir, "config.ini"))
+            est_fact_args = ["--config-file=" + est_fact_config]
+            est_fact_inputs.append(est_fact_config)
+        # The factorizations of the ESTs on each genomic sequence are cached with the results
+        factorization_cache = None
+        if options.cache_dir:
+            factorization_cache = FactorizationCache(options.cache_dir, options.cache_size_limit * 1024 * 1024)
+        limits = est_fact_limits(options)
+        shards = 1
+        if options.adaptive_limits or options.est_fact_shards != 1:
+            genomic_length = sequence_statistics(scratch.file('genomic.txt'))[1]
+            (number_of_ests, ests_length) = sequence_statistics(scratch.file('ests.txt'))
+            shards = est_fact_shards(options, genomic_length, number_of_ests, ests_length)
+        if options.adaptive_limits:
+            limits = est_fact_limits(options, genomic_length, number_of_ests, ests_length)
+            logging.info("Limits of the factorization step: %ds, %.0f MiB "
+                         "(%d nt of genomic sequence, %d ESTs of %d nt)",
+                         limits[resource.RLIMIT_CPU], limits[resource.RLIMIT_AS] / (1024 * 1024),
+                         genomic_length, number_of_ests, ests_length)
+        if shards > 1:
+            logging.info("Factorizing the ESTs in %d parallel shards", shards)
+        metrics.est_fact_shards = shards
+        degradation_level = 0
+        if checkpoints:
+            # A resumed run starts from the degradation level reached by the previous attempts
+            degradation_manifest = checkpoints.manifest([[exes["est-fact"]] + est_fact_args, sorted(limits.items())],
+                                                        est_fact_inputs, [exes["est-fact"]])
+            degradation_level = min(checkpoints.state('cmd-2-est-fact', degradation_manifest) or 0,
+                                    options.max_degradation_level)
+            if degradation_level:
+                logging.info("Resuming the factorization step at degradation level %d", degradation_level)
+        while True:
+            command = [exes["est-fact"]] + est_fact_args + EST_FACT_DEGRADATION_LEVELS[degradation_level]
+            try:
+                if shards > 1 or options.collapse_duplicate_ests or factorization_cache:
+                    run_sharded_est_fact(
+                        command=command,
+                        shards=shards,
+                        limits=limits,
+                        cmd_label='cmd-2-est-fact',
+                        inputs=est_fact_inputs,
+                        outputs=['raw-multifasta-out.txt', 'processed-ests.txt'],
+                        error_comment="Could not compute the factorizations",
+                        factorization_key=factorization_cache.entry_key(
+                            scratch.file('genomic.txt'), EST_FACT_DEGRADATION_LEVELS[degradation_level],
+                            exes["est-fact"], est_fact_config) if factorization_cache else None)
+                else:
+                    run_stage(
+                        command=command,
+                        limits=limits,
+                        error_comment="Could not compute the factorizations",
+                        cmd_label='cmd-2-est-fact',
+                        output_file='raw-multifasta-out.txt',
+                        inputs=est_fact_inputs,
+                        outputs=['raw-multifasta-out.txt', 'processed-ests.txt'],
+                        executables=[exes["est-fact"]])
+                break
+            except PIntronStageError as error:
+                # Each shard may have its own limits (see run_shard)
+                exceeded = limit_exceeded(error)
+                if (exceeded is None or degradation_level >= options.max_degradation_level or
+                        degradation_level + 1 >= len(EST_FACT_DEGRADATION_LEVELS)):
+                    raise
+                degradation_level += 1
+                if checkpoints:
+                    checkpoints.save_state('cmd-2-est-fact', degradation_manifest, degradation_level)
+                logging.warning("The factorization step exceeded its %s limit: retrying with %s "
+                                "(degradation level %d)", exceeded,
+                                " ".join(EST_FACT_DEGRADATION_LEVELS[degradation_level]), degradation_level)
+        metrics.degradation_level = degradation_level
+
+        # Min factorization agreement
+        logging.info("STEP  3:  Computing a raw consensus gene structure...")
+
+        run_stage(
+            command=[exes["min-factorization"]],
+            stdin='raw-multifasta-out.txt',
+            stdout='out-agree.txt',
+            limits={resource.RLIMIT_CPU: options.max_exon_agreement_time * 60},
+            error_comment="Could not minimize the factorizations",
+            cmd_label='cmd-3-min-factorization',
+            output_file='out-agree.txt',
+            inputs=['raw-multifasta-out.txt'],
+            outputs=['out-agree.txt'],
+            executables=[exes["min-factorization"]])
+
+        # Intron prediction
+        logging.info("STEP  4:  Predicting introns...")
+
+        run_stage(
+            command=[exes["intron-agreement"]],
+            limits={resource.RLIMIT_CPU: options.max_intron_agreement_time * 60},
+            error_comment="Could not compute the factorizations",
+            cmd_label='cmd-4-intron-agreement',
+            output_file='out-after-intron-agree.txt',
+            inputs=['genomic.txt', 'processed-ests.txt', 'out-agree.txt'],
+            outputs=['out-after-intron-agree.txt', 'predicted-introns.txt'],
+            executables=[exes["intron-agreement"]])
+
+        # The computation of the full-length isoforms should not be avoided
+        # if options.step1:
+        #     sys.exit(0)
+
+        # Transform compositions into exons
+        logging.info("STEP  5:  Computing the final transcript alignments...")
+
+        compact_compositions = {
+            'command': [exes["compact-compositions"]],
+            'error_comment': "Could not transform factorizations into exons",
+            'cmd_label': 'cmd-5-compact-compositions',
+            'tee': 'build-ests.txt',
+        }
+        maximal_transcripts = {
+            'command': [exes["maximal-transcripts"]],
+            'error_comment': "Could not compute maximal transcripts",
+            'cmd_label': 'cmd-6a-maximal-transcripts',
+        }
+        if options.pipe_stages:
+            # Compute maximal transcripts while the exons are computed
+            logging.info("STEP  6:  Computing the final full-length isoforms...")
+
+            if profiler:
+                for (stage, executable) in ((compact_compositions, exes["compact-compositions"]),
+                                            (maximal_transcripts, exes["maximal-transcripts"])):
+                    stage['env'] = profiler.environment(stage['cmd_label'])
+                    stage['executable'] = executable
+            checkpointed(lambda: profiled(lambda: exec_piped_commands([compact_compositions, maximal_transcripts],
+                                                                      logfile=plog.stream,
+                                                                      input_file='out-after-intron-agree.txt',
+                                                                      cwd=scratch.path,
+                                                                      keep_intermediate=options.no_clean,
+                                                                      timeout=timeout),
+                                          [(stage['cmd_label'], stage.get('executable'))
+                                           for stage in (compact_compositions, maximal_transcripts)]),
+                         cmd_label='cmd-5-6a-compact-compositions-maximal-transcripts',
+                         command=describe_command(compact_compositions['command']) + " | " +
+                         describe_command(maximal_transcripts['command']),
+                         inputs=['out-after-intron-agree.txt', 'genomic.txt', 'predicted-introns.txt'],
+                         outputs=['genomic-exonforCCDS.txt', 'TRANSCRIPTS1_1.txt'],
+                         executables=[exes["compact-compositions"], exes["maximal-transcripts"]])
+        else:
+            run_stage(
+                command=compact_compositions['command'],
+                stdin='out-after-intron-agree.txt',
+                stdout='build-ests.txt',
+                error_comment=compact_compositions['error_comment'],
+                cmd_label=compact_compositions['cmd_label'],
+                output_file='build-ests.txt',
+                inputs=['out-after-intron-agree.txt', 'genomic.txt'],
+                outputs=['build-ests.txt', 'genomic-exonforCCDS.txt'],
+                executables=[exes["compact-compositions"]])
+
+            # Compute maximal transcripts
+            logging.info("STEP  6:  Computing the final full-length isoforms...")
+
+            run_stage(
+                command=maximal_transcripts['command'],
+                stdin='build-ests.txt',
+                error_comment=maximal_transcripts['error_comment'],
+                cmd_label=maximal_transcripts['cmd_label'],
+                output_file='CCDS_transcripts.txt',
+                inputs=['build-ests.txt', 'predicted-introns.txt'],
+                outputs=['TRANSCRIPTS1_1.txt'],
+                executables=[exes["maximal-transcripts"]])
+        # TRANSCRIPTS1_1.txt is rewritten if maximal-transcripts is executed again
+        stage_input(scratch.file('TRANSCRIPTS1_1.txt'), 'isoforms.txt', 'cmd-6b-copy-maximal-transcripts',
+                    hardlink=False)
+
+        # Annotate CDS
+        logging.info("STEP  7:  Annotating CDS...")
+
+        run_stage(
+            command=[exes["cds-annotation"], "./", "./", options.gene, options.organism],
+            error_comment="Could not annotate the CDSs",
+            cmd_label='cmd-7-cds-annotation',
+            output_file='CCDS_transcripts.txt',
+            inputs=['isoforms.txt', 'predicted-introns.txt', 'genomic-exonforCCDS.txt', 'genomic.txt'],
+            outputs=['CCDS_transcripts.txt', 'VariantGTF.txt'],
+            executables=[exes["cds-annotation"]])
+
+        # TODO: Transcripts browser
+        # Output the desired file
+        logging.info("STEP  8:  Saving outputs...")
+
+        results = output_files(options)
+        with metrics.stage('step-8-save-outputs', scratch.path,
+                           inputs=['CCDS_transcripts.txt', 'VariantGTF.txt', 'genomic.txt',
+                                   'out-after-intron-agree.txt', 'predicted-introns.txt'],
+                           outputs=list(results), in_process=True), \
+             (profiler.python('step-8-save-outputs') if profiler else contextlib.nullcontext()):
+            gene = build_gene(ccds_file=scratch.file("CCDS_transcripts.txt"),
+                              variant_file=scratch.file("VariantGTF.txt"),
+                              pas_tolerance=options.pas_tolerance,
+                              genomic_seq=scratch.file("genomic.txt"),
+                              factorization_file=scratch.file("out-after-intron-agree.txt"),
+                              introns_file=scratch.file("predicted-introns.txt"))
+            exports = {'gtf_all_isoforms': not options.only_cds_annot}
+            if options.gtf_filename:
+                exports['gtf_file'] = scratch.file("pintron-output.gtf")
+            if options.cds_gtf_filename:
+                exports['cds_gtf_file'] = scratch.file("pintron-cds-output.gtf")
+            if options.gff3_filename:
+                exports['gff3_file'] = scratch.file("pintron-output.gff3")
+            if options.bed_filename:
+                exports['bed_file'] = scratch.file("pintron-output.bed")
+            if options.bundle_filename:
+                exports['bundle_file'] = scratch.file("pintron-output.bundle")
+            gene['est_fact_degradation_level'] = degradation_level
+            export_gene(gene, options.gene, json_file=scratch.file("pintron-full-output.json"),
+                        json_format=options.json_format, compression=compression, **exports)
+            del gene
+        scratch.check_size()
+
+        # Clean mess
+        logging.info("STEP 10:  Finalizing...")
+
+        # With --adaptive-limits, the limits of est-fact also depend on its shards,
+        # hence on the memory available: a degraded result is not reused
+        if cache and not (options.adaptive_limits and degradation_level > 0):
+            cache.store(cache_key, {name: scratch.file(name) for name in results},
+                        {'gene': options.gene,
+                         'organism': options.organism,
+                         'genomic': os.path.abspath(options.genome_filename),
+                         'ests': os.path.abspath(options.EST_filename)})
+        for (name, destination) in results.items():
+            scratch.move_out(name, destination)
+        if options.no_clean and not options.resume:
+            scratch.move_all_out(options.work_dir)
+
+
+def read_batch_manifest(manifest, options):
+    """Read the list of loci of a batch run.
+
+    Each non-empty line of the manifest that does not start with '#' contains the
+    genomic file, the EST file and, optionally, the gene and the organism,
+    separated by tabs.  Relative paths are resolved w.r.t. the manifest directory.
+    """
+    if not os.path.isfile(manifest) or not os.access(manifest, os.R_OK):
+        raise PIntronIOError(manifest, 'Could not read file "' + manifest + '"!')
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    loci = []
+    with open(manifest, mode='r', encoding='utf-8', newline='') as fd:
+        for row in csv.reader(fd, delimiter='\t'):
+            if not row or not row[0].strip() or row[0].lstrip().startswith('#'):
+                continue
+            if len(row) < 2:
+                raise PIntronIOError(manifest, "Could not parse manifest line: " + "\t".join(row))
+            row = [field.strip() for field in row] + ["", ""]
+            loci.append({
+                'index': len(loci) + 1,
+                'genomic': os.path.join(base_dir, os.path.expanduser(row[0])),
+                'ests': os.path.join(base_dir, os.path.expanduser(row[1])),
+                'gene': row[2] if row[2] else options.gene,
+                'organism': row[3] if row[3] else options.organism,
+            })
+    return loci
+
+
+def available_memory():
+    """Return the memory (in bytes) available for new processes on this node."""
+    try:
+        with open("/proc/meminfo", mode='r') as fd:
+            for line in fd:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _solve(matrix, vector):
+    """Solve a small linear system by Gaussian elimination, None if it is singular."""
+    n = len(vector)
+    rows = [list(row) + [value] for (row, value) in zip(matrix, vector)]
+    for column in range(n):
+        pivot = max(range(column, n), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-12 * max(1.0, max(abs(x) for row in rows for x in row[:n])):
+            return None
+        (rows[column], rows[pivot]) = (rows[pivot], rows[column])
+        for row in range(n):
+            if row != column:
+                factor = rows[row][column] / rows[column][column]
+                rows[row] = [x - factor * y for (x, y) in zip(rows[row], rows[column])]
+    return [rows[i][n] / rows[i][i] for i in range(n)]
+
+
+class CostModel:
+    """Model of the wall time and of the peak memory of the pipeline on a locus.
+
+    The cost of a locus is predicted from the length g of its genomic
+    sequence and the number n and the total length e of its ESTs:
+        wall time   = t0 + t1 * n + t2 * n * g
+        peak memory = m0 + m1 * g + m2 * e
+    The coefficients are fitted by least squares on the samples measured on
+    the past loci (saved in filename).  Until MIN_SAMPLES samples are
+    available, the rule of thumb of the resources of est-fact is used.
+    """
+
+    MIN_SAMPLES = 8
+    MAX_SAMPLES = 2000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.samples = []
+        try:
+            with open(filename, mode='r', encoding='utf-8') as fd:
+                self.samples = json.load(fd)['samples']
+        except (OSError, ValueError, KeyError):
+            pass
+        self._fit()
+
+    @staticmethod
+    def _time_features(sample):
+        return [1.0, sample['number_of_ests'], sample['number_of_ests'] * sample['genomic_length']]
+
+    @staticmethod
+    def _memory_features(sample):
+        return [1.0, sample['genomic_length'], sample['ests_length']]
+
+    def _least_squares(self, features, target):
+        xs = [features(sample) for sample in self.samples]
+        ys = [sample[target] for sample in self.samples]
+        # Scale the features, whose magnitudes differ by orders of magnitude
+        scales = [max(abs(x[i]) for x in xs) or 1.0 for i in range(len(xs[0]))]
+        xs = [[value / scale for (value, scale) in zip(x, scales)] for x in xs]
+        normal = [[sum(x[i] * x[j] for x in xs) for j in range(len(scales))] for i in range(len(scales))]
+        coefficients = _solve(normal, [sum(x[i] * y for (x, y) in zip(xs, ys)) for i in range(len(scales))])
+        return [c / scale for (c, scale) in zip(coefficients, scales)] if coefficients else None
+
+    def _fit(self):
+        self.time_coefficients = None
+        self.memory_coefficients = None
+        if len(self.samples) >= self.MIN_SAMPLES:
+            self.time_coefficients = self._least_squares(self._time_features, 'wall_time')
+            self.memory_coefficients = self._least_squares(self._memory_features, 'peak_rss')
+
+    def predict(self, genomic_length, number_of_ests, ests_length):
+        """Return the predicted wall time (in seconds) and peak memory (in bytes) of a locus."""
+        sample = {'genomic_length': genomic_length, 'number_of_ests': number_of_ests, 'ests_length': ests_length}
+        (seconds, memory) = estimate_est_fact_resources(genomic_length, number_of_ests, ests_length)
+        if self.time_coefficients:
+            seconds = sum(c * x for (c, x) in zip(self.time_coefficients, self._time_features(sample)))
+        if self.memory_coefficients:
+            memory = sum(c * x for (c, x) in zip(self.memory_coefficients, self._memory_features(sample)))
+        # A fitted model can extrapolate badly: the measures are never below the base costs
+        return (max(seconds, 1.0), max(memory, EST_FACT_BASE_MEMORY / 4))
+
+    def add(self, genomic_length, number_of_ests, ests_length, wall_time, peak_rss):
+        self.samples.append({'genomic_length': genomic_length, 'number_of_ests': number_of_ests,
+                             'ests_length': ests_length, 'wall_time': wall_time, 'peak_rss': peak_rss})
+        del self.samples[:-self.MAX_SAMPLES]
+        self._fit()
+
+    def save(self):
+        with open(self.filename + ".tmp", mode='w', encoding='utf-8') as fd:
+            fd.write(json.dumps({'samples': self.samples,
+                                 'time_coefficients': self.time_coefficients,
+                                 'memory_coefficients': self.memory_coefficients},
+                                sort_keys=True, indent=4))
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+def _init_batch_worker(batch_options):
+    global options, pintron_version
+    options = batch_options
+    pintron_version = batch_options.version
+    # The worker may be forked while another thread of the parent holds the lock of
+    # a stream (e.g., while logging): never flush or write the inherited streams
+    root = logging.getLogger('')
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    sys.stdout = open(sys.stdout.fileno(), mode='w', closefd=False, encoding=sys.stdout.encoding)
+    sys.stderr = open(sys.stderr.fileno(), mode='w', closefd=False, encoding=sys.stderr.encoding)
+
+
+def _run_worker(connection, options, func, args):
+    _init_batch_worker(options)
+    try:
+        result = (True, func(*args))
+    except BaseException as err:
+        # e.g., KeyboardInterrupt when the pool is terminated
+        result = (False, "".join(traceback.format_exception_only(type(err), err)).strip())
+    connection.send(result)
+    connection.close()
+
+
+class WorkerPool:
+    """Pool executing each locus of a batch (or job of the service) in a new worker process.
+
+    It has the interface of the multiprocessing pool that it replaces (apply_async
+    with callbacks, and termination when leaving the with block).  Each worker
+    is forked for a single task, and is monitored by a thread of the pool: a
+    worker that terminates without a result (e.g., killed by the OOM killer)
+    fails its task, while multiprocessing.Pool would never complete it.
+    """
+
+    # Seconds given to the workers to stop their programs when the pool is terminated
+    TERMINATION_TIMEOUT = 10
+
+    def __init__(self, options):
+        self.options = options
+        self.workers = set()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.terminate()
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        """Execute func(*args) in a new worker, passing its result to callback or its error to error_callback."""
+        (reader, writer) = multiprocessing.Pipe(duplex=False)
+        worker = multiprocessing.Process(target=_run_worker, args=(writer, self.options, func, args), daemon=True)
+        with self.lock:
+            worker.start()
+            self.workers.add(worker)
+        writer.close()
+        threading.Thread(target=self._monitor, args=(worker, reader, callback, error_callback),
+                         daemon=True).start()
+
+    def _monitor(self, worker, reader, callback, error_callback):
+        try:
+            (ok, result) = reader.recv()
+        except EOFError:
+            (ok, result) = (False, None)
+        reader.close()
+        worker.join()
+        with self.lock:
+            self.workers.discard(worker)
+        if ok:
+            if callback:
+                callback(result)
+        elif error_callback:
+            if result is None:
+                result = "the worker process terminated with exit status {}".format(worker.exitcode)
+            error_callback(PIntronError(result))
+
+    def terminate(self):
+        """Interrupt the workers (they kill their programs) and wait for them, killing the late ones."""
+        with self.lock:
+            workers = list(self.workers)
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGINT)
+        deadline = time.time() + self.TERMINATION_TIMEOUT
+        for worker in workers:
+            worker.join(max(0, deadline - time.time()))
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+
+
+def make_paths_absolute(options):
+    """Make the paths shared by all the loci independent of the work directory of each locus."""
+    sys.argv[0] = os.path.abspath(sys.argv[0])
+    if options.bindir:
+        options.bindir = os.path.abspath(os.path.expanduser(options.bindir))
+    if options.scratch_dir:
+        options.scratch_dir = os.path.abspath(os.path.expanduser(options.scratch_dir))
+    if options.cache_dir:
+        options.cache_dir = os.path.abspath(os.path.expanduser(options.cache_dir))
+    if options.serve_input_dir:
+        options.serve_input_dir = os.path.abspath(os.path.expanduser(options.serve_input_dir))
+
+
+def run_batch_locus(locus, options):
+    """Run the pipeline on a single locus of a batch, inside its own work directory.
+
+    In a worker process the work directory becomes the current directory; the
+    jobs of an AsyncLocusPool share the current directory (and the loggers) of
+    the controller, hence the paths of the locus are made absolute and its
+    messages are saved to its log by a handler of its own.
+    Never raises: the outcome is reported in the returned status record.
+    """
+    status = {
+        'index': locus['index'],
+        'gene': locus['gene'],
+        'organism': locus['organism'],
+        'genomic': locus['genomic'],
+        'ests': locus['ests'],
+        'work_dir': locus['work_dir'],
+        'status': 'failed',
+    }
+    start = time.time()
+    controller = _controller.get()
+    job_log = None
+    try:
+        os.makedirs(locus['work_dir'], exist_ok=True)
+        locus_options = copy.copy(options)
+        locus_options.genome_filename = locus['genomic']
+        locus_options.EST_filename = locus['ests']
+        locus_options.gene = locus['gene']
+        locus_options.organism = locus['organism']
+        locus_options.work_dir = locus['work_dir']
+        for field in ('output_filename', 'gtf_filename', 'cds_gtf_filename', 'gff3_filename', 'bed_filename',
+                      'bundle_filename', 'metrics_filename', 'profile_dir', 'plogfile', 'glogfile'):
+            value = getattr(locus_options, field)
+            if value:
+                setattr(locus_options, field, os.path.join(locus['work_dir'], os.path.basename(value)))
+        if controller:
+            job_log = controller.open_job_log(locus_options)
+        else:
+            os.chdir(locus['work_dir'])
+            prepare_loggers(locus_options, console_level=logging.WARNING)
+        pintron_pipeline(locus_options)
+        status['status'] = 'ok'
+        compression = compression_of(locus_options)
+        status['output'] = compressed_name(locus_options.output_filename, compression)
+        for (key, field) in (('gtf', 'gtf_filename'), ('cds_gtf', 'cds_gtf_filename'),
+                             ('gff3', 'gff3_filename'), ('bed', 'bed_filename')):
+            if getattr(locus_options, field):
+                status[key] = compressed_name(getattr(locus_options, field), compression)
+        if locus_options.bundle_filename:
+            status['bundle'] = locus_options.bundle_filename
+        if locus_options.metrics_filename:
+            status['metrics'] = locus_options.metrics_filename
+    except PIntronError as err:
+        logging.exception("*** Fatal error caught during the execution of the pipeline! ***\n"
+                          "%s", err)
+        status['error'] = str(err)
+    except Exception as err:
+        logging.exception("*** Unexpected error caught during the execution of the pipeline! ***")
+        status['error'] = "".join(traceback.format_exception_only(type(err), err)).strip()
+    if job_log:
+        controller.close_job_log(job_log)
+    status['wall_time'] = round(time.time() - start, 3)
+    return status
+
+
+class JobLogFilter(logging.Filter):
+    """Filter passing the messages of a job of an AsyncLocusPool and those of the other jobs at level or higher.
+
+    The job None stands for the messages logged outside of the jobs.
+    """
+
+    def __init__(self, job, level=logging.CRITICAL + 1):
+        super().__init__()
+        self.job = job
+        self.level = level
+
+    def filter(self, record):
+        return _job.get() == self.job or record.levelno >= self.level
+
+
+class AsyncLocusPool:
+    """Pool executing the loci of a batch as concurrent jobs of this process.
+
+    It has the interface of the multiprocessing pool used by pintron_batch
+    (apply_async with callbacks, and termination when leaving the with block).
+    Each job executes the Python code of its pipeline in a thread of its own,
+    while the programs of its stages are waited for by an asyncio event loop,
+    which also copies their standard error to the pipeline log of the job and
+    kills them on timeout or when the pool is terminated.  Since the programs
+    release the GIL, the post-processing of a locus overlaps with the programs
+    of the other loci, and a single controller can keep all the processors busy.
+
+    The processes are waited for as in any other run (see wait_processes), but by
+    the loop of the pool.
+    """
+
+    def __init__(self, processes):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=processes,
+                                                              thread_name_prefix="pintron-job")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="pintron-controller", daemon=True)
+        self.thread.start()
+        self.job_ids = itertools.count(1)
+        self.running = set()
+        self.terminating = False
+        # The loggers of the controller only receive the warnings and the errors of the jobs
+        self.log_filter = JobLogFilter(None, logging.WARNING)
+        self.handlers = logging.getLogger('').handlers[:]
+        for handler in self.handlers:
+            handler.addFilter(self.log_filter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.terminate()
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        """Execute func(*args) as a new job, passing its result to callback or its exception to error_callback."""
+        job = next(self.job_ids)
+
+        def run():
+            _controller.set(self)
+            _job.set(job)
+            return func(*args)
+
+        async def execute():
+            try:
+                # Each job has its own copy of the context variables
+                result = await self.loop.run_in_executor(self.executor, contextvars.copy_context().run, run)
+            except Exception as err:
+                if error_callback:
+                    error_callback(err)
+            else:
+                if callback:
+                    callback(result)
+
+        asyncio.run_coroutine_threadsafe(execute(), self.loop)
+
+    def open_job_log(self, options):
+        """Start saving the messages of the current job to options.glogfile, and return its handler."""
+        handler = log_file_handler(options)
+        handler.addFilter(JobLogFilter(_job.get()))
+        logging.getLogger('').addHandler(handler)
+        return handler
+
+    def close_job_log(self, handler):
+        logging.getLogger('').removeHandler(handler)
+        handler.close()
+
+    def wait_processes(self, processes, logfile, timeout=None, cancel=None):
+        """Implementation of wait_processes for the current job."""
+        return asyncio.run_coroutine_threadsafe(self._wait(processes, logfile, timeout, cancel), self.loop).result()
+
+    async def _wait(self, processes, logfile, timeout, cancel):
+        self.running.update(processes)
+        if self.terminating:
+            for proc in processes:
+                _kill_process(proc)
+        try:
+            result = await _wait_processes(processes, logfile, timeout, lambda: self.terminating, cancel)
+        finally:
+            self.running.difference_update(processes)
+        if self.terminating:
+            raise PIntronError("The execution of the pipeline has been interrupted")
+        return result
+
+    def terminate(self):
+        """Kill the programs of the running jobs, wait for the jobs to end and stop the loop."""
+        def kill():
+            self.terminating = True
+            for proc in self.running:
+                _kill_process(proc)
+
+        async def finish():
+            jobs = asyncio.all_tasks() - {asyncio.current_task()}
+            await asyncio.gather(*jobs, return_exceptions=True)
+
+        self.loop.call_soon_threadsafe(kill)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        asyncio.run_coroutine_threadsafe(finish(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        for handler in self.handlers:
+            handler.removeFilter(self.log_filter)
+
+
+def pintron_batch(options):
+    """Executes the whole pipeline on all the loci listed in the batch manifest.
+
+    The loci are processed by options.jobs worker processes (see WorkerPool) (or jobs of an
+    AsyncLocusPool, with --batch-engine=async), each locus in its own work
+    directory under options.batch_dir.  The loci are started from the
+    one with the longest predicted time, as long as their predicted memory fits in
+    the memory budget; the cost model is refined with the metrics of each locus.
+    A summary with the status and the wall time of each locus is saved in the
+    batch directory.
+    """
+    logging.info("PIntron%s", pintron_version)
+    logging.info("Running: " + " ".join(sys.argv))
+    loci = read_batch_manifest(options.batch_manifest, options)
+    batch_dir = os.path.abspath(options.batch_dir)
+    os.makedirs(batch_dir, exist_ok=True)
+    for locus in loci:
+        locus['work_dir'] = os.path.join(batch_dir, "{:05d}-{}".format(locus['index'],
+                                                                      re.sub(r'[^\w.-]', '_', locus['gene'])))
+    make_paths_absolute(options)
+    jobs = max(1, min(options.jobs, len(loci)))
+    if jobs > 1 and options.est_fact_shards != 1:
+        # The loci processed in parallel already share the processors and the memory budget
+        logging.warning("The ESTs of each locus are not split into shards when the loci are processed in parallel")
+        options.est_fact_shards = 1
+    budget = options.memory_budget * 1024 * 1024 if options.memory_budget else available_memory()
+    model = CostModel(options.cost_model or os.path.join(batch_dir, "pintron-cost-model.json"))
+    for locus in loci:
+        locus['genomic_length'] = sequence_statistics(locus['genomic'])[1]
+        (locus['number_of_ests'], locus['ests_length']) = sequence_statistics(locus['ests'])
+        (locus['predicted_time'], locus['predicted_memory']) = model.predict(
+            locus['genomic_length'], locus['number_of_ests'], locus['ests_length'])
+        # est-fact cannot use more memory than its limit
+        limit = est_fact_limits(options, locus['genomic_length'], locus['number_of_ests'],
+                                locus['ests_length'])[resource.RLIMIT_AS]
+        locus['memory'] = min(limit, locus['predicted_memory'] * EST_FACT_SAFETY_MARGIN)
+    logging.info("Processing %d loci with %d parallel jobs and %.0f MiB of memory...",
+                 len(loci), jobs, budget / (1024 * 1024))
+
+    start = time.time()
+    summary = []
+    # Longest processing time first: the longest loci do not delay the end of the batch
+    pending = sorted(loci, key=lambda locus: locus['predicted_time'], reverse=True)
+    running = {}
+    completed = queue.Queue()
+    if options.batch_engine == 'async':
+        pool = AsyncLocusPool(jobs)
     else:
-        exec_system_command(
-            command="cp " + options.genome_filename + " genomic.txt ",
-            error_comment="Could not prepare genomic input file",
-            logfile=options.plogfile,
-            cmd_label='cmd-1a-copy-genomic',
-            output_file='raw-multifasta-out.txt')
-
-    if os.path.isfile('ests.txt') and os.path.samefile('ests.txt', options.EST_filename):
-        logging.debug('Files "%s" and "ests.txt" refer to the same file: skip copy.',
-                      options.EST_filename)
+        pool = WorkerPool(options)
+    with pool:
+        while pending or running:
+            # Admit the longest pending loci whose memory fits in the budget left.  A locus
+            # larger than the whole budget is executed alone.
+            used = sum(locus['memory'] for locus in running.values())
+            for locus in list(pending):
+                if len(running) >= jobs:
+                    break
+                if used + locus['memory'] <= budget or not running:
+                    pending.remove(locus)
+                    running[locus['index']] = locus
+                    used += locus['memory']
+                    logging.debug("Starting locus %d (%s): predicted %.0fs, %.0f MiB", locus['index'],
+                                  locus['gene'], locus['predicted_time'], locus['memory'] / (1024 * 1024))
+                    pool.apply_async(run_batch_locus, (locus, options), callback=completed.put,
+                                     error_callback=lambda err, locus=locus: completed.put(
+                                         {'index': locus['index'], 'gene': locus['gene'], 'status': 'failed',
+                                          'error': str(err), 'wall_time': 0.0}))
+            status = completed.get()
+            locus = running.pop(status['index'])
+            logging.info("Locus %d (%s): %s in %.1fs (predicted %.1fs)", status['index'], status['gene'],
+                         status['status'], status['wall_time'], locus['predicted_time'])
+            summary.append(status)
+            peak_rss = None
+            try:
+                with open(status['metrics'], mode='r', encoding='utf-8') as fd:
+                    metrics = json.load(fd)
+                if not metrics['cached']:
+                    peak_rss = max((stage['peak_rss'] for stage in metrics['stages'] if stage.get('peak_rss')),
+                                   default=None)
+            except (KeyError, OSError, ValueError):
+                pass
+            if status['status'] == 'ok' and peak_rss:
+                model.add(locus['genomic_length'], locus['number_of_ests'], locus['ests_length'],
+                          status['wall_time'], peak_rss)
+                model.save()
+    summary.sort(key=lambda status: status['index'])
+
+    failed = [status for status in summary if status['status'] != 'ok']
+    with open(os.path.join(batch_dir, "pintron-batch-summary.json"), mode='w', encoding='utf-8') as fd:
+        fd.write(json.dumps({'loci': summary,
+                             'number_of_loci': len(summary),
+                             'number_of_failed_loci': len(failed),
+                             'jobs': jobs,
+                             'wall_time': round(time.time() - start, 3)},
+                            sort_keys=True, indent=4))
+    if options.merge_gtf:
+        merge_gtf([status['gtf'] for status in summary if 'gtf' in status], options.merge_gtf)
+    if failed:
+        raise PIntronError("{} out of {} loci failed (see {})".format(
+            len(failed), len(summary), os.path.join(batch_dir, "pintron-batch-summary.json")))
+
+
+class PipelineService:
+    """Queue of the pipeline jobs submitted to the service.
+
+    At most options.jobs jobs are executed at a time (by run_batch_locus), each
+    in a worker process forked from the service, hence with the checksums of the
+    programs of the pipeline already computed (see pintron_service).  Each
+    job is processed in its own work directory under options.batch_dir, and its
+    status record is the one of a locus of a batch, plus its 'id' and the
+    'queued', 'running', 'ok' or 'failed' status.  Only the last
+    options.serve_max_finished_jobs finished jobs are kept, with their work
+    directories.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.work_dir = os.path.abspath(options.batch_dir)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.last_id = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.slots = threading.Semaphore(max(1, options.jobs))
+        self.pool = WorkerPool(options)
+        self.dispatcher = threading.Thread(target=self._dispatch, name="dispatcher", daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, request):
+        """Queue the job described by the JSON request and return its status.
+
+        The request gives the genomic sequence and the ESTs either as their
+        FASTA text ('genomic_sequence' and 'ests_sequences') or, only if
+        options.serve_input_dir is set, as the paths of files in that directory
+        ('genomic' and 'ests', relative to the directory), and optionally the 'gene' and the 'organism'.
+        Raise ValueError if the request is not valid.
+        """
+        if not isinstance(request, dict):
+            raise ValueError("the job must be a JSON object")
+        inputs = {}
+        for (path, text) in (('genomic', 'genomic_sequence'), ('ests', 'ests_sequences')):
+            if (path in request) == (text in request):
+                raise ValueError("exactly one of '{}' and '{}' is required".format(path, text))
+            if path in request:
+                inputs[path] = self._input_file(str(request[path]))
+        with self.lock:
+            self.last_id += 1
+            job_id = self.last_id
+            gene = str(request.get('gene') or self.options.gene)
+            job = {
+                'id': job_id,
+                'index': job_id,
+                'gene': gene,
+                'organism': str(request.get('organism') or self.options.organism),
+                'work_dir': os.path.join(self.work_dir, "job-{:05d}-{}".format(job_id,
+                                                                              re.sub(r'[^\w.-]', '_', gene))),
+                'status': 'queued',
+                'submitted': round(time.time(), 3),
+            }
+            self.jobs[job_id] = job
+        os.makedirs(job['work_dir'], exist_ok=True)
+        for (path, text, name) in (('genomic', 'genomic_sequence', 'genomic.txt'),
+                                   ('ests', 'ests_sequences', 'ests.txt')):
+            if path in request:
+                job[path] = inputs[path]
+            else:
+                job[path] = os.path.join(job['work_dir'], name)
+                with open(job[path], mode='w', encoding='utf-8') as fd:
+                    fd.write(str(request[text]))
+        logging.info("Job %d (%s) queued", job_id, job['gene'])
+        self.queue.put(job_id)
+        return self.status(job_id)
+
+    def _input_file(self, path):
+        # The files of the jobs are confined to options.serve_input_dir (symbolic links resolved)
+        if not self.options.serve_input_dir:
+            raise ValueError("the service does not accept input files: send the sequences instead")
+        root = os.path.realpath(self.options.serve_input_dir)
+        full_path = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, full_path]) != root:
+            raise ValueError("file '{}' is not in the input directory of the service".format(path))
+        if not os.path.isfile(full_path) or not os.access(full_path, os.R_OK):
+            raise ValueError("could not read file '{}'".format(path))
+        return full_path
+
+    def _dispatch(self):
+        while True:
+            job_id = self.queue.get()
+            if job_id is None:
+                break
+            self.slots.acquire()
+            with self.lock:
+                job = self.jobs[job_id]
+                job['status'] = 'running'
+                job['started'] = round(time.time(), 3)
+                locus = {key: job[key] for key in ('index', 'gene', 'organism', 'genomic', 'ests', 'work_dir')}
+            self.pool.apply_async(run_batch_locus, (locus, self.options),
+                                  callback=lambda status, job_id=job_id: self._completed(job_id, status),
+                                  error_callback=lambda err, job_id=job_id: self._completed(
+                                      job_id, {'status': 'failed', 'error': str(err)}))
+
+    def _completed(self, job_id, status):
+        expired = []
+        with self.lock:
+            job = self.jobs[job_id]
+            job.update(status)
+            job['finished'] = round(time.time(), 3)
+            self.finished.append(job_id)
+            while len(self.finished) > max(0, self.options.serve_max_finished_jobs):
+                expired.append(self.jobs.pop(self.finished.popleft()))
+        self.slots.release()
+        logging.info("Job %d (%s): %s in %.1fs", job_id, job['gene'], job['status'],
+                     job['finished'] - job['started'])
+        for old_job in expired:
+            logging.debug("Job %d expired", old_job['id'])
+            shutil.rmtree(old_job['work_dir'], ignore_errors=True)
+
+    def status(self, job_id=None):
+        """Return a copy of the status of the job, or of all the jobs if job_id is None."""
+        with self.lock:
+            if job_id is None:
+                return [dict(job) for job in self.jobs.values()]
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def close(self):
+        """Stop the service: the jobs still queued or running are abandoned."""
+        self.queue.put(None)
+        self.pool.terminate()
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ServiceRequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP/JSON interface of the PipelineService of the server.
+
+    POST /jobs                 queue a job (see PipelineService.submit)
+    GET  /jobs                 status of all the jobs
+    GET  /jobs/ID              status of a job
+    GET  /jobs/ID/RESULT       result file of a completed job, where RESULT is
+                               one of the results in its status ('output' for
+                               the JSON file, 'gtf', 'cds_gtf', 'gff3', 'bed',
+                               'bundle', 'metrics')
+    """
+
+    RESULTS = {'output': 'application/json', 'gtf': 'text/plain', 'cds_gtf': 'text/plain',
+               'gff3': 'text/plain', 'bed': 'text/plain', 'bundle': 'application/octet-stream',
+               'metrics': 'application/json'}
+    # Content type of the results compressed by each codec (see COMPRESSION_CODECS)
+    COMPRESSED_RESULTS = {'.gz': 'application/gzip', '.bz2': 'application/x-bzip2', '.xz': 'application/x-xz'}
+
+    def log_message(self, format, *args):
+        logging.debug("Service: " + format, *args)
+
+    def _send_json(self, code, content):
+        body = json.dumps(content, sort_keys=True, indent=4).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message):
+        self._send_json(code, {'error': message})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._send_error(404, "unknown resource " + self.path)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError("negative Content-Length")
+            if length > self.server.service.options.serve_max_request_size * 1024 * 1024:
+                # The body is not read
+                self.close_connection = True
+                return self._send_error(413, "the job exceeds the maximum size of {} MiB".format(
+                    self.server.service.options.serve_max_request_size))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            status = self.server.service.submit(request)
+        except ValueError as e:
+            return self._send_error(400, "invalid job: " + str(e))
+        except OSError as e:
+            return self._send_error(500, "could not queue the job: " + str(e))
+        self._send_json(202, status)
+
+    def do_GET(self):
+        service = self.server.service
+        parts = [part for part in self.path.split('/') if part]
+        if parts == ['jobs']:
+            return self._send_json(200, service.status())
+        if len(parts) not in (2, 3) or parts[0] != 'jobs' or not parts[1].isdigit():
+            return self._send_error(404, "unknown resource " + self.path)
+        status = service.status(int(parts[1]))
+        if status is None:
+            return self._send_error(404, "unknown job " + parts[1])
+        if len(parts) == 2:
+            return self._send_json(200, status)
+        result = parts[2]
+        if result not in self.RESULTS:
+            return self._send_error(404, "unknown result " + result)
+        if status['status'] != 'ok' or result not in status:
+            return self._send_error(409, "result '{}' of job {} not available (status: {})".format(
+                result, status['id'], status['status']))
+        try:
+            fd = open(status[result], 'rb')
+        except OSError as e:
+            return self._send_error(500, "could not read the result: " + str(e))
+        with fd:
+            self.send_response(200)
+            suffix = os.path.splitext(status[result])[1]
+            self.send_header("Content-Type", self.COMPRESSED_RESULTS.get(suffix, self.RESULTS[result]))
+            self.send_header("Content-Length", str(os.fstat(fd.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(fd, self.wfile)
+
+
+def pintron_service(options):
+    """Run the pipeline as a service, on the jobs submitted over HTTP until interrupted.
+
+    options.serve is either HOST:PORT or the path of a Unix socket (which
+    replaces a stale socket, but no other file).  The programs of the pipeline
+    are looked up once, when the service starts.
+    """
+    logging.info("PIntron%s", pintron_version)
+    make_paths_absolute(options)
+    check_executables(options.bindir, ["est-fact", "min-factorization", "intron-agreement",
+                                       "compact-compositions", "maximal-transcripts", "cds-annotation"])
+    (host, separator, port) = options.serve.rpartition(':')
+    if separator and port.isdigit():
+        server_class = http.server.ThreadingHTTPServer
+        address = (host or "localhost", int(port))
     else:
-        exec_system_command(
-            command="cp " + options.EST_filename + " ests.txt ",
-            error_comment="Could not prepare ESTs input file",
-            logfile=options.plogfile,
-            cmd_label='cmd-1b-copy-ests',
-            output_file='raw-multifasta-out.txt')
-
-    # Compute factorizations
-    logging.info("STEP  2:  Pre-aligning transcript data...")
-
-    exec_system_command(
-        command="ulimit -t " + str(options.max_factorization_time * 60) + " && ulimit -v " +
-        str(options.max_factorization_memory * 1024) + " && " + exes["est-fact"],
-        error_comment="Could not compute the factorizations",
-        logfile=options.plogfile,
-        cmd_label='cmd-2-est-fact',
-        output_file='raw-multifasta-out.txt')
-
-    # Min factorization agreement
-    logging.info("STEP  3:  Computing a raw consensus gene structure...")
-
-    exec_system_command(
-        command="ulimit -t " + str(options.max_exon_agreement_time * 60) + " && " +
-        exes["min-factorization"] + " < raw-multifasta-out.txt >out-agree.txt",
-        error_comment="Could not minimize the factorizations",
-        logfile=options.plogfile,
-        cmd_label='cmd-3-min-factorization',
-        output_file='out-agree.txt')
-
-    # Intron prediction
-    logging.info("STEP  4:  Predicting introns...")
-
-    exec_system_command(
-        command="ulimit -t " + str(options.max_intron_agreement_time * 60) + " && " +
-        exes["intron-agreement"],
-        error_comment="Could not compute the factorizations",
-        logfile=options.plogfile,
-        cmd_label='cmd-4-intron-agreement',
-        output_file='out-after-intron-agree.txt')
-
-    # The computation of the full-length isoforms should not be avoided
-    # if options.step1:
-    #     sys.exit(0)
-
-    # Transform compositions into exons
-    logging.info("STEP  5:  Computing the final transcript alignments...")
-
-    exec_system_command(
-        command=exes["compact-compositions"] + " < out-after-intron-agree.txt > build-ests.txt",
-        error_comment="Could not transform factorizations into exons",
-        logfile=options.plogfile,
-        cmd_label='cmd-5-compact-compositions',
-        output_file='build-ests.txt')
-
-    # Compute maximal transcripts
-    logging.info("STEP  6:  Computing the final full-length isoforms...")
-
-    exec_system_command(
-        command=exes["maximal-transcripts"] + " < build-ests.txt",
-        error_comment="Could not compute maximal transcripts",
-        logfile=options.plogfile,
-        cmd_label='cmd-6a-maximal-transcripts',
-        output_file='CCDS_transcripts.txt')
-    exec_system_command(
-        command="cp -f TRANSCRIPTS1_1.txt isoforms.txt",
-        error_comment="Could not link isoforms",
-        logfile=options.plogfile,
-        cmd_label='cmd-6b-copy-maximal-transcripts',
-        output_file='CCDS_transcripts.txt')
-
-    # Annotate CDS
-    logging.info("STEP  7:  Annotating CDS...")
-
-    exec_system_command(
-        command=exes["cds-annotation"] + " ./ ./ " + options.gene + " " + options.organism,
-        error_comment="Could not annotate the CDSs",
-        logfile=options.plogfile,
-        cmd_label='cmd-7-cds-annotation',
-        output_file='CCDS_transcripts.txt')
-
-    # TODO: Transcripts browser
-    # Output the desired file
-    logging.info("STEP  8:  Saving outputs...")
-
-    json_output = compute_json(ccds_file="CCDS_transcripts.txt",
-                             variant_file="VariantGTF.txt",
-                             output_file=options.output_filename,
-                             pas_tolerance=options.pas_tolerance,
-                             genomic_seq=options.genome_filename)
+        server_class = _UnixHTTPServer
+        address = os.path.abspath(options.serve)
+        if _is_socket(address):
+            os.remove(address)
+        elif os.path.lexists(address):
+            raise PIntronIOError(address, "The service address exists and is not a Unix socket")
+    service = PipelineService(options)
+    # SIGTERM stops the service as an interrupt does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        with server_class(address, _ServiceRequestHandler) as server:
+            server.service = service
+            logging.info("Serving PIntron jobs at %s with %d workers", options.serve, max(1, options.jobs))
+            server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Service interrupted")
+    finally:
+        # A further interrupt (e.g., Ctrl-C sent again to the process group) must not stop the cleanup,
+        # which is bounded by the termination timeout of the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        try:
+            service.close()
+        finally:
+            if server_class is _UnixHTTPServer and _is_socket(address):
+                os.remove(address)
 
-    if options.gtf_filename:
-        json2gtf(options.output_filename, options.gtf_filename, options.gene,
-                 not options.only_cds_annot)
-
-    # Clean mess
-    logging.info("STEP 10:  Finalizing...")
-
-    if options.compress:
-        exec_system_command("gzip -q9 " + " ".join([options.output_filename,
-                                                    options.plogfile,
-                                                    options.glogfile]),
-                            error_comment="Could not compress final files",
-                            logfile="/dev/null",
-                            cmd_label='cmd-10-compress',
-                            output_file=options.output_filename + '.gz')
-
-    if not options.no_clean:
-        tempfiles = ("TEMP_COMPOSITION_TRANS1_1.txt", "TEMP_COMPOSITION_TRANS1_2.txt",
-                   "TEMP_COMPOSITION_TRANS1_3.txt", "TEMP_COMPOSITION_TRANS1_4.txt",
-                   "TRANSCRIPTS1_1.txt", "TRANSCRIPTS1_2.txt", "TRANSCRIPTS1_3.txt", "TRANSCRIPTS1_4.txt",
-                   "VariantGTF.txt", "build-ests.txt", "CCDS_transcripts.txt", "config-dump.ini",
-                   "genomic-exonforCCDS.txt", "info-pid-*.log", "isoforms.txt",
-                   "meg-edges.txt", "megs.txt", "out-after-intron-agree.txt", "out-agree.txt", "out-fatt.txt",
-                   "predicted-introns.txt", "processed-ests.txt", "processed-megs-info.txt",
-                   "processed-megs.txt", "raw-multifasta-out.txt", "time-limits")
-        subprocess.call("rm -f " + " ".join(tempfiles), shell=True)
-
-
-def prepare_loggers(options):
+
+def _is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+def log_file_handler(options):
+    """Return the handler that saves the messages to options.glogfile (compressed if requested)."""
+    compression = compression_of(options)
+    if compression:
+        handler = CompressedFileHandler(compressed_name(options.glogfile, compression), compression)
+    else:
+        handler = logging.FileHandler(options.glogfile, mode='w')
+    handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(asctime)s%(msecs)d:%(message)s',
+                                           datefmt='%Y%m%d-%H%M%S'))
+    return handler
+
+
+def prepare_loggers(options, console_level=logging.INFO):
     """Prepare loggers.
 
-    Save DEBUG and higher messages to options.glogfile, and INFO and higher messages to stdout
+    Save DEBUG and higher messages to options.glogfile, and console_level (INFO by default)
+    and higher messages to stdout
     Code adapted from
     http://docs.python.org/py3k/library/logging.html?highlight=logging#logging-to-multiple-destinations
     """
-    logging.basicConfig(filename=options.glogfile,
-                        filemode='w',
-                        format='%(levelname)s:%(name)s:%(asctime)s%(msecs)d:%(message)s',
-                        datefmt='%Y%m%d-%H%M%S',
-                        level=logging.DEBUG)
+    root = logging.getLogger('')
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    logging.basicConfig(level=logging.DEBUG, handlers=[log_file_handler(options)])
     console = logging.StreamHandler()
-    console.setLevel(logging.INFO)
+    console.setLevel(console_level)
     formatter = logging.Formatter('[%(levelname)-8s] %(asctime)s - %(message)s')
     console.setFormatter(formatter)
     logging.getLogger('').addHandler(console)
@@ -1028,8 +4638,29 @@ if __name__ == '__main__':
             options.version = ''
         else:
             options.version = pintron_version
+        if options.cache_list or options.cache_purge:
+            if not options.cache_dir:
+                sys.exit("Option --cache-dir is required to inspect or purge the cache")
+            cache = ResultCache(options.cache_dir)
+            if options.cache_purge:
+                cache.purge()
+            cache.print_entries()
+            sys.exit(0)
+        if options.query_gtf:
+            index = read_tabix_index(options.query_gtf + ".tbi")
+            for region in options.arguments:
+                sys.stdout.writelines(query_gtf(options.query_gtf, region, index))
+            sys.exit(0)
+        if options.merge_gtf and not options.batch_manifest:
+            merge_gtf(options.arguments, options.merge_gtf)
+            sys.exit(0)
         prepare_loggers(options)
-        pintron_pipeline(options)
+        if options.serve:
+            pintron_service(options)
+        elif options.batch_manifest:
+            pintron_batch(options)
+        else:
+            pintron_pipeline(options)
     except PIntronError as err:
         logging.exception("*** Fatal error caught during the execution of the pipeline! ***\n"
                           "%s", err)